@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import functools
+import multiprocessing
+from dataclasses import dataclass, asdict, replace
+from flasher.util import set_log_level
+from flasher.program import Image, Program, RetryPolicy, PipelineSettings
+from flasher.link import LinkProfile, open_link
+from flasher_simulated.device_timing import TIMING_PROFILES, FaultInjection
+from flasher_simulated.loopback import LoopbackSerial
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+# End to end flash benchmark: full Program() sessions of flasher/ against the simulated bootloader of
+# main_simulated.py, over a local TCP connection or an in-process loopback. Run from the repository root:
+#   python -m benchmarks.flash_bench                   quick suite, compared against benchmarks/baselines.json
+#   python -m benchmarks.flash_bench --suite full      every axis swept around the default case
+#   python -m benchmarks.flash_bench --save-baseline   store the results as the new baselines
+# Absolute times depend on the host, so a case only regresses when it got slower than its baseline both in absolute
+# terms and relative to the default case of the same run (see compare()).
+# Every case runs in a fresh process (and the simulator in one of its own), so CPU time and peak RSS are the host
+# side's alone and don't carry over between cases.
+
+BASELINES_FILE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+IMAGE_ADDR: int = 0x10008000  # first address the simulated bootloader accepts
+SECTOR_SIZE: int = 4096
+READ_TIMEOUT: float = 5.0  # seconds, generous for the slow link cases
+DEFAULT_TOLERANCE: float = 0.10
+
+
+@dataclass
+class BenchCase:
+    name: str
+    image_size: int = 1024 * 1024  # bytes
+    chunk_size: int = 1024  # max_data_len the simulator announces, bytes per WRIT
+    sparsity: float = 0.0  # fraction of sectors left erased (0xff)
+    window: int = 1  # WRIT frames in flight
+    latency: float = 0.0  # seconds added to every response
+    bandwidth: int = 0  # bytes/s in each direction, 0 for unlimited
+    timing: str = "ideal"  # simulator timing profile, the latency and bandwidth above are added on top
+    err_rate: float = 0.0  # probability of an ERR! answer per command
+
+
+@dataclass
+class BenchResult:
+    name: str
+    ok: bool
+    wall: float = 0.0  # seconds
+    rate: float = 0.0  # image bytes/s
+    cpu: float = 0.0  # seconds of host process CPU time
+    peak_rss: int = 0  # bytes, 0 when unknown
+
+
+DEFAULT_CASE = BenchCase("default")
+
+# Each axis is varied on its own, the other parameters stay at the default case.
+SWEEPS: dict = {
+    "size": ("image_size", [4 * 1024, 64 * 1024, 256 * 1024, 4 * 1024 * 1024, 15 * 1024 * 1024]),
+    "chunk": ("chunk_size", [256, 1024, 4096]),
+    "sparsity": ("sparsity", [0.5, 0.9]),
+    "window": ("window", [4, 16]),
+    "latency": ("latency", [0.001, 0.005]),
+    "bandwidth": ("bandwidth", [1000000, 250000]),
+    "timing": ("timing", ["flash", "usb-cdc", "uart-921600"]),
+    "err": ("err_rate", [0.001, 0.01]),
+}
+
+QUICK_CASES: list = ["default", "size-4194304", "window-4", "latency-0.001"]
+
+
+def full_suite() -> list:
+    cases = [DEFAULT_CASE]
+    for axis, (attr, values) in SWEEPS.items():
+        for value in values:
+            cases.append(replace(DEFAULT_CASE, name=axis + "-" + str(value), **{attr: value}))
+    return cases
+
+
+def quick_suite() -> list:
+    return [c for c in full_suite() if c.name in QUICK_CASES]
+
+
+# Random image data of the given size, the same for every run. A `sparsity` fraction of its sectors is left erased.
+def make_image(size: int, sparsity: float = 0.0, seed: int = 1) -> Image:
+    rng = random.Random(seed)
+    data = bytearray(rng.randbytes(size))
+    for start in range(0, size, SECTOR_SIZE):
+        if rng.random() < sparsity:
+            data[start:start + SECTOR_SIZE] = b'\xff' * len(data[start:start + SECTOR_SIZE])
+    return Image(IMAGE_ADDR, bytes(data))
+
+
+# The simulated device's timing and faults for a case.
+def _device_settings(case: BenchCase):
+    timing = replace(TIMING_PROFILES[case.timing])
+    timing.latency += case.latency
+    if case.bandwidth:
+        timing.bandwidth = case.bandwidth
+    faults = FaultInjection(err_rate=case.err_rate, seed=1) if case.err_rate else None
+    return timing, faults
+
+
+# Simulator process: serves the simulated bootloader on an ephemeral port and sends the port number back.
+def _serve_simulator(case: BenchCase, port_pipe):
+    from main_simulated import simulated_device
+    set_log_level("quiet")
+    timing, faults = _device_settings(case)
+
+    async def serve():
+        device = functools.partial(simulated_device, timing=timing, faults=faults, max_data_len=case.chunk_size)
+        server = await asyncio.start_server(device, '127.0.0.1', 0)
+        port_pipe.send(server.sockets[0].getsockname()[1])
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def _peak_rss() -> int:
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+# Case process: flashes one image and sends a BenchResult back. With the tcp transport the simulator runs in a
+# process of its own; with the loopback transport it runs in a thread of this process, so there is no socket in
+# between, but the CPU time and RSS include the simulator.
+def _measure(case: BenchCase, transport: str, result_pipe):
+    set_log_level("quiet")
+    image = make_image(case.image_size, case.sparsity)
+    simulator = None
+    try:
+        if transport == "loopback":
+            from main_simulated import simulated_device
+            timing, faults = _device_settings(case)
+            conn = LoopbackSerial(functools.partial(simulated_device, timing=timing, faults=faults,
+                                                    max_data_len=case.chunk_size), timeout=READ_TIMEOUT)
+        else:
+            mp = multiprocessing.get_context("spawn")
+            port_recv, port_send = mp.Pipe(duplex=False)
+            simulator = mp.Process(target=_serve_simulator, args=(case, port_send), daemon=True)
+            simulator.start()
+            conn = open_link("tcp:127.0.0.1:" + str(port_recv.recv()), LinkProfile(read_timeout=READ_TIMEOUT))
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        Program(conn, image, None, RetryPolicy(max_retries=10), use_journal=False,
+                pipeline=PipelineSettings(window=case.window))
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        conn.close()
+        result_pipe.send(BenchResult(case.name, True, wall, case.image_size / wall, cpu, _peak_rss()))
+    except SystemExit:
+        result_pipe.send(BenchResult(case.name, False))
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+
+
+def run_case(case: BenchCase, transport: str = "tcp") -> BenchResult:
+    mp = multiprocessing.get_context("spawn")
+    result_recv, result_send = mp.Pipe(duplex=False)
+    proc = mp.Process(target=_measure, args=(case, transport, result_send))
+    proc.start()
+    result = result_recv.recv() if result_recv.poll(600) else BenchResult(case.name, False)
+    proc.join()
+    return result
+
+
+# Runs a case `repeat` times and keeps the fastest wall and CPU time, which are the least disturbed by other load.
+def run_repeated(case: BenchCase, repeat: int, transport: str = "tcp") -> BenchResult:
+    best = None
+    for _ in range(repeat):
+        result = run_case(case, transport)
+        if not result.ok:
+            return result
+        if best is None:
+            best = result
+        else:
+            best = replace(best, wall=min(best.wall, result.wall), cpu=min(best.cpu, result.cpu),
+                           peak_rss=max(best.peak_rss, result.peak_rss))
+    return replace(best, rate=case.image_size / best.wall)
+
+
+def load_baselines(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_baselines(path: str, results: list):
+    baselines = load_baselines(path)
+    for r in results:
+        if r.ok:
+            baselines[r.name] = asdict(r)
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def _delta(value: float, baseline: float) -> float:
+    return value / baseline - 1 if baseline else 0.0
+
+
+# Returns how a result compares to its baseline as text, and whether the wall or CPU time regressed by more than the
+# tolerance. A time counts as regressed only when it grew both against its baseline and relative to the reference
+# result of the same run, so that a slower host (everything slower) or a faster one (the link bound cases, which don't
+# speed up with the host, slower relative to the reference) doesn't fail the run. The reference itself isn't checked.
+def compare(result: BenchResult, reference: BenchResult, baselines: dict, tolerance: float):
+    baseline = baselines.get(result.name)
+    reference_baseline = baselines.get(reference.name)
+    if baseline is None or reference_baseline is None:
+        return "no baseline", False
+    wall_delta = _delta(result.wall, baseline["wall"])
+    cpu_delta = _delta(result.cpu, baseline["cpu"])
+    if result.name == reference.name:
+        return "wall %+6.1f%% cpu %+6.1f%%  reference" % (wall_delta * 100, cpu_delta * 100), False
+    if not reference.ok:
+        return reference.name + " failed", False
+    wall_delta = min(wall_delta, _delta(result.wall / reference.wall, baseline["wall"] / reference_baseline["wall"]))
+    cpu_delta = min(cpu_delta, _delta(result.cpu / reference.cpu if reference.cpu else 0.0,
+                                      baseline["cpu"] / reference_baseline["cpu"] if reference_baseline["cpu"] else 0.0))
+    regressed = wall_delta > tolerance or cpu_delta > tolerance
+    text = "wall %+6.1f%% cpu %+6.1f%%" % (wall_delta * 100, cpu_delta * 100)
+    return text + ("  REGRESSION" if regressed else ""), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end flash benchmark on the simulated bootloader.")
+    parser.add_argument("--suite", choices=["quick", "full"], default="quick")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baselines", default=BASELINES_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--transport", choices=["tcp", "loopback"], default="tcp",
+                        help="tcp measures the host alone, loopback skips the sockets but includes the simulator")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    cases = full_suite() if args.suite == "full" else quick_suite()
+    cases = [c for c in cases if args.filter in c.name]
+    # The reference of the comparisons runs first, also when the filter leaves it out
+    cases = [DEFAULT_CASE] + [c for c in cases if c.name != DEFAULT_CASE.name]
+    baselines = load_baselines(args.baselines)
+
+    print("%-20s %10s %9s %9s %8s %8s  %s" % ("case", "bytes", "wall s", "kB/s", "cpu s", "rss MB", "vs baseline"))
+    results = list()
+    reference = None
+    regressions = 0
+    for case in cases:
+        result = run_repeated(case, args.repeat, args.transport)
+        results.append(result)
+        if reference is None:
+            reference = result
+        if not result.ok:
+            print("%-20s %10d  FAILED" % (case.name, case.image_size))
+            regressions += 1
+            continue
+        text, regressed = compare(result, reference, baselines, args.tolerance)
+        regressions += regressed
+        print("%-20s %10d %9.3f %9.1f %8.3f %8.1f  %s" % (case.name, case.image_size, result.wall, result.rate / 1000,
+                                                         result.cpu, result.peak_rss / 1e6, text))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([asdict(r) for r in results], f, indent=2)
+    if args.save_baseline:
+        save_baselines(args.baselines, results)
+        print("Baselines saved to " + args.baselines)
+    sys.exit(1 if regressions and not args.save_baseline else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import sys
+import struct
+import argparse
+import tempfile
+import functools
+import tracemalloc
+from dataclasses import dataclass
+from flasher.util import set_log_level
+from flasher.elf import load_elf
+from flasher.program import Program, RetryPolicy, PipelineSettings
+from flasher.registry import DeviceRegistry
+from flasher_simulated.loopback import LoopbackSerial
+from flasher_simulated.flash_model import SparseFlash
+from benchmarks.flash_bench import make_image
+
+# Memory budget benchmark: the peak of the Python allocations (tracemalloc) while loading an ELF file and during a
+# complete flash session against the simulated bootloader, at several image sizes. Run from the repository root:
+#   python -m benchmarks.memory_bench                  quick suite
+#   python -m benchmarks.memory_bench --suite full     up to 15 MB images
+# Unlike times, allocations don't depend on the machine, so every case has a fixed budget instead of a baseline, and
+# the exit code is 1 when a case goes over it. Stations flash many devices in parallel, so a copy of the image more
+# per flash is a regression even when it is fast.
+# The simulated device runs in a thread of this process (loopback), its flash holding a copy of every page written,
+# which is part of the budgets of the flash cases.
+
+KB: int = 1024
+MB: int = 1024 * 1024
+
+# Budget of a case: bytes per byte of the image, plus fixed bytes.
+#   load_elf: the section data read by pyelftools, the image being assembled and the bytes of the finished image
+#   flash: the pages of the simulated flash, the host side itself doesn't copy the image, padded or not
+BUDGETS: dict = {
+    "load_elf": (3.25, 512 * KB),
+    "flash": (1.25, 512 * KB),
+}
+
+WARMUP_SIZE: int = 64 * KB
+
+
+@dataclass
+class MemoryCase:
+    name: str
+    kind: str  # "load_elf" or "flash"
+    image_size: int
+    window: int = 1
+    use_journal: bool = False
+    registry: bool = False
+
+    def budget(self) -> int:
+        per_byte, fixed = BUDGETS[self.kind]
+        return int(self.image_size * per_byte) + fixed
+
+
+def _sized_cases(sizes: list) -> list:
+    cases = list()
+    for size in sizes:
+        cases.append(MemoryCase("load_elf-" + str(size), "load_elf", size))
+        cases.append(MemoryCase("flash-" + str(size), "flash", size))
+    return cases
+
+
+# Images that don't end on the write size are padded before they are written, ELF files almost never do.
+def quick_suite() -> list:
+    return _sized_cases([64 * KB, 1 * MB, 4 * MB]) + [
+        MemoryCase("flash-journal", "flash", 1 * MB, use_journal=True),
+        MemoryCase("flash-window-8", "flash", 1 * MB, window=8),
+        MemoryCase("flash-registry", "flash", 1 * MB, registry=True),
+        MemoryCase("flash-unaligned", "flash", 1 * MB - 100),
+        MemoryCase("flash-unaligned-journal", "flash", 1 * MB - 100, use_journal=True, registry=True),
+    ]
+
+
+def full_suite() -> list:
+    return quick_suite() + _sized_cases([15 * MB]) + [MemoryCase("flash-unaligned-15M", "flash", 15 * MB - 100)]
+
+
+# A minimal ELF file with the image in one loadable segment and one section, like the flash part of a Pico build.
+def write_elf(path: str, addr: int, data: bytes):
+    names = b'\0.text\0.shstrtab\0'
+    data_offset = 52 + 32
+    names_offset = data_offset + len(data)
+    sections_offset = -(-(names_offset + len(names)) // 4) * 4
+    with open(path, 'wb') as f:
+        f.write(b'\x7fELF' + bytes([1, 1, 1, 0]) + bytes(8))
+        f.write(struct.pack('<HHIIIIIHHHHHH', 2, 40, 1, addr, 52, sections_offset, 0, 52, 32, 1, 40, 3, 2))
+        f.write(struct.pack('<8I', 1, data_offset, addr, addr, len(data), len(data), 5, 4))
+        f.write(data)
+        f.write(names)
+        f.write(bytes(sections_offset - names_offset - len(names)))
+        f.write(bytes(40))
+        f.write(struct.pack('<10I', 1, 1, 6, addr, data_offset, len(data), 0, 0, 4, 0))
+        f.write(struct.pack('<10I', 7, 3, 0, 0, names_offset, len(names), 0, 0, 1, 0))
+
+
+def _traced_peak(func) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Peak bytes allocated by the case. Everything it needs is prepared before tracing starts.
+def measure(case: MemoryCase, work_dir: str) -> int:
+    from main_simulated import simulated_device
+    image = make_image(case.image_size)
+    if case.kind == "load_elf":
+        path = work_dir + "/" + case.name + ".elf"
+        write_elf(path, image.Addr, image.Data)
+        del image
+        return _traced_peak(lambda: load_elf(path))
+
+    registry = DeviceRegistry(tempfile.mkdtemp(dir=work_dir)) if case.registry else None
+    conn = LoopbackSerial(functools.partial(simulated_device, flash_memory=SparseFlash()), timeout=5.0)
+    try:
+        return _traced_peak(lambda: Program(conn, image, None, RetryPolicy(), use_journal=case.use_journal,
+                                            device_id="memory-bench", pipeline=PipelineSettings(window=case.window),
+                                            registry=registry))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory budgets of load_elf and Program.")
+    parser.add_argument("--suite", choices=["quick", "full"], default="quick")
+    args = parser.parse_args()
+    set_log_level("quiet")
+
+    cases = quick_suite() if args.suite == "quick" else full_suite()
+    over = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Lazy imports and first-use caches out of the way of the first measured cases
+        for kind in BUDGETS:
+            measure(MemoryCase("warmup-" + kind, kind, WARMUP_SIZE), work_dir)
+
+        print("%-24s %10s %10s %8s" % ("case", "peak MB", "budget MB", "x image"))
+        for case in cases:
+            peak = measure(case, work_dir)
+            budget = case.budget()
+            over += peak > budget
+            print("%-24s %10.2f %10.2f %8.2f%s" % (case.name, peak / MB, budget / MB, peak / case.image_size,
+                                                  "  OVER BUDGET" if peak > budget else ""))
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from dataclasses import dataclass, asdict
+
+# Startup benchmark: how long main.py takes before it does anything, which is a large part of a short flash job on
+# a slow host. Every measurement runs in a fresh interpreter. Run from the repository root:
+#   python -m benchmarks.startup_bench                   compared against benchmarks/startup_baselines.json
+#   python -m benchmarks.startup_bench --save-baseline   store the results as the new baselines
+# Besides the times, it checks that the modules main.py only imports where they are needed (DEFERRED_MODULES) are
+# not imported at startup, which fails the run whatever the speed of the machine.
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES_FILE: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup_baselines.json")
+DEFAULT_TOLERANCE: float = 0.20  # startup times are noisy
+
+# Only imported by the runs that need them: pyelftools for ELF files that aren't cached yet, the port enumeration for
+# 'auto', the thread pool for fleets, the watcher for --watch, the tuning for --tune, --tune-pipeline and the saved
+# pipeline settings of a flash.
+DEFERRED_MODULES: tuple = ("elftools", "flasher.elf", "serial.tools.list_ports", "flasher.discovery",
+                           "flasher.fleet", "concurrent.futures", "flasher.watch", "ctypes", "flasher.pipeline_tuning",
+                           "flasher.tuning")
+
+
+@dataclass
+class StartupResult:
+    name: str
+    seconds: float  # best of the repeats
+
+
+def _wall(args: list) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+# The output of -X importtime for 'import main': module -> (self, cumulative) import time in seconds.
+def import_profile() -> dict:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    profile = dict()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        profile[name.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+    return profile
+
+
+def run(repeat: int):
+    interpreter = min(_wall(["-c", "pass"]) for _ in range(repeat))
+    usage = min(_wall(["main.py"]) for _ in range(repeat))
+    profiles = [import_profile() for _ in range(repeat)]
+    imports = min(p["main"][1] for p in profiles if "main" in p)
+    results = [
+        StartupResult("interpreter", interpreter),
+        StartupResult("import main", imports),
+        StartupResult("main.py usage", usage),
+    ]
+    return results, profiles[-1]
+
+
+def load_baselines(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_baselines(path: str, results: list):
+    baselines = load_baselines(path)
+    for r in results:
+        baselines[r.name] = asdict(r)
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def compare(result: StartupResult, baseline: dict, tolerance: float):
+    if baseline is None:
+        return "no baseline", False
+    delta = result.seconds / baseline["seconds"] - 1
+    regressed = delta > tolerance
+    return ("%+6.1f%%" % (delta * 100)) + ("  REGRESSION" if regressed else ""), regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time benchmark of main.py.")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="modules listed by their own import time")
+    parser.add_argument("--baselines", default=BASELINES_FILE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    results, profile = run(args.repeat)
+    baselines = load_baselines(args.baselines)
+    regressions = 0
+    print("%-16s %9s  %s" % ("measurement", "ms", "vs baseline"))
+    for result in results:
+        text, regressed = compare(result, baselines.get(result.name), args.tolerance)
+        regressions += regressed
+        print("%-16s %9.1f  %s" % (result.name, result.seconds * 1000, text))
+
+    print("\nSlowest imports of main.py (own time, ms):")
+    for name, (self_s, _) in sorted(profile.items(), key=lambda item: -item[1][0])[:args.top]:
+        print("  %7.2f  %s" % (self_s * 1000, name))
+
+    loaded = [m for m in DEFERRED_MODULES if m in profile]
+    if loaded:
+        print("\nImported at startup although only some runs need them: " + ", ".join(loaded))
+        regressions += 1
+
+    if args.save_baseline:
+        save_baselines(args.baselines, results)
+        print("Baselines saved to " + args.baselines)
+    sys.exit(1 if regressions and not args.save_baseline else 0)
+
+
+if __name__ == '__main__':
+    main()
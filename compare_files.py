@@ -1,27 +1,64 @@
-def compare_files(file1, file2):
-    try:
-        with open(file1, 'r') as f1, open(file2, 'r') as f2:
-            file1_lines = f1.readlines()
-            file2_lines = f2.readlines()
-
-            differences = []
-            for i, (line1, line2) in enumerate(zip(file1_lines, file2_lines), start=1):
-                if line1 != line2:
-                    differences.append((i, line1, line2))
-
-            if differences:
-                print(f"Differences found between {file1} and {file2}:")
-                for line_num, line1, line2 in differences:
-                    print(f"Line {line_num}:")
-                    print(f"File 1: {line1.strip()}")
-                    print(f"File 2: {line2.strip()}")
-            else:
-                print(f"No differences found between {file1} and {file2}.")
-
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
+import sys
+import argparse
+from flasher.capture_diff import diff_captures, DEFAULT_WINDOW, DEFAULT_MAX_HUNKS
+
+# Compares two recorded sessions frame by frame: --capture files, the legacy binary logs (plc_device_output_real.bin)
+# or their text versions (plc_device_output_real.txt). Prints the first difference in detail and a summary, and exits
+# with 1 if the sessions differ, like diff.
+#   python compare_files.py plc_device_output_real.bin plc_device_output.bin
+#   python compare_files.py before.cap after.cap --max-hunks=50
+
+
+def _describe(frames: list) -> str:
+    text = frames[0].describe()
+    if len(frames) > 1:
+        text += " ... " + frames[-1].describe() + " (" + str(len(frames)) + " frames)"
+    return text
+
+
+def compare_files(file1: str, file2: str, window: int = DEFAULT_WINDOW, max_hunks: int = DEFAULT_MAX_HUNKS) -> bool:
+    result = diff_captures(file1, file2, window, max_hunks)
+    if result.identical():
+        print("No differences found between " + file1 + " and " + file2 + " (" + str(result.matched) + " frames).")
+        return True
+
+    print("Differences found between " + file1 + " (A) and " + file2 + " (B):")
+    first = result.hunks[0]
+    print("First difference at frame " + str(first.a_index) + " of A, frame " + str(first.b_index) + " of B:")
+    if first.kind == 'changed':
+        print("  A: " + first.a_frames[0].describe())
+        print("  B: " + first.b_frames[0].describe())
+        print("  first differing byte: " + str(first.offset()))
+    else:
+        print("  " + first.kind + ": " + _describe(first.a_frames or first.b_frames))
+
+    print("Differences (first " + str(len(result.hunks)) + "):")
+    for hunk in result.hunks:
+        if hunk.kind == 'changed':
+            text = hunk.a_frames[0].describe() + " -> " + hunk.b_frames[0].describe()
+        else:
+            text = _describe(hunk.a_frames or hunk.b_frames)
+        print("  A " + str(hunk.a_index) + " / B " + str(hunk.b_index) + " " + hunk.kind + ": " + text)
+
+    print("Summary: A has " + str(result.a_frames) + " frames, B " + str(result.b_frames) + ". " + str(result.matched)
+          + " equal, " + str(result.changed) + " changed, " + str(result.only_a) + " only in A, " + str(result.only_b)
+          + " only in B.")
+    print("Differing frames per opcode: " + ", ".join(repr(op)[2:-1] + " " + str(n)
+                                                    for op, n in sorted(result.by_opcode.items())))
+    return False
+
 
 if __name__ == "__main__":
-    file1 = "plc_device_output_real.txt"#input("Enter the path to the first file: ")
-    file2 = "plc_device_output.txt"#input("Enter the path to the second file: ")
-    compare_files(file1, file2)
+    parser = argparse.ArgumentParser(description="Compare two recorded flash sessions frame by frame.")
+    parser.add_argument("file1")
+    parser.add_argument("file2")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help="frames looked ahead on each side to realign after a difference")
+    parser.add_argument("--max-hunks", type=int, default=DEFAULT_MAX_HUNKS, help="differences listed")
+    args = parser.parse_args()
+    try:
+        same = compare_files(args.file1, args.file2, args.window, args.max_hunks)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(2)
+    sys.exit(0 if same else 1)
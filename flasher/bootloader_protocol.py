@@ -1,8 +1,12 @@
 import time
 import serial
 import binascii
-from flasher.util import debug, puts, exit_prog, hex_bytes_to_int, bytes_to_little_end_uint32, little_end_uint32_to_bytes, custom_crc32
-from dataclasses import dataclass, field
+import collections
+from flasher.util import debug, debug_enabled, puts, exit_prog, hex_bytes_to_int, bytes_to_little_end_uint32, little_end_uint32_to_bytes, custom_crc32
+from dataclasses import dataclass
+from flasher.capture import TrafficCapture
+from flasher.metrics import DeviceMetrics
+from flasher.trace import TraceTrack
 
 
 @dataclass
@@ -14,61 +18,35 @@ class PicoInfo:
     max_data_len: int
 
 
+# Decodes the five little endian uint32 values of an INFO response (without the OKOK prefix).
+def parse_info(resp_ok_bytes: bytes) -> PicoInfo:
+    flash_addr = bytes_to_little_end_uint32(resp_ok_bytes)
+    flash_size = bytes_to_little_end_uint32(resp_ok_bytes[4:])
+    erase_size = bytes_to_little_end_uint32(resp_ok_bytes[8:])
+    write_size = bytes_to_little_end_uint32(resp_ok_bytes[12:])
+    max_data_len = bytes_to_little_end_uint32(resp_ok_bytes[16:])
+    return PicoInfo(flash_addr, flash_size, erase_size, write_size, max_data_len)
+
+
 @dataclass
 class Protocol_RP2040:
     MAX_SYNC_ATTEMPTS: int = 1
     has_sync: bool = False
+    # Only needed for non-blocking connections (timeout=0). With a read timeout, reads wait for the response instead.
     wait_time_before_read = 0.05  # seconds
+    # When False, ERR! responses and failed syncs are reported through the return values instead of exiting,
+    # so Program() can resync and retransmit.
+    exit_on_error: bool = True
+    sync_backoff: float = 0.05  # seconds, doubled after every failed sync attempt
+    last_response: bytes = b""
 
-    plc_output_bin: str = field(default="plc_output_real.bin")
-    plc_output_txt: str = field(default="plc_output_real.txt")
-    
-    device_output_bin: str = field(default="device_output_real.bin")
-    device_output_txt: str = field(default="device_output_real.txt")
-
-    plc_device_output_bin: str = field(default="plc_device_output_real.bin")
-    plc_device_output_txt: str = field(default="plc_device_output_real.txt")
+    # Opt-in traffic capture (see flasher/capture.py). None means frames are not recorded at all.
+    capture: TrafficCapture = None
+    # Opt-in latency metrics (see flasher/metrics.py). None means no timestamps are taken.
+    metrics: DeviceMetrics = None
+    # Opt-in trace timeline (see flasher/trace.py), every frame sent and every response wait becomes a span.
+    trace: TraceTrack = None
 
-    def __post_init__(self):
-        self.plc_bin = open(self.plc_output_bin, 'wb')  # Open the file in binary mode
-        self.plc_txt = open(self.plc_output_txt, 'w')  # Open the file in binary mode
-        self.device_bin = open(self.device_output_bin, 'wb')  # Open the file in binary mode
-        self.device_txt = open(self.device_output_txt, 'w')  # Open the file in binary mode
-        self.plc_device_bin = open(self.plc_device_output_bin, 'wb')  # Open the file in binary mode
-        self.plc_device_txt = open(self.plc_device_output_txt, 'w')  # Open the file in binary mode
-
-
-    def __del__(self):
-        if self.plc_bin:
-            self.plc_bin.close()
-        if self.plc_txt:
-            self.plc_txt.close()
-        if self.device_bin:
-            self.device_bin.close()
-        if self.device_txt:
-            self.device_txt.close()
-        if self.plc_device_bin:
-            self.plc_device_bin.close()
-        if self.plc_device_txt:
-            self.plc_device_txt.close()
-
-    def log_device_plc_output(self, message: bytes):
-        self.plc_device_bin.write(message + b"\n")
-        self.plc_device_txt.write(str(message) + "\n")
-
-    def log_plc_output(self, message: bytes):
-        pass
-        # self.log_device_plc_output(message)
-        self.plc_bin.write(message + b"\n")
-        self.plc_txt.write(str(message) + "\n")
-
-    def log_device_output(self, message: bytes):
-        pass
-        # self.log_device_plc_output(message)
-        # self.device_bin.write(message + b"\n")
-        # self.device_txt.write(str(message) + "\n")
-    
-    
     Opcodes = {
         'Sync': bytes('SYNC', 'utf-8'),
         'Read': bytes('READ', 'utf-8'),
@@ -85,54 +63,136 @@ class Protocol_RP2040:
         'ResponseErr': bytes('ERR!', 'utf-8')
     }
 
+    def __post_init__(self):
+        # (command, send time, frame length) of the frames whose response has not been read yet, oldest first
+        self._in_flight = collections.deque()
+
+    # Writes one frame and records it in the capture, metrics and trace, for the ones that are enabled.
+    def _write_frame(self, conn: serial.Serial, frame: bytes, expect_response: bool = True):
+        if self.metrics is None and self.trace is None:
+            n = conn.write(frame)
+        else:
+            t_start = time.perf_counter()
+            n = conn.write(frame)
+            command = frame[:4].decode('ascii', 'replace')
+            if expect_response:
+                self._in_flight.append((command, t_start, len(frame)))
+            if self.trace is not None:
+                self.trace.complete(command + " send", t_start, time.perf_counter(), bytes=len(frame))
+        if self.capture is not None:
+            self.capture.host(frame)
+        return n
+
+    # Reads a response of response_len bytes (after the head already read), but stops after the status when it is
+    # ERR!, which is all the device sends on an error. Waiting for the full length would last until the read timeout.
+    def _read_response(self, conn: serial.Serial, response_len: int, head: bytes = b"") -> bytes:
+        status_len = len(self.Opcodes['ResponseErr'])
+        if response_len > status_len:
+            head += conn.read(status_len - len(head))
+            if head == self.Opcodes['ResponseErr'] or len(head) < status_len:
+                return head
+        return head + conn.read(response_len - len(head))
+
+    # Reads a response in two steps, so the arrival of its first byte can be timed, and records the latencies
+    # against the oldest frame in flight (in the metrics) and the wait for it (in the trace).
+    def _timed_read(self, conn: serial.Serial, response_len: int) -> bytes:
+        t_start = time.perf_counter()
+        all_bytes = conn.read(1)
+        t_first = time.perf_counter()
+        if all_bytes and response_len > 1:
+            all_bytes = self._read_response(conn, response_len, all_bytes)
+        t_done = time.perf_counter()
+        if self._in_flight:
+            command, t_sent, tx_bytes = self._in_flight.popleft()
+        else:
+            command, t_sent, tx_bytes = None, t_start, 0
+        if self.metrics is not None and command is not None:
+            self.metrics.observe(command, t_first - t_sent if all_bytes else None,
+                                 t_done - t_sent if len(all_bytes) == response_len else None, tx_bytes, len(all_bytes))
+        if self.trace is not None:
+            self.trace.complete((command or "unknown") + " response", t_start, t_done, bytes=len(all_bytes),
+                                first_byte_ms=(t_first - t_start) * 1000)
+        return all_bytes
+
+    # Counts a retransmission of a command after an error, for the metrics.
+    def note_retry(self, command: str):
+        if self.metrics is not None:
+            self.metrics.retry(command)
+
     def read_bootloader_resp(self, conn: serial.Serial, response_len: int, exit_before_flash=True) -> (bytes, bytes):
         # Do a small sleep because we need to wait for Pico to be able to respond.
-        time.sleep(self.wait_time_before_read)
-        debug("Start blocking code reponse length is hit. Resp_len: " + str(response_len))
-        all_bytes = conn.read(response_len)
-        print(all_bytes)
+        if self.wait_time_before_read:
+            if self.trace is None:
+                time.sleep(self.wait_time_before_read)
+            else:
+                with self.trace.span("sleep"):
+                    time.sleep(self.wait_time_before_read)
+        if self.metrics is None and self.trace is None:
+            all_bytes = self._read_response(conn, response_len)
+        else:
+            all_bytes = self._timed_read(conn, response_len)
+        self.last_response = all_bytes
         err_byte = all_bytes.removeprefix(self.Opcodes["ResponseErr"][:])
         data_bytes = bytes()
         if len(err_byte) == response_len:
             data_bytes = all_bytes.removeprefix((self.Opcodes["ResponseOK"][:]))
-            debug("No error encoutered")
+        elif not self.exit_on_error:
+            debug("Error encoutered in RPi Pico, response: %s", all_bytes)
         else:
             puts("Error encoutered in RPi Pico! Please POR your Pico and try again.")
             exit_prog(exit_before_flash)
 
-        debug("Complete Buff: " + str(all_bytes))
-        debug("Data buff: " + str(data_bytes))
-        debug("Len Data buff: " + str(len(data_bytes)))
+        # Once per frame, so the debug output is skipped with a single check
+        if debug_enabled():
+            debug("Response length %s, complete buff: %s", response_len, all_bytes)
+            debug("Data buff: %s, len: %s", data_bytes, len(data_bytes))
         return all_bytes, data_bytes
 
-    def sync_cmd(self, conn: serial.Serial) -> bool:
+    # Sends SYNC until the bootloader answers, at most MAX_SYNC_ATTEMPTS times.
+    # Use flush=True when resyncing after an error, to drop stale response bytes still in the input buffer.
+    def sync_cmd(self, conn: serial.Serial, flush: bool = False) -> bool:
         for i in range(1, self.MAX_SYNC_ATTEMPTS + 1):
             # print(i)
             response = bytes()
             # debug(response)
             try:
-                debug("Serial conn port used: " + str(conn.port))
-                # conn.flushInput()
+                debug("Serial conn port used: %s", conn.port)
+                if flush:
+                    conn.reset_input_buffer()
+                    # Responses to frames sent before the error are gone
+                    self._in_flight.clear()
+                if i > 1:
+                    self.note_retry('SYNC')
                 # conn.flushOutput()
-                debug("Starting sync command by sending: " + str(self.Opcodes["Sync"][:]))
-                self.log_plc_output(self.Opcodes["Sync"])
-                conn.write(self.Opcodes["Sync"][:])
+                debug("Starting sync command by sending: %s", self.Opcodes['Sync'][:])
+                self._write_frame(conn, self.Opcodes["Sync"])
 
                 # Small sleep because else Python is too fast, and serial buffer will still be empty.
-                time.sleep(self.wait_time_before_read)
+                if self.wait_time_before_read:
+                    time.sleep(self.wait_time_before_read)
                 debug("Have send Sync command, start reading response")
+                if self.metrics is None and self.trace is None:
+                    response += conn.read(len(self.Opcodes["ResponseSync"]))
+                else:
+                    response += self._timed_read(conn, len(self.Opcodes["ResponseSync"]))
                 while conn.inWaiting() > 0:
                     data_byte = conn.read(conn.inWaiting())
                     response += data_byte
 
-                debug("Whole response has arrived: " + str(response))
-                self.log_device_output(response)
+                debug("Whole response has arrived: %s", response)
+                if self.capture is not None:
+                    self.capture.device(response)
                 #file.write_new_line(str(response))
-                if response == self.Opcodes["ResponseSync"][:]:
+                # Both sync responses, like discovery accepts: a device found by it can be flashed
+                sync_responses = (self.Opcodes["ResponseSync"], self.Opcodes["ResponseSyncWota"])
+                if response in sync_responses or (flush and response.endswith(sync_responses)):
                     puts("Found a Pico device who responded to sync.")
                     self.has_sync = True
                     return self.has_sync
-                else:
+                elif i < self.MAX_SYNC_ATTEMPTS:
+                    debug("No sync response on attempt %s, got: %s", i, response)
+                    time.sleep(self.sync_backoff * (2 ** (i - 1)))
+                elif self.exit_on_error:
                     puts("No Pico bootloader found that will respond to the sync command. Is your device connected "
                          "and in bootloader?")
                     exit_prog(True)
@@ -140,36 +200,33 @@ class Protocol_RP2040:
             except serial.SerialTimeoutException:
                 puts("Serial timeout expired.")
                 exit_prog(True)
+        self.has_sync = False
+        return self.has_sync
 
     def info_cmd(self, conn: serial.Serial) -> PicoInfo:
         expected_len = len(self.Opcodes['ResponseOK']) + (4 * 5)
         #file.write_new_line(self.Opcodes["Info"][:])
-        conn.write(self.Opcodes["Info"][:])
-        self.log_plc_output(self.Opcodes["Info"][:])
-        debug("Written following bytes to Pico: " + str(self.Opcodes["Info"][:]))
+        self._write_frame(conn, self.Opcodes["Info"])
+        debug("Written following bytes to Pico: %s", self.Opcodes['Info'][:])
         all_bytes, resp_ok_bytes = self.read_bootloader_resp(conn, expected_len, True)
-        self.log_device_output(all_bytes)
+        if self.capture is not None:
+            self.capture.device(all_bytes)
         #file.write_new_line(all_bytes)
         decoded_arr = []
         if len(resp_ok_bytes) <= 0:
             puts("Something went horribly wrong. Please POR and retry.")
             exit_prog(True)
-        else:
+        elif debug_enabled():
             decoded_arr = hex_bytes_to_int(resp_ok_bytes)
-            debug("Decoded data array: " + str(decoded_arr))
+            debug("Decoded data array: %s", decoded_arr)
 
-        flash_addr = bytes_to_little_end_uint32(resp_ok_bytes)
-        flash_size = bytes_to_little_end_uint32(resp_ok_bytes[4:])
-        erase_size = bytes_to_little_end_uint32(resp_ok_bytes[8:])
-        write_size = bytes_to_little_end_uint32(resp_ok_bytes[12:])
-        max_data_len = bytes_to_little_end_uint32(resp_ok_bytes[16:])
-        this_pico_info = PicoInfo(flash_addr, flash_size, erase_size, write_size, max_data_len)
+        this_pico_info = parse_info(resp_ok_bytes)
 
-        debug("flash_addr: " + str(flash_addr))
-        debug("flash_size: " + str(flash_size))
-        debug("erase_size: " + str(erase_size))
-        debug("write_size: " + str(write_size))
-        debug("max_data_len: " + str(max_data_len))
+        debug("flash_addr: %s", this_pico_info.flash_addr)
+        debug("flash_size: %s", this_pico_info.flash_size)
+        debug("erase_size: %s", this_pico_info.erase_size)
+        debug("write_size: %s", this_pico_info.write_size)
+        debug("max_data_len: %s", this_pico_info.max_data_len)
 
         return this_pico_info
 
@@ -185,19 +242,70 @@ class Protocol_RP2040:
             write_buff += b
         # write_readable = hex_bytes_to_int(write_buff)
         #file.write_new_line(write_buff)
-        n = conn.write(write_buff)
-        self.log_plc_output(write_buff)
-        debug("Number of bytes written: " + str(n))
-        time.sleep(self.wait_time_before_read)
+        n = self._write_frame(conn, write_buff)
+        debug("Number of bytes written: %s", n)
+        if self.wait_time_before_read:
+            time.sleep(self.wait_time_before_read)
         all_bytes, resp_ok_bytes = self.read_bootloader_resp(conn, len(self.Opcodes['ResponseOK']), True)
         #file.write_new_line(all_bytes)
-        self.log_device_output(all_bytes)
-        debug("Erased a length of bytes, response is: " + str(all_bytes))
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        debug("Erased a length of bytes, response is: %s", all_bytes)
         if all_bytes != self.Opcodes['ResponseOK']:
             return False
         return True
 
+    # Asks the device for the CRC32 of a range of its flash. Returns None when the device did not answer with OKOK.
+    def crc_cmd(self, conn: serial.Serial, addr, length):
+        expected_bit_n = 3 * 4
+        write_buff = bytes()
+        write_buff += self.Opcodes['CRC'][:]
+        write_buff += little_end_uint32_to_bytes(addr)
+        write_buff += little_end_uint32_to_bytes(length)
+        if len(write_buff) != expected_bit_n:
+            missing_bits = expected_bit_n - len(write_buff)
+            b = bytes(missing_bits)
+            write_buff += b
+        n = self._write_frame(conn, write_buff)
+        debug("Number of bytes written: %s", n)
+        if self.wait_time_before_read:
+            time.sleep(self.wait_time_before_read)
+        all_bytes, data_bytes = self.read_bootloader_resp(conn, len(self.Opcodes['ResponseOK']) + 4, True)
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        if not all_bytes.startswith(self.Opcodes['ResponseOK']) or len(data_bytes) < 4:
+            return None
+        return bytes_to_little_end_uint32(data_bytes)
+
+    # Reads length bytes (at most max_data_len) of device flash. Returns None when the device did not answer with OKOK.
+    def read_cmd(self, conn: serial.Serial, addr, length):
+        expected_bit_n = 3 * 4
+        write_buff = bytes()
+        write_buff += self.Opcodes['Read'][:]
+        write_buff += little_end_uint32_to_bytes(addr)
+        write_buff += little_end_uint32_to_bytes(length)
+        if len(write_buff) != expected_bit_n:
+            missing_bits = expected_bit_n - len(write_buff)
+            b = bytes(missing_bits)
+            write_buff += b
+        n = self._write_frame(conn, write_buff)
+        debug("Number of bytes written: %s", n)
+        if self.wait_time_before_read:
+            time.sleep(self.wait_time_before_read)
+        all_bytes, data_bytes = self.read_bootloader_resp(conn, len(self.Opcodes['ResponseOK']) + length, True)
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        if not all_bytes.startswith(self.Opcodes['ResponseOK']) or len(data_bytes) != length:
+            return None
+        return data_bytes
+
     def write_cmd(self, conn: serial.Serial, addr, length, data):
+        self.send_write(conn, addr, length, data)
+        return self.read_write_resp(conn, data)
+
+    # Sends a WRIT frame without waiting for the response, so several frames can be in flight at once.
+    # Every send_write must be followed by a read_write_resp, in the same order.
+    def send_write(self, conn: serial.Serial, addr, length, data):
         expected_bit_n_no_data = len(self.Opcodes['Write']) + 4 + 4
         # expected_bit_n = expected_bit_n_no_data + len(data)
         write_buff = bytes()
@@ -211,15 +319,21 @@ class Protocol_RP2040:
             write_buff += b
         write_buff += data
         #file.write_new_line(write_buff)
-        n = conn.write(write_buff)
-        self.log_plc_output(write_buff)
-        debug("Number of bytes written: " + str(n))
-        time.sleep(self.wait_time_before_read)
+        n = self._write_frame(conn, write_buff)
+        debug("Number of bytes written: %s", n)
+
+    # Reads the response to the oldest WRIT in flight and checks its CRC against the data that was sent.
+    def read_write_resp(self, conn: serial.Serial, data) -> bool:
+        if self.wait_time_before_read:
+            time.sleep(self.wait_time_before_read)
         all_bytes, data_bytes = self.read_bootloader_resp(conn, len(self.Opcodes['ResponseOK']) + 4, True)
         #file.write_new_line(all_bytes)
-        self.log_device_output(all_bytes)
-        debug("All bytes return from read: " + str(all_bytes))
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        debug("All bytes return from read: %s", all_bytes)
         # all_bytes_readable = hex_bytes_to_int(all_bytes)
+        if len(data_bytes) < 4:
+            return False
         resp_crc = bytes_to_little_end_uint32(data_bytes)
         calc_crc = binascii.crc32(data)
 
@@ -227,38 +341,34 @@ class Protocol_RP2040:
             return False
         return True
 
-    def seal_cmd(self, conn: serial.Serial, addr, data):
+    # crc is the CRC32 of data, when the caller already computed it.
+    def seal_cmd(self, conn: serial.Serial, addr, data, crc: int = None):
         expected_bits_before_crc = len(self.Opcodes['Seal']) + 4 + 4
         data_length = len(data)
-        crc = binascii.crc32(data)
+        if crc is None:
+            crc = binascii.crc32(data)
         #crc = custom_crc32(data)
         write_buff = bytes()
         write_buff += self.Opcodes['Seal'][:]
-        print(write_buff)
         write_buff += little_end_uint32_to_bytes(addr)
-        print(write_buff)
-        print(data_length)
-        print(little_end_uint32_to_bytes(data_length))
         write_buff += little_end_uint32_to_bytes(data_length)
-        print(write_buff)
         len_before_data = len(write_buff)
         if len_before_data != expected_bits_before_crc:
             missing_bits = expected_bits_before_crc - len_before_data
             b = bytes(missing_bits)
             write_buff += b
-        print(write_buff)
         write_buff += little_end_uint32_to_bytes(crc)
-        wr_buff_read = hex_bytes_to_int(write_buff)
         #file.write_new_line(write_buff)
-        print(write_buff)
-        n = conn.write(write_buff)
-        self.log_plc_output(write_buff)
-        debug("Number of bytes written: " + str(n))
-        time.sleep(self.wait_time_before_read)
+        debug("Seal frame: %s", write_buff)
+        n = self._write_frame(conn, write_buff)
+        debug("Number of bytes written: %s", n)
+        if self.wait_time_before_read:
+            time.sleep(self.wait_time_before_read)
         all_bytes, data_bytes = self.read_bootloader_resp(conn, len(self.Opcodes['ResponseOK']), False)
         #file.write_new_line(all_bytes)
-        self.log_device_output(all_bytes)
-        debug("All bytes seal: " + str(all_bytes))
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        debug("All bytes seal: %s", all_bytes)
         if all_bytes[:4] != self.Opcodes['ResponseOK']:
             return False
         return True
@@ -272,10 +382,12 @@ class Protocol_RP2040:
             missing_bits = expected_bit_n - len(write_buff)
             b = bytes(missing_bits)
             write_buff += b
-        write_readable = hex_bytes_to_int(write_buff)
-        n = conn.write(write_buff)
-        self.log_plc_output(write_buff)
+        # write_readable = hex_bytes_to_int(write_buff)
+        n = self._write_frame(conn, write_buff, expect_response=False)
         #file.write_new_line(write_buff)
+        if self.metrics is not None:
+            # No response to wait for, only the frame itself is counted
+            self.metrics.observe('GOGO', None, None, len(write_buff), 0)
 
         # Hopaatskeeeeee
 
@@ -0,0 +1,165 @@
+import os
+import time
+import struct
+import threading
+import collections
+from flasher.util import puts
+
+# Capture file layout: the magic, then one record per frame. A record header holds the time since the start of the
+# capture in seconds (float64), the direction and the payload length (uint32), followed by the payload itself.
+CAPTURE_MAGIC: bytes = b"PPSFCAP1"
+RECORD_HEADER = struct.Struct('<dBI')
+HOST_TO_DEVICE: int = 0
+DEVICE_TO_HOST: int = 1
+
+DEFAULT_CAPACITY: int = 65536  # frames buffered before the oldest unwritten ones are dropped
+FLUSH_INTERVAL: float = 0.05  # seconds between writer wake ups
+
+
+# Records the frames of a flash session to a capture file. record() only appends to an in-memory ring buffer;
+# a background thread does the file I/O, so capturing doesn't slow down the WRIT loop.
+class TrafficCapture:
+    def __init__(self, path: str, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.dropped = 0
+        self._ring = collections.deque(maxlen=capacity)
+        self._t0 = time.perf_counter()
+        self._stop = threading.Event()
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._writer = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+        self._writer.start()
+
+    def record(self, direction: int, data: bytes):
+        if len(self._ring) == self._ring.maxlen:
+            self.dropped += 1
+        self._ring.append((time.perf_counter() - self._t0, direction, data))
+
+    def host(self, data: bytes):
+        self.record(HOST_TO_DEVICE, data)
+
+    def device(self, data: bytes):
+        self.record(DEVICE_TO_HOST, data)
+
+    def _drain(self):
+        ring = self._ring
+        out = self._file
+        while ring:
+            t, direction, data = ring.popleft()
+            out.write(RECORD_HEADER.pack(t, direction, len(data)))
+            out.write(data)
+
+    def _run(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            self._drain()
+        self._drain()
+
+    # Writes out everything still buffered and closes the file.
+    def close(self):
+        if self._file.closed:
+            return
+        self._stop.set()
+        self._writer.join()
+        self._file.close()
+        if self.dropped:
+            puts("Capture " + self.path + " dropped " + str(self.dropped) + " frames, the writer could not keep up.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Capture file name for one port of a fleet run: the port name is appended before the extension.
+def capture_path_for(path: str, port: str) -> str:
+    base, ext = os.path.splitext(path)
+    safe_port = "".join(c if c.isalnum() else "_" for c in port).strip("_")
+    return base + "-" + safe_port + (ext or ".cap")
+
+
+# Yields (time, direction, data) for every frame in a capture file, without loading the whole file.
+def read_capture(path: str):
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(path + " is not a traffic capture file")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            t, direction, length = RECORD_HEADER.unpack(header)
+            yield t, direction, f.read(length)
+
+
+# Every frame starts with one of these: the opcode of a host command, or the status word of a device response.
+COMMAND_TAGS: tuple = (b'SYNC', b'INFO', b'READ', b'CSUM', b'CRCC', b'ERAS', b'WRIT', b'SEAL', b'GOGO')
+RESPONSE_TAGS: tuple = (b'PICO', b'WOTA', b'OKOK', b'ERR!')
+FRAME_TAGS: frozenset = frozenset(COMMAND_TAGS + RESPONSE_TAGS)
+COMMAND_ARGS: dict = {b'SYNC': 0, b'INFO': 0, b'READ': 2, b'CSUM': 2, b'CRCC': 2, b'ERAS': 2, b'WRIT': 2, b'SEAL': 3,
+                      b'GOGO': 1}
+LEGACY_CHUNK_SIZE: int = 1 << 16
+
+
+# Length of the host frame that starts with head (opcode, arguments and the WRIT payload), or None while head is too
+# short to tell or doesn't start with a known opcode.
+def command_length(head: bytes):
+    nargs = COMMAND_ARGS.get(bytes(head[:4]))
+    if nargs is None or len(head) < 4 + 4 * nargs:
+        return None
+    if head[:4] == b'WRIT':
+        return 12 + int.from_bytes(head[8:12], 'little')
+    return 4 + 4 * nargs
+
+
+# Yields (None, direction, data) for every frame of a legacy log such as plc_device_output_real.bin: frames of either
+# direction written one after the other, each followed by a newline, without timestamps. Payloads contain newlines as
+# well, so a frame only ends at a newline that is followed by the start of another frame or the end of the file.
+def read_legacy_capture(path: str):
+    with open(path, 'rb') as f:
+        buf = bytearray()  # starts with the current frame
+        pos = 0  # where to look for the next newline
+        eof = False
+        while True:
+            end = buf.find(b'\n', pos)
+            # The four bytes after a newline tell whether it ends the frame, so they have to be read first
+            if end < 0 or (end + 5 > len(buf) and not eof):
+                if eof:
+                    if buf:
+                        yield _legacy_frame(bytes(buf))
+                    return
+                chunk = f.read(LEGACY_CHUNK_SIZE)
+                eof = not chunk
+                buf += chunk
+                continue
+            if end + 1 == len(buf) or bytes(buf[end + 1:end + 5]) in FRAME_TAGS:
+                yield _legacy_frame(bytes(buf[:end]))
+                del buf[:end + 1]
+                pos = 0
+            else:
+                pos = end + 1
+
+
+def _legacy_frame(data: bytes):
+    return None, DEVICE_TO_HOST if data[:4] in RESPONSE_TAGS else HOST_TO_DEVICE, data
+
+
+# Yields (None, direction, data) for every frame of a legacy text log such as plc_device_output_real.txt: one frame per
+# line, written as a Python bytes literal.
+def read_text_capture(path: str):
+    import ast  # only needed here, and not cheap to import on every flash
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield _legacy_frame(ast.literal_eval(line))
+
+
+# read_capture(), read_legacy_capture() or read_text_capture(), whichever fits the file.
+def read_any_capture(path: str):
+    with open(path, 'rb') as f:
+        magic = f.read(len(CAPTURE_MAGIC))
+    if magic == CAPTURE_MAGIC:
+        return read_capture(path)
+    if magic[:2] in (b"b'", b'b"'):
+        return read_text_capture(path)
+    return read_legacy_capture(path)
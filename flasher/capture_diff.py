@@ -0,0 +1,195 @@
+import hashlib
+import binascii
+import collections
+from dataclasses import dataclass, field
+from flasher.capture import read_any_capture, COMMAND_ARGS, HOST_TO_DEVICE
+
+# Streaming comparison of two recorded sessions, frame by frame instead of line by line. Frames are decoded (opcode,
+# address, length, CRC), equal frames are skipped in lockstep and after a difference the two sides are realigned
+# within a window of frames, so one inserted frame (a retry, an extra SYNC) shows up as one insertion instead of a
+# cascade of differences. Only the frames of the window are held in memory, whatever the size of the sessions.
+
+DEFAULT_WINDOW: int = 256  # frames looked ahead on each side to realign after a difference
+DEFAULT_MAX_HUNKS: int = 10  # differences kept in the result, all of them are counted
+
+
+@dataclass
+class Frame:
+    index: int  # in its file
+    direction: int
+    data: bytes
+    tag: bytes  # opcode or status
+    addr: int = None
+    length: int = None
+    crc: int = None  # of the WRIT payload or READ data, or the one a command carries or a response returns
+    answers: bytes = b''  # for responses, the opcode of the command answered
+    digest: bytes = b''  # of the frame, for responses together with the command answered
+
+    def describe(self) -> str:
+        text = repr(self.tag)[2:-1]
+        if self.answers:
+            text += " (" + repr(self.answers)[2:-1] + ")"
+        if self.addr is not None:
+            text += " " + hex(self.addr)
+        if self.length is not None:
+            text += " len " + str(self.length)
+        if self.crc is not None:
+            text += " crc " + hex(self.crc)
+        return text
+
+
+@dataclass
+class Hunk:
+    kind: str  # 'changed', 'only in A' or 'only in B'
+    a_index: int  # first frame concerned in A, or where the frames of B would be
+    b_index: int
+    a_frames: list = field(default_factory=list)
+    b_frames: list = field(default_factory=list)
+
+    # First byte that differs between two changed frames
+    def offset(self) -> int:
+        a, b = self.a_frames[0].data, self.b_frames[0].data
+        return next((i for i, (x, y) in enumerate(zip(a, b)) if x != y), min(len(a), len(b)))
+
+
+@dataclass
+class DiffResult:
+    a_frames: int = 0
+    b_frames: int = 0
+    matched: int = 0
+    changed: int = 0
+    only_a: int = 0
+    only_b: int = 0
+    hunks: list = field(default_factory=list)
+    by_opcode: collections.Counter = field(default_factory=collections.Counter)  # differing frames per opcode
+
+    def identical(self) -> bool:
+        return not (self.changed or self.only_a or self.only_b)
+
+
+def _args(data: bytes, n: int) -> list:
+    return [int.from_bytes(data[4 + 4 * i:8 + 4 * i], 'little') for i in range(n)]
+
+
+# Decodes the frames of a capture file as they are read. Responses are matched with the oldest command still waiting
+# for one, like the device answers them.
+def decode_frames(path: str):
+    waiting = collections.deque()
+    for index, (t, direction, data) in enumerate(read_any_capture(path)):
+        frame = Frame(index, direction, data, bytes(data[:4]))
+        if direction == HOST_TO_DEVICE:
+            args = _args(data, COMMAND_ARGS.get(frame.tag, 0))
+            if args:
+                frame.addr = args[0]
+            if len(args) >= 2:
+                frame.length = args[1]
+            if frame.tag == b'WRIT':
+                frame.crc = binascii.crc32(data[12:])
+            elif frame.tag == b'SEAL' and len(args) == 3:
+                frame.crc = args[2]
+            frame.digest = hashlib.blake2b(data, digest_size=8).digest()
+            waiting.append(frame)
+        else:
+            while waiting and waiting[0].tag == b'SYNC' and frame.tag not in (b'PICO', b'WOTA'):
+                waiting.popleft()
+            command = waiting.popleft() if waiting else None
+            context = b''
+            if command is not None:
+                frame.answers = command.tag
+                context = command.digest
+                if frame.tag == b'OKOK':
+                    if command.tag in (b'WRIT', b'CRCC', b'CSUM'):
+                        frame.crc = _args(data, 1)[0]
+                    elif command.tag == b'READ':
+                        frame.crc = binascii.crc32(data[4:])
+                    elif command.tag == b'INFO':
+                        frame.addr, frame.length = _args(data, 2)
+            frame.digest = hashlib.blake2b(context + data, digest_size=8).digest()
+        yield frame
+
+
+# Look ahead buffer over a frame iterator, holding at most window frames.
+class _Window:
+    def __init__(self, frames, size: int):
+        self._frames = frames
+        self._size = size
+        self._buf = collections.deque()
+        self.read = 0
+        self._fill()
+
+    def _fill(self):
+        while len(self._buf) < self._size:
+            frame = next(self._frames, None)
+            if frame is None:
+                return
+            self._buf.append(frame)
+            self.read += 1
+
+    def peek(self, i: int = 0):
+        return self._buf[i] if i < len(self._buf) else None
+
+    def pop(self, n: int = 1) -> list:
+        taken = [self._buf.popleft() for _ in range(min(n, len(self._buf)))]
+        self._fill()
+        return taken
+
+    def __len__(self):
+        return len(self._buf)
+
+
+# Offsets (i, j) of the nearest frames A[i] == B[j] in the windows, smallest i + j first, or None.
+def _realign(a: _Window, b: _Window):
+    positions = dict()
+    for j in range(len(b)):
+        positions.setdefault(b.peek(j).digest, j)
+    best = None
+    for i in range(len(a)):
+        if best is not None and i >= best[0] + best[1]:
+            break
+        j = positions.get(a.peek(i).digest)
+        if j is not None and (best is None or i + j < best[0] + best[1]):
+            best = (i, j)
+    return best
+
+
+def diff_captures(path_a: str, path_b: str, window: int = DEFAULT_WINDOW,
+                  max_hunks: int = DEFAULT_MAX_HUNKS) -> DiffResult:
+    result = DiffResult()
+    a = _Window(decode_frames(path_a), window)
+    b = _Window(decode_frames(path_b), window)
+
+    def add(hunk: Hunk):
+        for frame in hunk.a_frames or hunk.b_frames:
+            result.by_opcode[frame.answers or frame.tag] += 1
+        if len(result.hunks) < max_hunks:
+            result.hunks.append(hunk)
+
+    while len(a) or len(b):
+        fa, fb = a.peek(), b.peek()
+        if fa is not None and fb is not None:
+            if fa.digest == fb.digest:
+                result.matched += 1
+                a.pop()
+                b.pop()
+                continue
+            if (fa.tag, fa.addr, fa.length, fa.answers) == (fb.tag, fb.addr, fb.length, fb.answers):
+                result.changed += 1
+                add(Hunk('changed', fa.index, fb.index, a.pop(), b.pop()))
+                continue
+            found = _realign(a, b)
+            if found is None:
+                result.changed += 1
+                add(Hunk('changed', fa.index, fb.index, a.pop(), b.pop()))
+                continue
+            i, j = found
+        else:
+            i, j = len(a), len(b)
+        if i:
+            result.only_a += i
+            add(Hunk('only in A', fa.index, fb.index if fb is not None else b.read, a.pop(i)))
+        if j:
+            result.only_b += j
+            add(Hunk('only in B', fa.index if fa is not None else a.read, fb.index, [], b.pop(j)))
+    result.a_frames = a.read
+    result.b_frames = b.read
+    return result
@@ -0,0 +1,131 @@
+import struct
+import binascii
+from dataclasses import dataclass, field
+from flasher.journal import image_hash
+from flasher.registry import sector_crcs
+
+# Release to release delta bundles. A bundle is built once from the ELF files of two releases and holds everything a
+# station needs to bring a device from the old release to the new one: the sectors that changed (and only those), the
+# CRC of every sector of the new release, and the length and CRC the new image is sealed with. Applying it (see
+# ProgramDelta in flasher/program.py) needs neither ELF file, and only the changed sectors go over the wire.
+#
+# Both images are padded the way Program pads them (with zeros to the write size of the device), so a device that was
+# flashed with the old release holds exactly the old image of the bundle, and ends up holding exactly what flashing the
+# new release would have left. Sector CRCs follow flasher/registry.py: one per erase_size sector of the padded data,
+# the last one possibly shorter.
+#
+# File layout, all integers little endian:
+#   DELTA_MAGIC
+#   header             see _HEADER, the image hashes as 32 byte digests
+#   new sector CRCs    u32 each
+#   changed sectors    u32 sector index followed by the sector data, as long as the sector is in the new image
+
+DELTA_MAGIC: bytes = b"PPSFDLT2"
+# Bundles of the first format also held the CRCs of the old sectors, which applying a bundle never needs: the sectors
+# the bundle leaves as they are are checked against the new CRCs, and the changed ones are rewritten completely.
+_OLD_MAGICS: tuple = (b"PPSFDLT1",)
+DEFAULT_ERASE_SIZE: int = 1 << 12  # of the RP2040 QSPI flash, what PicoInfo reports
+DEFAULT_WRITE_SIZE: int = 1 << 8
+
+# addr, erase size, write size, old length, new length, seal CRC, number of changed sectors, old and new image hash
+_HEADER = struct.Struct('<7I32s32s')
+_U32 = struct.Struct('<I')
+
+
+@dataclass
+class DeltaBundle:
+    addr: int
+    erase_size: int
+    write_size: int
+    old_length: int  # of the padded image data
+    new_length: int
+    seal_crc: int  # CRC32 of the padded new image data
+    old_image: str = ""  # image hashes, as flasher/journal.py computes them
+    new_image: str = ""
+    new_sectors: list = field(default_factory=list)  # CRC of every sector
+    changed: dict = field(default_factory=dict)  # sector index -> data of the sector in the new image
+
+    # Offset and length into the new image data of sector i.
+    def sector_range(self, i: int):
+        start = i * self.erase_size
+        return start, min(self.erase_size, self.new_length - start)
+
+    # Sectors of the new image that the old one already holds.
+    def unchanged(self) -> list:
+        return [i for i in range(len(self.new_sectors)) if i not in self.changed]
+
+    def changed_bytes(self) -> int:
+        return sum(len(data) for data in self.changed.values())
+
+    # The new image data with only the changed sectors filled in, the rest is zeros. Enough to erase, write and seal
+    # the changed sectors with, the others are never read from it.
+    def image_data(self) -> bytearray:
+        data = bytearray(self.new_length)
+        for i, sector in self.changed.items():
+            start = i * self.erase_size
+            data[start:start + len(sector)] = sector
+        return data
+
+
+def pad_image(data: bytes, write_size: int) -> bytes:
+    return bytes(data) + bytes(-len(data) % write_size)
+
+
+# Builds the bundle that upgrades a device from the old Image to the new one. Both have to load at the same address.
+def build_delta(old, new, erase_size: int = DEFAULT_ERASE_SIZE, write_size: int = DEFAULT_WRITE_SIZE) -> DeltaBundle:
+    if old.Addr != new.Addr:
+        raise ValueError("Images load at different addresses: " + hex(old.Addr) + " and " + hex(new.Addr))
+    if erase_size % write_size:
+        raise ValueError("Erase size " + str(erase_size) + " is not a multiple of the write size " + str(write_size))
+    old_data = pad_image(old.Data, write_size)
+    new_data = pad_image(new.Data, write_size)
+    bundle = DeltaBundle(new.Addr, erase_size, write_size, len(old_data), len(new_data), binascii.crc32(new_data),
+                         image_hash(old.Addr, old_data), image_hash(new.Addr, new_data),
+                         sector_crcs(new_data, erase_size))
+    for start in range(0, len(new_data), erase_size):
+        sector = new_data[start:start + erase_size]
+        if sector != old_data[start:start + erase_size]:
+            bundle.changed[start // erase_size] = sector
+    return bundle
+
+
+def write_delta(path: str, bundle: DeltaBundle):
+    with open(path, 'wb') as f:
+        f.write(DELTA_MAGIC)
+        f.write(_HEADER.pack(bundle.addr, bundle.erase_size, bundle.write_size, bundle.old_length, bundle.new_length,
+                             bundle.seal_crc, len(bundle.changed), bytes.fromhex(bundle.old_image),
+                             bytes.fromhex(bundle.new_image)))
+        f.write(struct.pack('<%dI' % len(bundle.new_sectors), *bundle.new_sectors))
+        for i in sorted(bundle.changed):
+            f.write(_U32.pack(i))
+            f.write(bundle.changed[i])
+
+
+def _read_exactly(f, n: int) -> bytes:
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError("Delta bundle " + f.name + " is truncated")
+    return data
+
+
+def read_delta(path: str) -> DeltaBundle:
+    with open(path, 'rb') as f:
+        magic = f.read(len(DELTA_MAGIC))
+        if magic in _OLD_MAGICS:
+            raise ValueError(path + " was made by an older make_delta.py, build it again")
+        if magic != DELTA_MAGIC:
+            raise ValueError(path + " is not a delta bundle")
+        addr, erase_size, write_size, old_length, new_length, seal_crc, changed, old_image, new_image = \
+            _HEADER.unpack(_read_exactly(f, _HEADER.size))
+        bundle = DeltaBundle(addr, erase_size, write_size, old_length, new_length, seal_crc, old_image.hex(),
+                             new_image.hex())
+        new_count = -(-new_length // erase_size)
+        bundle.new_sectors = list(struct.unpack('<%dI' % new_count, _read_exactly(f, 4 * new_count)))
+        for _ in range(changed):
+            i = _U32.unpack(_read_exactly(f, 4))[0]
+            if i >= new_count:
+                raise ValueError("Delta bundle " + path + " holds a sector past the end of the image")
+            bundle.changed[i] = _read_exactly(f, bundle.sector_range(i)[1])
+            if binascii.crc32(bundle.changed[i]) != bundle.new_sectors[i]:
+                raise ValueError("Delta bundle " + path + " is corrupt, sector " + str(i) + " fails its CRC")
+    return bundle
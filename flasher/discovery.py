@@ -0,0 +1,92 @@
+import glob
+import fnmatch
+import serial
+import serial.tools.list_ports
+from serial.tools.list_ports_common import ListPortInfo
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from flasher.util import debug
+from flasher.bootloader_protocol import PicoInfo, Protocol_RP2040, parse_info
+
+DEFAULT_PROBE_DEADLINE: float = 0.25  # seconds, per read on a probed port
+MAX_PROBE_WORKERS: int = 64
+
+
+@dataclass
+class DiscoveredDevice:
+    port: str
+    response: bytes  # b'PICO' or b'WOTA'
+    info: PicoInfo
+    serial_number: str = ""
+    hwid: str = ""
+
+
+# Returns the device paths of all serial ports on this machine, optionally filtered with a glob pattern
+# such as '/dev/ttyUSB*'. A pattern also matches device files that the OS doesn't list as serial ports, such as the
+# pseudo terminals of the simulated device farm (flasher_simulated/device_farm.py) or udev symlinks.
+def candidate_ports(pattern: str = None) -> list:
+    ports = list()
+    for p in serial.tools.list_ports.comports():
+        if pattern is None or fnmatch.fnmatch(p.device, pattern):
+            ports.append(p)
+    if pattern is not None:
+        known = {p.device for p in ports}
+        for path in sorted(glob.glob(pattern)):
+            if path not in known:
+                ports.append(ListPortInfo(path, skip_link_detection=True))
+    return ports
+
+
+# Opens a single port, sends SYNC and, when a bootloader answers, INFO. Never exits the program:
+# ports that can't be opened or stay silent within the deadline return None.
+def probe_port(port: str, deadline: float = DEFAULT_PROBE_DEADLINE, baudrate: int = 115200):
+    opcodes = Protocol_RP2040.Opcodes
+    try:
+        conn = serial.Serial(port=port, baudrate=baudrate, timeout=deadline, write_timeout=deadline)
+    except (ValueError, serial.SerialException) as e:
+        debug("Probe could not open %s: %s", port, e)
+        return None
+
+    try:
+        conn.reset_input_buffer()
+        conn.write(opcodes['Sync'])
+        response = conn.read(len(opcodes['ResponseSync']))
+        if response not in (opcodes['ResponseSync'], opcodes['ResponseSyncWota']):
+            debug("Probe of %s got no sync response: %s", port, response)
+            return None
+
+        conn.write(opcodes['Info'])
+        expected_len = len(opcodes['ResponseOK']) + (4 * 5)
+        info_bytes = conn.read(expected_len)
+        if len(info_bytes) != expected_len or not info_bytes.startswith(opcodes['ResponseOK']):
+            debug("Probe of %s got a bad INFO response: %s", port, info_bytes)
+            return None
+        return DiscoveredDevice(port, response, parse_info(info_bytes[len(opcodes['ResponseOK']):]))
+    except serial.SerialException as e:
+        debug("Probe of %s failed: %s", port, e)
+        return None
+    finally:
+        conn.close()
+
+
+# Probes all candidate ports concurrently, so the total time is roughly one deadline instead of one per port.
+# Returns the responding bootloaders sorted by port name.
+def discover_devices(pattern: str = None, deadline: float = DEFAULT_PROBE_DEADLINE, baudrate: int = 115200) -> list:
+    ports = candidate_ports(pattern)
+    debug("Probing serial ports: %s", [p.device for p in ports])
+    if len(ports) == 0:
+        return []
+
+    workers = min(len(ports), MAX_PROBE_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda p: probe_port(p.device, deadline, baudrate), ports))
+
+    found = list()
+    for port_info, dev in zip(ports, results):
+        if dev is None:
+            continue
+        dev.serial_number = port_info.serial_number or ""
+        dev.hwid = port_info.hwid or ""
+        found.append(dev)
+    found.sort(key=lambda d: d.port)
+    return found
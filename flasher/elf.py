@@ -37,12 +37,12 @@ def load_elf(file_name: str):
             # For each program header entry, check program adress and memsize. Check if fits in flash.
             for head_count in range(f.header['e_phnum']):
                 prog_head = f.get_segment(head_count).header
-                debug("Prog_HEAD: " + str(prog_head))
+                debug("Prog_HEAD: %s", prog_head)
                 p_paddr = prog_head['p_paddr']
                 p_memsz = prog_head['p_memsz']
                 if not _is_in_flash(p_paddr, p_memsz):
-                    debug("IDX: " + str(head_count) + " is not in flash.")
-                    debug("This is addr: " + str(p_paddr) + " and memsz: " + str(p_memsz))
+                    debug("IDX: %s is not in flash.", head_count)
+                    debug("This is addr: %s and memsz: %s", p_paddr, p_memsz)
                     continue
                 # For each segment header entry, get size and address.
                 for sec_count in range(f.header['e_shnum']):
@@ -80,17 +80,17 @@ def load_elf(file_name: str):
     len_of_last_elements_data = len(chunks[len(chunks) - 1].Data)
     max_p_addr = p_addr_of_last_elem + len_of_last_elements_data
 
-    debug("min_p_addr: " + str(min_p_addr))
-    debug("p_addr_of_last_elem: " + str(p_addr_of_last_elem))
-    debug("len_of_last_elements_data: " + str(len_of_last_elements_data))
-    debug("max_p_addr: " + str(max_p_addr))
+    debug("min_p_addr: %s", min_p_addr)
+    debug("p_addr_of_last_elem: %s", p_addr_of_last_elem)
+    debug("len_of_last_elements_data: %s", len_of_last_elements_data)
+    debug("max_p_addr: %s", max_p_addr)
 
-    img_data = [bytes()] * (max_p_addr - min_p_addr)
-    # debug(img_data)
+    # One byte per byte of the image, gaps between the sections stay zero
+    img_data = bytearray(max_p_addr - min_p_addr)
 
     for c in chunks:
-        img_data[c.PAddr-min_p_addr:] = c.Data
-    # debug(img_data)
+        offset = c.PAddr - min_p_addr
+        img_data[offset:offset + len(c.Data)] = c.Data
 
     img_addr = min_p_addr
     img_byte = bytes(img_data)
@@ -100,5 +100,5 @@ def load_elf(file_name: str):
 
 
 if __name__ == '__main__':
-    debug("Const flash base: " + str(FLASH_BASE))
-    debug("Const flash size: " + str(FLASH_SIZE))
+    debug("Const flash base: %s", FLASH_BASE)
+    debug("Const flash size: %s", FLASH_SIZE)
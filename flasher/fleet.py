@@ -0,0 +1,86 @@
+import serial
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from flasher.util import puts
+from flasher.program import Image, Program, ProgramDelta, ProgramManifest, RetryPolicy, PipelineSettings
+from flasher.delta import DeltaBundle
+from flasher.manifest import Manifest
+from flasher.pipeline_tuning import load_pipeline
+from flasher.capture import TrafficCapture, capture_path_for
+from flasher.metrics import FlashMetrics
+from flasher.trace import TraceRecorder
+from flasher.link import LinkProfile, open_link, load_profile, adapter_id
+from flasher.registry import DeviceRegistry
+
+
+@dataclass
+class FleetResult:
+    port: str
+    ok: bool
+    message: str = ""
+
+
+# Opens one serial port and runs a complete flash session on it.
+# Without an explicit profile or pipeline settings, the ones saved by --tune and --tune-pipeline for the port's
+# adapter (or the defaults) are used.
+# image may also be a DeltaBundle, which is applied with ProgramDelta, or a Manifest, flashed with ProgramManifest.
+# capture_path, when given, is where the traffic of this port is recorded. The device is identified by its USB adapter
+# (see adapter_id), in the journal, the metrics and the registry.
+def flash_port(port: str, image: Image, profile: LinkProfile = None, retry: RetryPolicy = None, use_journal: bool = True,
+               pipeline: PipelineSettings = None, capture_path: str = None, metrics: FlashMetrics = None,
+               trace: TraceRecorder = None, progress=None, registry: DeviceRegistry = None):
+    if profile is None:
+        profile = load_profile(port) or LinkProfile()
+    if pipeline is None:
+        pipeline = load_pipeline(port) or PipelineSettings()
+    conn = open_link(port, profile)
+    capture = TrafficCapture(capture_path) if capture_path else None
+    try:
+        if isinstance(image, Manifest):
+            ProgramManifest(conn, image, progress, retry, device_id=adapter_id(port), pipeline=pipeline,
+                            capture=capture, metrics=metrics, trace=trace.track(port) if trace is not None else None,
+                            registry=registry)
+        elif isinstance(image, DeltaBundle):
+            ProgramDelta(conn, image, progress, retry, device_id=adapter_id(port), pipeline=pipeline, capture=capture,
+                         metrics=metrics, trace=trace.track(port) if trace is not None else None, registry=registry)
+        else:
+            Program(conn, image, progress, retry, use_journal, device_id=adapter_id(port), pipeline=pipeline,
+                    capture=capture, metrics=metrics, trace=trace.track(port) if trace is not None else None,
+                    registry=registry)
+    finally:
+        conn.close()
+        if capture is not None:
+            capture.close()
+
+
+# Flashes the same image (or applies the same delta bundle) to every given port in parallel, one thread per port.
+# A failing device (Program calls exit_prog, which raises SystemExit) does not stop the others.
+# With a capture_path, every port gets its own capture file, named after the port. All ports record into the same
+# metrics, labelled per device and port, and into the same trace, with a track per port. progress is called with the
+# ProgressReports of all ports, from their threads (FleetRenderer draws them as one line per port).
+def flash_fleet(ports: list, image: Image, profile: LinkProfile = None, retry: RetryPolicy = None,
+                use_journal: bool = True, pipeline: PipelineSettings = None, capture_path: str = None,
+                metrics: FlashMetrics = None, trace: TraceRecorder = None, progress=None,
+                registry: DeviceRegistry = None) -> list:
+    if len(ports) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+        futures = [(port, pool.submit(flash_port, port, image, profile, retry, use_journal, pipeline,
+                                          capture_path_for(capture_path, port) if capture_path else None, metrics, trace,
+                                      progress, registry))
+                   for port in ports]
+
+    results = list()
+    for port, future in futures:
+        try:
+            future.result()
+            results.append(FleetResult(port, True))
+        except SystemExit:
+            results.append(FleetResult(port, False, "flash aborted"))
+        except (OSError, ValueError, serial.SerialException) as e:
+            results.append(FleetResult(port, False, str(e)))
+
+    for r in results:
+        puts(r.port + ": " + ("OK" if r.ok else "FAILED (" + r.message + ")"))
+    return results
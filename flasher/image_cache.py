@@ -0,0 +1,47 @@
+import os
+import struct
+import hashlib
+from flasher.util import debug, CACHE_DIR
+from flasher.program import Image
+
+# The images assembled from ELF files, kept per ELF file, so that flashing the same build again doesn't need
+# pyelftools at all: importing it takes longer than reading the cached image back. An entry is valid as long as the
+# ELF file keeps its modification time and size.
+
+IMAGE_CACHE_DIR: str = os.path.join(CACHE_DIR, "images")
+
+_HEADER = struct.Struct('<QQI')  # modification time (ns) and size of the ELF file, load address of the image
+
+
+def _cache_path(elf_path: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, hashlib.sha256(os.path.abspath(elf_path).encode()).hexdigest()[:24] + ".img")
+
+
+# load_elf(), through the cache.
+def load_elf_cached(elf_path: str, cache_dir: str = IMAGE_CACHE_DIR) -> Image:
+    st = os.stat(elf_path)
+    path = _cache_path(elf_path, cache_dir)
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) == _HEADER.size:
+                mtime, size, addr = _HEADER.unpack(header)
+                if (mtime, size) == (st.st_mtime_ns, st.st_size):
+                    debug("Image of %s read from the cache.", elf_path)
+                    return Image(addr, f.read())
+    except OSError:
+        pass
+
+    from flasher.elf import load_elf
+    image = load_elf(elf_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(st.st_mtime_ns, st.st_size, image.Addr))
+            f.write(image.Data)
+        # Atomic, a cache entry is either complete or not there
+        os.replace(tmp_path, path)
+    except OSError as e:
+        debug("Could not cache the image of %s: %s", elf_path, e)
+    return image
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+from dataclasses import dataclass, asdict
+from flasher.util import debug, CACHE_DIR
+
+JOURNAL_DIR: str = os.path.join(CACHE_DIR, "journal")
+
+
+# Image data followed by its padding to the write size, without copying the image into one padded buffer: only slices
+# that reach into the padding are joined. Slices are bytes, like slices of the padded bytes would be.
+class PaddedData:
+    def __init__(self, data: bytes, pad: bytes):
+        self.data = data
+        self.pad = pad
+        self._length = len(data) + len(pad)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, index: slice) -> bytes:
+        start, stop, _ = index.indices(self._length)
+        stop = max(start, stop)
+        split = len(self.data)
+        if stop <= split:
+            return self.data[start:stop]
+        if start >= split:
+            return self.pad[start - split:stop - split]
+        return self.data[start:] + self.pad[:stop - split]
+
+    def parts(self) -> tuple:
+        return self.data, self.pad
+
+
+# Hash identifying an image: its load address and the (padded) data that is written to the device.
+def image_hash(addr: int, data: bytes) -> str:
+    h = hashlib.sha256()
+    h.update(addr.to_bytes(4, 'little'))
+    for part in data.parts() if isinstance(data, PaddedData) else (data,):
+        h.update(part)
+    return h.hexdigest()
+
+
+# Progress of one flash session of one image to one device. Erase and write run front to back through the image,
+# so two high water marks (offsets into the image data, sector aligned or the end of the image) describe which
+# sectors are done: everything below `erased` has been erased, everything below `written` has been written.
+@dataclass
+class FlashJournal:
+    device: str
+    image: str
+    addr: int
+    length: int
+    erase_size: int
+    erased: int = 0
+    written: int = 0
+    path: str = ""
+
+    def _save(self):
+        record = asdict(self)
+        del record["path"]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        # Atomic, so a kill during the save never leaves a half written journal behind.
+        os.replace(tmp_path, self.path)
+
+    def mark_erased(self, offset: int):
+        if offset > self.erased:
+            self.erased = offset
+            self._save()
+
+    def mark_written(self, offset: int):
+        if offset > self.written:
+            self.written = offset
+            self._save()
+
+    # Called when the written data turned out to be bad, so that a later run starts over from this sector.
+    def rewind(self, offset: int):
+        self.written = min(self.written, offset)
+        self.erased = min(self.erased, offset)
+        self._save()
+
+    # The session finished, nothing is left to resume.
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _journal_path(journal_dir: str, device: str, img_hash: str) -> str:
+    key = hashlib.sha256((device + "\0" + img_hash).encode()).hexdigest()[:24]
+    return os.path.join(journal_dir, key + ".json")
+
+
+# Returns the journal of an earlier, interrupted session of this image on this device, or a new empty one.
+def open_journal(device: str, addr: int, data: bytes, erase_size: int, journal_dir: str = JOURNAL_DIR) -> FlashJournal:
+    os.makedirs(journal_dir, exist_ok=True)
+    img_hash = image_hash(addr, data)
+    path = _journal_path(journal_dir, device, img_hash)
+    journal = FlashJournal(device, img_hash, addr, len(data), erase_size, path=path)
+    if not os.path.exists(path):
+        return journal
+
+    try:
+        with open(path, 'r') as f:
+            record = json.load(f)
+    except (OSError, ValueError) as e:
+        debug("Ignoring unreadable journal %s: %s", path, e)
+        return journal
+
+    if (record.get("device") != device or record.get("image") != img_hash or record.get("addr") != addr
+            or record.get("length") != len(data) or record.get("erase_size") != erase_size):
+        debug("Ignoring journal %s of another session.", path)
+        return journal
+
+    journal.erased = int(record.get("erased", 0))
+    journal.written = int(record.get("written", 0))
+    return journal
+
+
+# Drops every journal of the device, for when its flash was changed behind their back.
+def remove_journals(device: str, journal_dir: str = JOURNAL_DIR):
+    if not os.path.isdir(journal_dir):
+        return
+    for name in os.listdir(journal_dir):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(journal_dir, name)
+        try:
+            with open(path, 'r') as f:
+                record = json.load(f)
+            if record.get("device") == device:
+                os.remove(path)
+        except (OSError, ValueError, AttributeError) as e:
+            debug("Skipping journal %s: %s", path, e)
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import serial
+from dataclasses import dataclass, asdict, fields
+from flasher.util import debug, CACHE_DIR
+
+LINK_PROFILES_FILE: str = os.path.join(CACHE_DIR, "link_profiles.json")
+
+
+# Serial link settings. read_timeout > 0 makes reads block until the full response has arrived, so the protocol
+# doesn't need its fixed sleep before every read. read_timeout = 0 gives the old non-blocking reads plus sleeps.
+@dataclass
+class LinkProfile:
+    baudrate: int = 115200
+    rtscts: bool = False
+    xonxoff: bool = False
+    rx_buffer: int = 0  # bytes, 0 keeps the OS default
+    tx_buffer: int = 0  # bytes, 0 keeps the OS default
+    low_latency: bool = False
+    read_timeout: float = 1.0  # seconds
+    inter_byte_timeout: float = 0.1  # seconds
+
+
+# Opens a port with the given profile. 'tcp:host:port' opens a raw TCP serial bridge (for example ser2net or the
+# simulator) instead of a local serial port. Settings the platform or pyserial doesn't support are skipped.
+def open_link(port: str, profile: LinkProfile = None) -> serial.Serial:
+    if profile is None:
+        profile = LinkProfile()
+
+    if port.startswith("tcp:"):
+        return serial.serial_for_url("socket://" + port[len("tcp:"):], timeout=profile.read_timeout)
+
+    conn = serial.Serial(port=port, baudrate=profile.baudrate, rtscts=profile.rtscts, xonxoff=profile.xonxoff,
+                         inter_byte_timeout=profile.inter_byte_timeout, timeout=profile.read_timeout)
+    if (profile.rx_buffer or profile.tx_buffer) and hasattr(conn, 'set_buffer_size'):
+        # Only available on Windows
+        conn.set_buffer_size(rx_size=profile.rx_buffer or 4096, tx_size=profile.tx_buffer or None)
+    if profile.low_latency:
+        if hasattr(conn, 'set_low_latency_mode'):
+            try:
+                # Only available on Linux, sets ASYNC_LOW_LATENCY (on FTDI adapters this drops the 16 ms latency timer)
+                conn.set_low_latency_mode(True)
+            except (OSError, ValueError) as e:
+                debug("Low latency mode not supported on %s: %s", port, e)
+        else:
+            debug("Low latency mode not supported on this platform.")
+    return conn
+
+
+_adapter_ids: dict = dict()  # port -> adapter_id(port), a run asks for it several times
+
+
+# Identifies the adapter behind a port, so that a tuned profile follows a USB cable to another port name.
+# Falls back to the port name for links without USB information.
+def adapter_id(port: str) -> str:
+    if port.startswith("tcp:"):
+        return port
+    if port not in _adapter_ids:
+        _adapter_ids[port] = _lookup_adapter(port)
+    return _adapter_ids[port]
+
+
+# On Linux only the port itself is looked up in sysfs, enumerating every serial port of the machine is slow on small
+# hosts. Like comports(), symlinks to a port are not resolved.
+def _lookup_adapter(port: str) -> str:
+    if sys.platform.startswith("linux") and os.path.exists(port) and not os.path.islink(port):
+        from serial.tools.list_ports_linux import SysFS
+        ports = [SysFS(port)]
+    else:
+        import serial.tools.list_ports
+        ports = serial.tools.list_ports.comports()
+    for p in ports:
+        if p.device == port and p.vid is not None:
+            return "usb:%04x:%04x:%s" % (p.vid, p.pid, p.serial_number or p.location or port)
+    return port
+
+
+def _load_profiles(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+# Returns the settings of type cls saved for the adapter on this port, or None when there are none.
+def load_settings(port: str, cls, path: str):
+    record = _load_profiles(path).get(adapter_id(port))
+    if record is None:
+        return None
+    known = {f.name for f in fields(cls)}
+    return cls(**{k: v for k, v in record.items() if k in known})
+
+
+# Saves a settings dataclass for the adapter on this port, next to the ones saved for other adapters.
+def save_settings(port: str, settings, path: str):
+    profiles = _load_profiles(path)
+    profiles[adapter_id(port)] = asdict(settings)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+# Returns the saved link profile for the adapter on this port, or None when it was never tuned.
+def load_profile(port: str, path: str = LINK_PROFILES_FILE):
+    return load_settings(port, LinkProfile, path)
+
+
+def save_profile(port: str, profile: LinkProfile, path: str = LINK_PROFILES_FILE):
+    save_settings(port, profile, path)
@@ -0,0 +1,147 @@
+import os
+import json
+from dataclasses import dataclass, field
+from flasher.bootloader_protocol import PicoInfo
+
+# Manifests list several images to flash in one bootloader session, for products that need data or configuration
+# blobs at other flash addresses next to the application. A manifest is a JSON file:
+#   {
+#     "images": [
+#       {"file": "build/app.elf"},
+#       {"file": "calibration.bin", "addr": "0x10180000"},
+#       {"file": "assets.bin", "addr": "0x10200000"}
+#     ]
+#   }
+# ELF files load at the address they were linked for, binary files at the "addr" they are given (a number or a hex
+# string). File names are relative to the manifest. The application is the image that gets sealed and started: the
+# one marked with "application": true, or else the only ELF file of the manifest.
+#
+# plan_manifest() merges the images into runs of consecutive sectors that are erased and written together. Images may
+# share a sector but not a page: a page is the unit the device writes in, and the application's last page is padded
+# with zeros (like Program does) while the last page of a blob is left erased.
+
+
+@dataclass
+class ManifestImage:
+    file: str
+    addr: int
+    data: bytes
+    application: bool = False
+
+
+@dataclass
+class Manifest:
+    path: str
+    images: list = field(default_factory=list)
+
+    def application(self) -> ManifestImage:
+        return next(image for image in self.images if image.application)
+
+
+# Consecutive sectors that are erased together and then written with data, up to its last page with data. The gaps
+# between images in the sectors stay erased (0xff).
+@dataclass
+class FlashRun:
+    addr: int  # sector aligned
+    sectors: int
+    data: bytes
+
+
+def _addr(entry: dict, name: str) -> int:
+    addr = entry["addr"]
+    if isinstance(addr, str):
+        addr = int(addr, 0)
+    if not isinstance(addr, int) or addr < 0:
+        raise ValueError("Bad address for " + name + ": " + str(entry["addr"]))
+    return addr
+
+
+def load_manifest(path: str) -> Manifest:
+    with open(path, 'r') as f:
+        try:
+            entries = json.load(f)["images"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError("Manifest " + path + " has no list of images: " + str(e))
+    manifest = Manifest(path)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for entry in entries:
+        name = entry.get("file") if isinstance(entry, dict) else None
+        if not name:
+            raise ValueError("Manifest entry without a file: " + str(entry))
+        file_path = os.path.join(base_dir, name)
+        if os.path.splitext(name)[1] == ".elf":
+            if "addr" in entry:
+                raise ValueError("Base address for ELF files can't be specified: " + name)
+            from flasher.image_cache import load_elf_cached
+            image = load_elf_cached(file_path)
+            addr, data = image.Addr, image.Data
+        else:
+            if "addr" not in entry:
+                raise ValueError("Binary file " + name + " needs an \"addr\".")
+            addr = _addr(entry, name)
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        if not data:
+            raise ValueError(name + " is empty.")
+        manifest.images.append(ManifestImage(name, addr, bytes(data), bool(entry.get("application", False))))
+
+    if not any(image.application for image in manifest.images):
+        elves = [image for image in manifest.images if os.path.splitext(image.file)[1] == ".elf"]
+        if len(elves) != 1:
+            raise ValueError("Manifest " + path + " has to mark its application with \"application\": true.")
+        elves[0].application = True
+    if sum(image.application for image in manifest.images) != 1:
+        raise ValueError("Manifest " + path + " marks more than one application.")
+    return manifest
+
+
+# The image data as written: padded to whole pages, with zeros for the application (what its seal CRC covers) and
+# left erased for blobs.
+def padded_data(image: ManifestImage, write_size: int) -> bytes:
+    pad = -len(image.data) % write_size
+    return image.data + (bytes(pad) if image.application else b'\xff' * pad)
+
+
+# Checks every image of the manifest against the flash of the device and against each other, and returns the runs to
+# erase and write, in address order. Raises ValueError for images that don't fit or overlap.
+def plan_manifest(manifest: Manifest, device_info: PicoInfo) -> list:
+    erase_size, write_size = device_info.erase_size, device_info.write_size
+    flash_end = device_info.flash_addr + device_info.flash_size
+    images = sorted(manifest.images, key=lambda image: image.addr)
+    previous = None
+    for image in images:
+        end = image.addr + len(padded_data(image, write_size))
+        if image.addr < device_info.flash_addr or end > flash_end:
+            raise ValueError(image.file + " (" + hex(image.addr) + " to " + hex(end) + ") is outside the writable flash"
+                             " of the device (" + hex(device_info.flash_addr) + " to " + hex(flash_end) + ").")
+        if previous is not None and image.addr < previous[1]:
+            raise ValueError(image.file + " overlaps " + previous[0].file + " at " + hex(image.addr) + ".")
+        previous = (image, end)
+
+    # Sector by sector contents, erased where no image goes
+    sectors = dict()
+    for image in images:
+        data = padded_data(image, write_size)
+        offset = 0
+        while offset < len(data):
+            addr = image.addr + offset
+            index = addr // erase_size
+            sector = sectors.setdefault(index, bytearray(b'\xff' * erase_size))
+            start = addr - index * erase_size
+            length = min(erase_size - start, len(data) - offset)
+            sector[start:start + length] = data[offset:offset + length]
+            offset += length
+
+    runs = list()
+    for index in sorted(sectors):
+        if runs and runs[-1][0] + len(runs[-1][1]) == index:
+            runs[-1][1].append(sectors[index])
+        else:
+            runs.append((index, [sectors[index]]))
+    plan = list()
+    for index, contents in runs:
+        data = b''.join(contents)
+        # Trailing erased pages need no WRIT
+        used = len(data.rstrip(b'\xff'))
+        plan.append(FlashRun(index * erase_size, len(contents), data[:used + (-used % write_size)]))
+    return plan
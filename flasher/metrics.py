@@ -0,0 +1,170 @@
+import os
+import json
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets, an implicit +Inf bucket follows the last one.
+LATENCY_BUCKETS: tuple = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # Approximate quantile: the upper bound of the bucket the q-th observation falls in.
+    def quantile(self, q: float):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {str(b): c for b, c in zip(self.buckets + ("+Inf",), self.counts)},
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+# Everything recorded for one command (SYNC, WRIT, ...) on one device.
+class CommandStats:
+    def __init__(self):
+        self.first_byte = Histogram()  # send to first response byte
+        self.round_trip = Histogram()  # send to complete response
+        self.count = 0
+        self.retries = 0
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "retries": self.retries,
+            "tx_bytes": self.tx_bytes,
+            "rx_bytes": self.rx_bytes,
+            "first_byte_seconds": self.first_byte.to_dict(),
+            "round_trip_seconds": self.round_trip.to_dict(),
+        }
+
+
+# The view of FlashMetrics one Protocol_RP2040 records into, with the device and port labels filled in.
+class DeviceMetrics:
+    def __init__(self, registry, device: str, port: str):
+        self._registry = registry
+        self.device = device
+        self.port = port
+        self.commands = dict()
+
+    def _stats(self, command: str) -> CommandStats:
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        return stats
+
+    # first_byte and round_trip are None for commands without a response (GOGO).
+    def observe(self, command: str, first_byte, round_trip, tx_bytes: int, rx_bytes: int):
+        with self._registry.lock:
+            stats = self._stats(command)
+            stats.count += 1
+            stats.tx_bytes += tx_bytes
+            stats.rx_bytes += rx_bytes
+            if first_byte is not None:
+                stats.first_byte.observe(first_byte)
+            if round_trip is not None:
+                stats.round_trip.observe(round_trip)
+
+    def retry(self, command: str):
+        with self._registry.lock:
+            self._stats(command).retries += 1
+
+
+# Per command latency metrics of a run, for every device flashed in it. Safe to share between the threads of a
+# fleet run. Exported as a JSON report and as a Prometheus textfile (for node_exporter's textfile collector).
+class FlashMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = list()
+
+    def for_device(self, device: str, port: str) -> DeviceMetrics:
+        dev = DeviceMetrics(self, device, port)
+        with self.lock:
+            self.devices.append(dev)
+        return dev
+
+    def to_json(self) -> dict:
+        with self.lock:
+            return {"devices": [{"device": d.device, "port": d.port,
+                                 "commands": {c: s.to_dict() for c, s in sorted(d.commands.items())}}
+                                for d in self.devices]}
+
+    def to_prometheus(self) -> str:
+        lines = list()
+
+        def labels(dev, command, extra=""):
+            return '{device="%s",port="%s",command="%s"%s}' % (_escape(dev.device), _escape(dev.port), command, extra)
+
+        def histogram(name, help_text, attr):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s histogram" % name)
+            for dev in self.devices:
+                for command, stats in sorted(dev.commands.items()):
+                    h = getattr(stats, attr)
+                    cumulative = 0
+                    for bound, c in zip(h.buckets + ("+Inf",), h.counts):
+                        cumulative += c
+                        lines.append("%s_bucket%s %d" % (name, labels(dev, command, ',le="%s"' % bound), cumulative))
+                    lines.append("%s_sum%s %.6f" % (name, labels(dev, command), h.sum))
+                    lines.append("%s_count%s %d" % (name, labels(dev, command), h.count))
+
+        def counter(name, help_text, attr):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for dev in self.devices:
+                for command, stats in sorted(dev.commands.items()):
+                    lines.append("%s%s %d" % (name, labels(dev, command), getattr(stats, attr)))
+
+        with self.lock:
+            histogram("pico_flash_first_byte_seconds", "Time from sending a command to the first response byte.",
+                      "first_byte")
+            histogram("pico_flash_round_trip_seconds", "Time from sending a command to the complete response.",
+                      "round_trip")
+            counter("pico_flash_commands_total", "Commands sent.", "count")
+            counter("pico_flash_retries_total", "Commands retried after an error.", "retries")
+            counter("pico_flash_tx_bytes_total", "Bytes sent, frame headers included.", "tx_bytes")
+            counter("pico_flash_rx_bytes_total", "Response bytes received.", "rx_bytes")
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path: str):
+        _write_atomic(path, json.dumps(self.to_json(), indent=2))
+
+    # The textfile collector may read the file at any moment, so it is replaced atomically.
+    def write_prometheus(self, path: str):
+        _write_atomic(path, self.to_prometheus())
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _write_atomic(path: str, text: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,127 @@
+import os
+import time
+import collections
+from dataclasses import dataclass
+from flasher.util import debug, puts, CACHE_DIR
+from flasher.bootloader_protocol import Protocol_RP2040
+from flasher.program import PipelineSettings, ERASE_TIMEOUT_PER_SECTOR
+from flasher.link import load_settings, save_settings
+from flasher.tuning import measure_rtt
+
+PIPELINE_PROFILES_FILE: str = os.path.join(CACHE_DIR, "pipeline_profiles.json")
+CANDIDATE_WINDOWS: list = [1, 2, 4, 8, 16, 32]
+CANDIDATE_ERASE_BATCHES: list = [1, 4, 16]
+CALIBRATION_SECTORS: int = 16
+MIN_GAIN: float = 1.05  # a deeper window has to be at least 5% faster to be worth it
+
+
+@dataclass
+class PipelineCalibration:
+    settings: PipelineSettings
+    rtt: float  # seconds, median SYNC round trip
+    write_rate: float  # bytes/s with the chosen window
+    erase_rate: float  # bytes/s with the chosen erase batch
+
+
+# Erases the calibration region with ERAS commands of `batch` sectors each. Returns the elapsed time,
+# or None when an erase failed.
+def _timed_erase(protocol: Protocol_RP2040, conn, addr, length, erase_size, batch):
+    old_timeout = conn.timeout
+    conn.timeout = max(old_timeout or 0, batch * ERASE_TIMEOUT_PER_SECTOR)
+    try:
+        t_start = time.perf_counter()
+        for start in range(0, length, erase_size * batch):
+            if not protocol.erase_cmd(conn, addr + start, min(erase_size * batch, length - start)):
+                return None
+        return time.perf_counter() - t_start
+    finally:
+        conn.timeout = old_timeout
+
+
+# Writes data with up to `window` WRIT frames in flight. Returns the elapsed time, or None when any response was
+# missing or had a bad CRC, which means the link can't take this many frames in flight.
+def _timed_write(protocol: Protocol_RP2040, conn, addr, data, max_data_len, window):
+    in_flight = collections.deque()
+    sent = 0
+    done = 0
+    t_start = time.perf_counter()
+    while done < len(data):
+        while sent < len(data) and len(in_flight) < window:
+            end = min(sent + max_data_len, len(data))
+            protocol.send_write(conn, addr + sent, end - sent, data[sent:end])
+            in_flight.append(end)
+            sent = end
+        end = in_flight.popleft()
+        if not protocol.read_write_resp(conn, data[done:end]):
+            return None
+        done = end
+    return time.perf_counter() - t_start
+
+
+# Runs a short calibration on a connected bootloader (a real device, or the simulator over tcp:) and returns the
+# in-flight window and erase batch size that gave the highest rate. The first CALIBRATION_SECTORS sectors of the
+# application area are erased and written with random data, so the device has to be flashed afterwards.
+# conn must be a blocking connection (read timeout > 0).
+def calibrate_pipeline(conn, windows: list = None, erase_batches: list = None, sectors: int = CALIBRATION_SECTORS):
+    if windows is None:
+        windows = CANDIDATE_WINDOWS
+    if erase_batches is None:
+        erase_batches = CANDIDATE_ERASE_BATCHES
+
+    protocol = Protocol_RP2040(exit_on_error=False, MAX_SYNC_ATTEMPTS=5)
+    protocol.wait_time_before_read = 0
+    if not protocol.sync_cmd(conn, flush=True):
+        puts("No Pico device to calibrate with.")
+        return None
+    rtt = measure_rtt(conn)
+    info = protocol.info_cmd(conn)
+    addr = info.flash_addr
+    length = min(sectors * info.erase_size, info.flash_size)
+    data = os.urandom(length)
+
+    best_batch = 1
+    best_erase = None
+    for batch in erase_batches:
+        elapsed = _timed_erase(protocol, conn, addr, length, info.erase_size, batch)
+        if elapsed is None:
+            debug("Erase batch of %s sectors failed.", batch)
+            protocol.sync_cmd(conn, flush=True)
+            break
+        puts("Erase batch %3d: %8.0f bytes/s" % (batch, length / elapsed))
+        if best_erase is None or elapsed * MIN_GAIN < best_erase:
+            best_batch, best_erase = batch, elapsed
+
+    best_window = 1
+    best_write = None
+    for window in windows:
+        if _timed_erase(protocol, conn, addr, length, info.erase_size, best_batch) is None:
+            protocol.sync_cmd(conn, flush=True)
+            break
+        elapsed = _timed_write(protocol, conn, addr, data, info.max_data_len, window)
+        if elapsed is None:
+            debug("Window of %s frames in flight failed.", window)
+            protocol.sync_cmd(conn, flush=True)
+            break
+        puts("Window %3d: %8.0f bytes/s" % (window, length / elapsed))
+        if best_write is None or elapsed * MIN_GAIN < best_write:
+            best_window, best_write = window, elapsed
+        elif elapsed > best_write:
+            # Past the knee, deeper windows only add risk
+            break
+
+    if best_erase is None or best_write is None:
+        puts("Calibration failed, keeping the default pipeline settings.")
+        return None
+
+    settings = PipelineSettings(window=best_window, erase_batch=best_batch)
+    puts("Round trip %.2f ms, picked window %d and erase batch %d." % (rtt * 1000 if rtt else 0, best_window, best_batch))
+    return PipelineCalibration(settings, rtt, length / best_write, length / best_erase)
+
+
+# Returns the pipeline settings saved for the transport behind this port, or None when it was never calibrated.
+def load_pipeline(port: str, path: str = PIPELINE_PROFILES_FILE):
+    return load_settings(port, PipelineSettings, path)
+
+
+def save_pipeline(port: str, settings: PipelineSettings, path: str = PIPELINE_PROFILES_FILE):
+    save_settings(port, settings, path)
@@ -0,0 +1,239 @@
+import math
+import collections
+from dataclasses import dataclass, field
+from flasher.bootloader_protocol import PicoInfo, parse_info
+from flasher.capture import read_any_capture, HOST_TO_DEVICE
+
+# Dry runs: the frames a flash session sends and receives, planned from the image and the PicoInfo of the device
+# without talking to one, and an estimate of the wall time from a simple linear model of the link and the flash:
+#   seconds = round trips * latency + bytes on the wire * byte time + sectors * erase time + pages * program time
+# The same model can be fitted against real sessions recorded with --capture, every command and its response giving
+# one sample, so the estimate of a station follows its actual adapter, cable and board.
+
+# What the RP2040 serial bootloader reports: the application area after its own 32 kB, in the 16 MB flash
+DEFAULT_PICO_INFO = PicoInfo(0x10008000, 16 * 1024 * 1024 - 0x8000, 1 << 12, 1 << 8, 1024)
+
+# Frame lengths, without payloads
+SYNC_LEN: int = 4
+INFO_LEN: int = 4
+ERAS_LEN: int = 12
+WRIT_LEN: int = 12
+CRCC_LEN: int = 12
+SEAL_LEN: int = 16
+GOGO_LEN: int = 8
+RSP_LEN: int = 4  # PICO, OKOK or ERR!
+INFO_RSP_LEN: int = 4 + 5 * 4
+CRC_RSP_LEN: int = 4 + 4  # OKOK and a CRC, for WRIT and CRCC
+
+
+# Seconds a session takes, from the parameters of the link and the flash. The defaults are a Pico UART behind a USB
+# serial adapter in low latency mode at 115200 baud, with the flash times of its W25Q16JV.
+@dataclass
+class LinkModel:
+    baudrate: int = 115200
+    bits_per_byte: int = 10  # 8N1
+    latency: float = 0.002  # seconds per round trip: adapter latency timer, USB frames, host scheduling
+    sector_erase_time: float = 0.045  # seconds per erase_size sector
+    page_program_time: float = 0.0004  # seconds per write_size page
+    byte_time: float = 0.0  # seconds per byte on the wire, fitted models set it instead of a baud rate
+
+    def seconds_per_byte(self) -> float:
+        return self.byte_time or self.bits_per_byte / self.baudrate
+
+
+@dataclass
+class FlashPlan:
+    frames: collections.Counter = field(default_factory=collections.Counter)  # per opcode
+    tx_bytes: int = 0  # host to device
+    rx_bytes: int = 0
+    round_trips: int = 0  # responses the host waits for, pipelined WRIT frames share theirs
+    erase_sectors: int = 0
+    pages: int = 0  # programmed
+
+    def add(self, opcode: str, tx: int, rx: int, count: int = 1, round_trips: int = None):
+        self.frames[opcode] += count
+        self.tx_bytes += tx
+        self.rx_bytes += rx
+        self.round_trips += count if round_trips is None else round_trips
+
+    def total_frames(self) -> int:
+        return sum(self.frames.values())
+
+    # Seconds per part of the model.
+    def breakdown(self, model: LinkModel) -> dict:
+        return {
+            "round trips": self.round_trips * model.latency,
+            "wire": (self.tx_bytes + self.rx_bytes) * model.seconds_per_byte(),
+            "erase": self.erase_sectors * model.sector_erase_time,
+            "program": self.pages * model.page_program_time,
+        }
+
+    def estimate(self, model: LinkModel) -> float:
+        return sum(self.breakdown(model).values())
+
+
+def _align(val: int, to: int) -> int:
+    return -(-val // to) * to
+
+
+def _start(plan: FlashPlan):
+    plan.add('SYNC', SYNC_LEN, RSP_LEN)
+    plan.add('INFO', INFO_LEN, INFO_RSP_LEN)
+
+
+def _erase(plan: FlashPlan, length: int, info: PicoInfo, erase_batch: int):
+    sectors = _align(length, info.erase_size) // info.erase_size
+    frames = -(-sectors // max(1, erase_batch))
+    plan.add('ERAS', frames * ERAS_LEN, frames * RSP_LEN, frames)
+    plan.erase_sectors += sectors
+
+
+def _write(plan: FlashPlan, length: int, info: PicoInfo, window: int):
+    frames = -(-length // info.max_data_len)
+    plan.add('WRIT', frames * WRIT_LEN + length, frames * CRC_RSP_LEN, frames, -(-frames // max(1, window)))
+    plan.pages += -(-length // info.write_size)
+
+
+def _finish(plan: FlashPlan):
+    plan.add('SEAL', SEAL_LEN, RSP_LEN)
+    plan.add('GOGO', GOGO_LEN, 0, round_trips=0)
+
+
+# A complete flash of an image, as Program does it without a journal or registry: erase, write, seal and go.
+def plan_image(image, info: PicoInfo = DEFAULT_PICO_INFO, window: int = 1, erase_batch: int = 1) -> FlashPlan:
+    plan = FlashPlan()
+    _start(plan)
+    length = _align(len(image.Data), info.write_size)
+    _erase(plan, length, info, erase_batch)
+    _write(plan, length, info, window)
+    _finish(plan)
+    return plan
+
+
+# Applying a delta bundle (see flasher/delta.py) to a device that isn't in the registry: a CRC query per sector the
+# bundle leaves as it is, then the runs of changed sectors.
+def plan_delta(bundle, info: PicoInfo = DEFAULT_PICO_INFO, window: int = 1, erase_batch: int = 1) -> FlashPlan:
+    plan = FlashPlan()
+    _start(plan)
+    unchanged = len(bundle.unchanged())
+    plan.add('CRCC', unchanged * CRCC_LEN, unchanged * CRC_RSP_LEN, unchanged)
+    runs = list()
+    for i in sorted(bundle.changed):
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    for first, end in runs:
+        length = sum(len(bundle.changed[i]) for i in range(first, end))
+        _erase(plan, length, info, erase_batch)
+        _write(plan, length, info, window)
+    _finish(plan)
+    return plan
+
+
+# Flashing a manifest (see flasher/manifest.py) in one session.
+def plan_manifest_session(manifest, info: PicoInfo = DEFAULT_PICO_INFO, window: int = 1,
+                          erase_batch: int = 1) -> FlashPlan:
+    from flasher.manifest import plan_manifest
+    plan = FlashPlan()
+    _start(plan)
+    for run in plan_manifest(manifest, info):
+        _erase(plan, run.sectors * info.erase_size, info, erase_batch)
+        if run.data:
+            _write(plan, len(run.data), info, window)
+    _finish(plan)
+    return plan
+
+
+# Every command of a recorded session with its response: (request, response, seconds, whether the host waited for
+# the response before sending it). The time of a command runs from when it was sent, or from the previous response
+# if the command was sent before that arrived (pipelined WRIT frames), to its response.
+def _timed_exchanges(path: str):
+    waiting = collections.deque()
+    last_response = None
+    for t, direction, data in read_any_capture(path):
+        if t is None:
+            raise ValueError(path + " has no timestamps, fitting needs sessions recorded with --capture")
+        if direction == HOST_TO_DEVICE:
+            waiting.append((t, data))
+            continue
+        while waiting and waiting[0][1][:4] == b'SYNC' and data[:4] not in (b'PICO', b'WOTA'):
+            waiting.popleft()
+        if not waiting:
+            continue
+        sent, request = waiting.popleft()
+        waited = last_response is None or sent >= last_response
+        start = sent if waited else last_response
+        yield request, data, t - start, waited
+        last_response = t
+
+
+# One (features, seconds) sample per command of the session, the features in the order of FIT_PARAMETERS.
+def capture_samples(path: str) -> list:
+    info = DEFAULT_PICO_INFO
+    samples = list()
+    for request, response, seconds, waited in _timed_exchanges(path):
+        opcode = request[:4]
+        if opcode == b'INFO' and response[:4] == b'OKOK' and len(response) >= INFO_RSP_LEN:
+            info = parse_info(response[4:INFO_RSP_LEN])
+        sectors = pages = 0
+        if opcode == b'ERAS' and len(request) >= ERAS_LEN:
+            sectors = -(-int.from_bytes(request[8:12], 'little') // info.erase_size)
+        elif opcode == b'WRIT':
+            pages = -(-(len(request) - WRIT_LEN) // info.write_size)
+        samples.append(([1.0 if waited else 0.0, len(request) + len(response), sectors, pages], seconds))
+    return samples
+
+
+FIT_PARAMETERS: tuple = ("latency", "byte_time", "sector_erase_time", "page_program_time")
+
+
+# Solves the least squares problem for the given columns, None when they can't be told apart in the samples.
+def _least_squares(samples: list, columns: list):
+    n = len(columns)
+    a = [[0.0] * (n + 1) for _ in range(n)]
+    for features, seconds in samples:
+        x = [features[c] for c in columns]
+        for i in range(n):
+            for j in range(n):
+                a[i][j] += x[i] * x[j]
+            a[i][n] += x[i] * seconds
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(a[r][col]))
+        if abs(a[pivot][col]) < 1e-12 * max(1.0, max(abs(a[r][r]) for r in range(n))):
+            return None
+        a[col], a[pivot] = a[pivot], a[col]
+        for r in range(n):
+            if r != col:
+                factor = a[r][col] / a[col][col]
+                for c in range(col, n + 1):
+                    a[r][c] -= factor * a[col][c]
+    return [a[i][n] / a[i][i] for i in range(n)]
+
+
+# Fits the model to the commands of recorded sessions. Parameters the samples don't determine (no ERAS in the
+# sessions, say) or that come out negative keep their value in base. Returns the model and the RMS error of a command
+# in seconds.
+def fit_model(paths: list, base: LinkModel = None):
+    base = base if base is not None else LinkModel()
+    samples = [s for path in paths for s in capture_samples(path)]
+    if not samples:
+        raise ValueError("No timed commands in " + ", ".join(paths))
+    values = [base.latency, base.seconds_per_byte(), base.sector_erase_time, base.page_program_time]
+    free = [c for c in range(len(FIT_PARAMETERS)) if any(f[c] for f, _ in samples)]
+    while free:
+        # The parameters held fixed are taken off the measured times
+        fixed = [(f, s - sum(f[c] * values[c] for c in range(len(values)) if c not in free)) for f, s in samples]
+        solution = _least_squares(fixed, free)
+        if solution is None:
+            free.pop()
+            continue
+        negative = [c for c, v in zip(free, solution) if v < 0]
+        if not negative:
+            for c, v in zip(free, solution):
+                values[c] = v
+            break
+        free.remove(negative[0])
+    model = LinkModel(base.baudrate, base.bits_per_byte, values[0], values[2], values[3], values[1])
+    squared = sum((sum(f[c] * values[c] for c in range(len(values))) - s) ** 2 for f, s in samples)
+    return model, math.sqrt(squared / len(samples))
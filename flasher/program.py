@@ -1,6 +1,17 @@
+import time
+import binascii
+import collections
 from dataclasses import dataclass
-from flasher.util import debug, puts, exit_prog, hex_bytes_to_int
+from flasher.util import debug, debug_enabled, puts, exit_prog, hex_bytes_to_int
 from flasher.bootloader_protocol import Protocol_RP2040
+from flasher.journal import FlashJournal, PaddedData, open_journal
+from flasher.capture import TrafficCapture
+from flasher.metrics import FlashMetrics
+from flasher.trace import TraceTrack, span
+from flasher.progress import ProgressReport, ProgressTracker
+from flasher.registry import DeviceRegistry, DeviceRecord, sector_crcs
+from flasher.delta import DeltaBundle
+from flasher.manifest import Manifest, plan_manifest, padded_data
 
 
 @dataclass
@@ -9,37 +20,338 @@ class Image:
     Data: bytes = None
 
 
+# How often a failed erase/write/seal is retried in the same session, and how long to back off in between.
 @dataclass
-class ProgressReport:
-    Stage: str
-    Progress: int
-    Max: int
+class RetryPolicy:
+    max_retries: int = 3
+    backoff: float = 0.05  # seconds, before the first retry
+    backoff_factor: float = 2.0
+    sync_attempts: int = 5  # SYNC attempts per recovery
+
+
+# How many WRIT frames may be in flight before the oldest response is read, and how many sectors one ERAS covers.
+# Deeper windows hide the round trip time of the link, but need a link that buffers (USB CDC, TCP, or a UART with
+# flow control). See flasher/pipeline_tuning.py for picking these per link.
+@dataclass
+class PipelineSettings:
+    window: int = 1
+    erase_batch: int = 1
+
+
+ERASE_TIMEOUT_PER_SECTOR: float = 0.4  # seconds, worst case 4 kB sector erase time of the QSPI flash
 
 
 def align(val, to):
     return (val + (to - 1)) & ~(to - 1)
 
 
-def Program(conn, image: Image, progress_bar):
+# Waits according to the retry policy and brings the bootloader back in sync. After an ERR! the bootloader state
+# machine is back in WAIT_FOR_SYNC, so nothing else is accepted before a new SYNC.
+def _recover(protocol: Protocol_RP2040, conn, retry: RetryPolicy, attempt: int) -> bool:
+    time.sleep(retry.backoff * (retry.backoff_factor ** (attempt - 1)))
+    return protocol.sync_cmd(conn, flush=True)
+
+
+# Erases one range of flash, resyncing and retrying on failure. An ERAS of several sectors takes several times as
+# long to answer, so the read timeout of a blocking connection is stretched to match.
+def _erase_with_retry(protocol: Protocol_RP2040, conn, addr, length, retry: RetryPolicy, sectors: int = 1):
+    old_timeout = getattr(conn, 'timeout', None)
+    if old_timeout and sectors > 1:
+        conn.timeout = max(old_timeout, sectors * ERASE_TIMEOUT_PER_SECTOR)
+    try:
+        attempt = 0
+        while not protocol.erase_cmd(conn, addr, length):
+            attempt += 1
+            if attempt > retry.max_retries:
+                puts("Error when erasing flash, at addr: " + str(addr))
+                exit_prog(True)
+            puts("Erase failed at " + hex(addr) + ", resyncing (attempt " + str(attempt) + " of " + str(retry.max_retries) + ").")
+            _recover(protocol, conn, retry, attempt)
+            protocol.note_retry('ERAS')
+    finally:
+        if old_timeout and sectors > 1:
+            conn.timeout = old_timeout
+
+
+# Writes data[start:stop] to the device in chunks of at most max_data_len bytes, keeping up to `window` WRIT frames in
+# flight. When a chunk fails, the responses still in flight can't be trusted anymore: the bootloader is resynced and
+# writing restarts at the failed chunk. If the device did not reject the frame with ERR! the flash may already have
+# been programmed with bad data, so the affected sectors (up to the last one a frame in flight went to) are erased
+# again and rewritten. Every completely written sector is recorded in the journal, if there is one. Progress is reported
+# per chunk, as progress_offset plus the offset into data, for callers that write several pieces in one stage.
+def _write_with_retry(protocol: Protocol_RP2040, conn, image_addr, data, device_info, retry: RetryPolicy,
+                      start: int = 0, journal: FlashJournal = None, window: int = 1, progress: ProgressTracker = None,
+                      stop: int = None, progress_offset: int = 0):
+    if stop is None:
+        stop = len(data)
+    erase_size = device_info.erase_size
+    in_flight = collections.deque()
+    sent = start
+    attempt = 0
+    while start < stop:
+        while sent < stop and len(in_flight) < window:
+            end = min(sent + device_info.max_data_len, stop)
+            protocol.send_write(conn, image_addr + sent, end - sent, data[sent:end])
+            in_flight.append(end)
+            sent = end
+
+        end = in_flight.popleft()
+        if protocol.read_write_resp(conn, data[start:end]):
+            start = end
+            attempt = 0
+            if journal is not None and (end % erase_size == 0 or end == len(data)):
+                journal.mark_written(end)
+            if progress is not None:
+                progress.update(progress_offset + end)
+            continue
+
+        attempt += 1
+        if attempt > retry.max_retries:
+            puts("CRC mismatch! Exiting.")
+            exit_prog(False)
+        rejected = protocol.last_response.startswith(protocol.Opcodes['ResponseErr'])
+        puts("Write failed at " + hex(image_addr + start) + (" (ERR!)" if rejected else " (CRC mismatch)")
+             + ", resyncing (attempt " + str(attempt) + " of " + str(retry.max_retries) + ").")
+        in_flight.clear()
+        protocol.note_retry('WRIT')
+        if _recover(protocol, conn, retry, attempt) and not rejected:
+            sector_start = (start // erase_size) * erase_size
+            erase_end = align(sent, erase_size)
+            _erase_with_retry(protocol, conn, image_addr + sector_start, erase_end - sector_start, retry,
+                              (erase_end - sector_start) // erase_size)
+            start = sector_start
+        sent = start
+
+
+# Returns the offset into the image data to continue writing from, after an interrupted earlier session.
+# Every sector in the journal was confirmed by a WRIT CRC before it was journaled, but the last one is checked against
+# the device with a CRC query anyway, since it is the one most likely to be hit by a power cut. If it does not match
+# (or the bootloader does not support the query) that sector is written again.
+def _resume_offset(protocol: Protocol_RP2040, conn, image_addr, data, journal: FlashJournal, retry: RetryPolicy) -> int:
+    if journal.written == 0:
+        return 0
+
+    last_sector = ((journal.written - 1) // journal.erase_size) * journal.erase_size
+    device_crc = protocol.crc_cmd(conn, image_addr + last_sector, journal.written - last_sector)
+    if device_crc == binascii.crc32(data[last_sector:journal.written]):
+        puts("Resuming interrupted flash, " + str(journal.written) + " of " + str(len(data)) + " bytes already written.")
+        return journal.written
+
+    puts("Last written sector at " + hex(image_addr + last_sector) + " could not be verified, writing it again.")
+    if device_crc is None:
+        _recover(protocol, conn, retry, 1)
+    journal.rewind(last_sector)
+    return last_sector
+
+
+# Erases and writes the whole image. With use_journal, an interrupted earlier session of the same image on the same
+# device is resumed, and the progress of this one is journaled. Returns the journal, or None.
+def _flash_all(protocol: Protocol_RP2040, conn, image: Image, data, device_info, retry: RetryPolicy, use_journal: bool,
+               device_id: str, pipeline: PipelineSettings, progress: ProgressTracker = None, trace: TraceTrack = None):
+    journal = None
+    erase_from = 0
+    write_from = 0
+    if use_journal:
+        with span(trace, "journal"):
+            journal = open_journal(device_id, image.Addr, data, device_info.erase_size)
+            write_from = _resume_offset(protocol, conn, image.Addr, data, journal, retry)
+            erase_from = journal.erased
+            # Past the last completely written sector, the acknowledged chunks of the next one and the WRIT frames that
+            # were in flight may have been programmed, so those sectors are erased again. When the whole image was
+            # written (the session stopped before the seal) there is nothing past it, and its end needn't be aligned.
+            window = max(1, pipeline.window)
+            dirty_end = min(align(write_from + device_info.erase_size + (window - 1) * device_info.max_data_len,
+                                  device_info.erase_size), erase_from)
+            if write_from < len(data) and write_from < dirty_end:
+                _erase_with_retry(protocol, conn, image.Addr + write_from, dirty_end - write_from, retry,
+                                  (dirty_end - write_from) // device_info.erase_size)
+
+    puts("Starting erase. at image address: " + str(image.Addr))
+
+    # Check how many bytes we need to erase, and start erasing.
+    erase_len = int(align(len(data), device_info.erase_size))
+    erase_step = device_info.erase_size * max(1, pipeline.erase_batch)
+    if progress is not None:
+        progress.stage("erase", erase_len, erase_from)
+    with span(trace, "erase", bytes=erase_len - erase_from):
+        for start in range(erase_from, erase_len, erase_step):
+            erase_addr = image.Addr + start
+            length = min(erase_step, erase_len - start)
+            debug("Erase: %s size: %s", erase_addr, length)
+            _erase_with_retry(protocol, conn, erase_addr, length, retry, length // device_info.erase_size)
+            if journal is not None:
+                journal.mark_erased(start + length)
+            if progress is not None:
+                progress.update(start + length)
+
+    puts("Erase completed.")
+
+    puts("Starting flash.")
+    # Start write
+    if progress is not None:
+        progress.stage("write", len(data), write_from)
+    with span(trace, "write", bytes=len(data) - write_from):
+        _write_with_retry(protocol, conn, image.Addr, data, device_info, retry, write_from, journal,
+                          max(1, pipeline.window), progress)
+
+    puts("Flashing completed.")
+    return journal
+
+
+# Returns the sectors that differ between the image data and what the registry says the device holds, or None when the
+# device has to be flashed completely: no usable record, or one of the spot checked sectors doesn't match the device.
+def _registry_plan(protocol: Protocol_RP2040, conn, registry: DeviceRegistry, device_id: str, image_addr, crcs: list,
+                   erase_size: int, retry: RetryPolicy):
+    record = registry.lookup(device_id)
+    if record is None or record.addr != image_addr or record.erase_size != erase_size:
+        return None
+    changed = registry.changed_sectors(record, crcs)
+    for i in registry.spot_check_sectors(record, changed, len(crcs)):
+        start, length = record.sector_range(i)
+        device_crc = protocol.crc_cmd(conn, image_addr + start, length)
+        if device_crc != record.sectors[i]:
+            puts("Device no longer holds the image last flashed to it (sector at " + hex(image_addr + start)
+                 + " differs).")
+            if device_crc is None:
+                _recover(protocol, conn, retry, 1)
+            return None
+    return changed
+
+
+# Erases and writes only the given sectors of the image, one run of consecutive sectors after the other.
+def _flash_sectors(protocol: Protocol_RP2040, conn, image_addr, data, device_info, changed: list, retry: RetryPolicy,
+                   pipeline: PipelineSettings, progress: ProgressTracker = None, trace: TraceTrack = None):
+    erase_size = device_info.erase_size
+    runs = list()
+    for i in changed:
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    ranges = [(first * erase_size, min(end * erase_size, len(data))) for first, end in runs]
+    total = sum(stop - start for start, stop in ranges)
+    erase_step = erase_size * max(1, pipeline.erase_batch)
+
+    if progress is not None:
+        progress.stage("erase", total)
+    done = 0
+    with span(trace, "erase", bytes=total):
+        for start, stop in ranges:
+            erase_stop = align(stop, erase_size)
+            for offset in range(start, erase_stop, erase_step):
+                length = min(erase_step, erase_stop - offset)
+                _erase_with_retry(protocol, conn, image_addr + offset, length, retry, length // erase_size)
+                done += min(offset + length, stop) - offset
+                if progress is not None:
+                    progress.update(done)
+
+    if progress is not None:
+        progress.stage("write", total)
+    done = 0
+    with span(trace, "write", bytes=total):
+        for start, stop in ranges:
+            _write_with_retry(protocol, conn, image_addr, data, device_info, retry, start, None,
+                              max(1, pipeline.window), progress, stop, done - start)
+            done += stop - start
+
+
+# Syncs with the bootloader on conn and asks it for its flash layout. Returns the protocol and the PicoInfo.
+def _start_session(conn, retry: RetryPolicy, device_id: str, capture: TrafficCapture = None,
+                   metrics: FlashMetrics = None, trace: TraceTrack = None):
     # Normal RP2040 (not wireless) protocol
-    protocol = Protocol_RP2040()
+    protocol = Protocol_RP2040(exit_on_error=False, sync_backoff=retry.backoff, capture=capture, trace=trace)
+    if metrics is not None:
+        protocol.metrics = metrics.for_device(device_id, str(getattr(conn, 'port', None) or "unknown"))
+    if getattr(conn, 'timeout', None):
+        # Blocking reads with a timeout wait for the response themselves
+        protocol.wait_time_before_read = 0
 
     # Check if there is a Pico device connected, ready to be flashed
-    has_sync = protocol.sync_cmd(conn=conn)
+    with span(trace, "sync"):
+        has_sync = protocol.sync_cmd(conn=conn)
     if not has_sync:
         puts("No Pico device to get in sync with.")
         exit_prog()
 
+    # From here on, a lost sync is recovered by resyncing instead of failing the flash
+    protocol.MAX_SYNC_ATTEMPTS = retry.sync_attempts
+
     # Receive information about flash size, and address offsets
-    device_info = protocol.info_cmd(conn=conn)
+    with span(trace, "info"):
+        device_info = protocol.info_cmd(conn=conn)
+    return protocol, device_info
+
+
+# Before anything is erased, the registry is told what the device will hold if the flash gets interrupted: nothing
+# known when it is flashed completely (changed is None), otherwise the record with the changed sectors unknown.
+def _mark_unknown(registry: DeviceRegistry, device_id: str, addr, length: int, erase_size: int, crcs: list,
+                  changed: list):
+    if changed is None:
+        registry.forget(device_id)
+        return
+    changed_set = set(changed)
+    registry.save(DeviceRecord(device_id, addr, length, erase_size, "",
+                               [None if i in changed_set else crc for i, crc in enumerate(crcs)]))
+
+
+# Seals the image, resyncing and retrying on failure. Exits when the device keeps refusing the seal.
+# A device that refuses the seal holds something else than the registry or the journal assume, so its record and the
+# journal are dropped: the next session flashes the whole image.
+def _seal(protocol: Protocol_RP2040, conn, addr, data, image_crc: int, retry: RetryPolicy, trace: TraceTrack = None,
+          registry: DeviceRegistry = None, device_id: str = None, journal: FlashJournal = None):
+    puts("Adding seal to finalize.")
+    with span(trace, "seal"):
+        has_sealed = protocol.seal_cmd(conn, addr, data, image_crc)
+        attempt = 0
+        while not has_sealed and attempt < retry.max_retries:
+            attempt += 1
+            puts("Seal failed, resyncing (attempt " + str(attempt) + " of " + str(retry.max_retries) + ").")
+            protocol.note_retry('SEAL')
+            if _recover(protocol, conn, retry, attempt):
+                has_sealed = protocol.seal_cmd(conn, addr, data, image_crc)
+    debug("Has sealed: %s", has_sealed)
+    if not has_sealed:
+        if registry is not None:
+            registry.forget(device_id)
+        if journal is not None:
+            journal.remove()
+        puts("Sealing failed. Exiting.")
+        exit_prog(False)
+
+
+# Flashes an image to the device on conn. Progress is kept in an on-disk journal per device and image, so a session
+# that gets interrupted continues where it stopped the next time the same image is flashed to the same device.
+# device_id identifies the device in the journal and defaults to the port name. When a capture is given, every frame
+# sent and received is recorded to it. When metrics are given, the latency of every command is added to them.
+# When a trace track is given, the phases of the session and every frame are recorded on it as spans.
+# When a registry is given and has a record of the device, only the sectors that changed since are erased and written
+# (see flasher/registry.py). After the seal, the image is recorded in it.
+# progress_bar is called with a ProgressReport as erasing and writing go on (see flasher/progress.py for renderers),
+# or None for no progress reporting.
+def Program(conn, image: Image, progress_bar, retry: RetryPolicy = None, use_journal: bool = True, device_id: str = None,
+            pipeline: PipelineSettings = None, capture: TrafficCapture = None, metrics: FlashMetrics = None,
+            trace: TraceTrack = None, registry: DeviceRegistry = None):
+    if retry is None:
+        retry = RetryPolicy()
+    if pipeline is None:
+        pipeline = PipelineSettings()
+    if device_id is None:
+        device_id = str(getattr(conn, 'port', None) or "unknown")
+
+    progress = ProgressTracker(progress_bar, device_id) if progress_bar is not None else None
+    protocol, device_info = _start_session(conn, retry, device_id, capture, metrics, trace)
 
-    # Pad the image data message
-    pad_len = align(int(len(image.Data)), device_info.write_size) - int(len(image.Data))
-    pad_zeros = bytes(pad_len)
-    data = image.Data + pad_zeros
+    # Pad the image data message. The padding is only joined to the last chunk written, not to a copy of the image.
+    with span(trace, "pad image"):
+        pad_len = align(int(len(image.Data)), device_info.write_size) - int(len(image.Data))
+        pad_zeros = bytes(pad_len)
+        data = PaddedData(image.Data, pad_zeros)
+    with span(trace, "precompute crc"):
+        image_crc = binascii.crc32(pad_zeros, binascii.crc32(image.Data))
 
-    debug("pad_len: " + str(pad_len))
-    debug("pad_zeros: " + str(hex_bytes_to_int(pad_zeros)))
+    debug("pad_len: %s", pad_len)
+    if debug_enabled():
+        debug("pad_zeros: %s", hex_bytes_to_int(pad_zeros))
     #debug("data: " + str(data))
     # debug("Data readable: " + str(data_ints))
 
@@ -51,47 +363,175 @@ def Program(conn, image: Image, progress_bar):
         puts("Image of " + str(len(data)) + " bytes does not fit in target flash at: " + str(hex(image.Addr)))
         exit_prog(True)
 
-    puts("Starting erase. at image address: " + str(image.Addr))
+    crcs = None
+    changed = None
+    if registry is not None:
+        with span(trace, "registry"):
+            crcs = sector_crcs(data, device_info.erase_size)
+            changed = _registry_plan(protocol, conn, registry, device_id, image.Addr, crcs, device_info.erase_size,
+                                     retry)
+        _mark_unknown(registry, device_id, image.Addr, len(data), device_info.erase_size, crcs, changed)
 
-    # Check how many bytes we need to erase, and start erasing.
-    erase_len = int(align(len(data), device_info.erase_size))
-    for start in range(0, erase_len, device_info.erase_size):
-        erase_addr = image.Addr + start
-        debug("Erase: " + str(erase_addr) + "size: " + str(device_info.erase_size))
-        has_succeeded = protocol.erase_cmd(conn, erase_addr, device_info.erase_size)
-        if not has_succeeded:
-            puts("Error when erasing flash, at addr: " + str(erase_addr))
-            exit_prog(True)
+    journal = None
+    if changed is not None:
+        puts("Device holds a known image, " + str(len(changed)) + " of " + str(len(crcs))
+             + " sectors changed, flashing only those.")
+        _flash_sectors(protocol, conn, image.Addr, data, device_info, changed, retry, pipeline, progress, trace)
+    else:
+        journal = _flash_all(protocol, conn, image, data, device_info, retry, use_journal, device_id, pipeline,
+                             progress, trace)
 
-    puts("Erase completed.")
+    _seal(protocol, conn, image.Addr, data, image_crc, retry, trace, registry, device_id, journal)
 
-    puts("Starting flash.")
-    # Start write
-    for start in range(0, len(data), device_info.max_data_len):
-        end = start + device_info.max_data_len
-        if end > int(len(data)):
-            end = int(len(data))
-
-        wr_addr = image.Addr + start
-        wr_len = end - start
-        wr_data = data[start:end]
-        crc_valid = protocol.write_cmd(conn, wr_addr, wr_len, wr_data)
-        if not crc_valid:
-            puts("CRC mismatch! Exiting.")
-            exit_prog(False)
+    if journal is not None:
+        journal.remove()
+    if registry is not None:
+        registry.store(device_id, image.Addr, data, device_info.erase_size, crcs)
 
-    puts("Flashing completed.")
+    with span(trace, "go"):
+        protocol.go_to_application_cmd(conn, image.Addr)
 
-    puts("Adding seal to finalize.")
-    has_sealed = protocol.seal_cmd(conn, image.Addr, data)
-    debug("Has sealed: " + str(has_sealed))
-    if not has_sealed:
-        puts("Sealing failed. Exiting.")
-        exit_prog(False)
 
-    protocol.go_to_application_cmd(conn, image.Addr)
 
 
+    debug("Program is done.")
 
 
-    debug("Program is done.")
+# The sectors to flash to bring the device from the old release of the bundle to the new one, or None when the device
+# doesn't hold the old release. A trusted registry record (see _registry_plan) spares the CRC query of every sector the
+# bundle leaves as it is, and after an interrupted apply it narrows the sectors down to the ones not written yet.
+def _delta_plan(protocol: Protocol_RP2040, conn, bundle: DeltaBundle, registry: DeviceRegistry, device_id: str,
+                retry: RetryPolicy):
+    if registry is not None:
+        changed = _registry_plan(protocol, conn, registry, device_id, bundle.addr, bundle.new_sectors,
+                                 bundle.erase_size, retry)
+        if changed is not None and all(i in bundle.changed for i in changed):
+            return changed
+    for i in bundle.unchanged():
+        start, length = bundle.sector_range(i)
+        device_crc = protocol.crc_cmd(conn, bundle.addr + start, length)
+        if device_crc != bundle.new_sectors[i]:
+            debug("Sector at %s differs from the old release: %s", hex(bundle.addr + start), device_crc)
+            if device_crc is None:
+                _recover(protocol, conn, retry, 1)
+            return None
+    return sorted(bundle.changed)
+
+
+# Applies a delta bundle (see flasher/delta.py) to the device on conn: checks that the device holds the release the
+# bundle upgrades from, erases and writes the sectors that changed and seals the new image. When the device holds
+# anything else, nothing is erased and the session is aborted, the device has to be flashed with the ELF file of the
+# new release then. The other arguments are the ones of Program.
+def ProgramDelta(conn, bundle: DeltaBundle, progress_bar, retry: RetryPolicy = None, device_id: str = None,
+                 pipeline: PipelineSettings = None, capture: TrafficCapture = None, metrics: FlashMetrics = None,
+                 trace: TraceTrack = None, registry: DeviceRegistry = None):
+    if retry is None:
+        retry = RetryPolicy()
+    if pipeline is None:
+        pipeline = PipelineSettings()
+    if device_id is None:
+        device_id = str(getattr(conn, 'port', None) or "unknown")
+
+    progress = ProgressTracker(progress_bar, device_id) if progress_bar is not None else None
+    protocol, device_info = _start_session(conn, retry, device_id, capture, metrics, trace)
+
+    if device_info.erase_size != bundle.erase_size or device_info.write_size != bundle.write_size:
+        puts("Delta bundle was built for " + str(bundle.erase_size) + " byte sectors and " + str(bundle.write_size)
+             + " byte pages, the device has " + str(device_info.erase_size) + " and " + str(device_info.write_size)
+             + ".")
+        exit_prog(True)
+
+    if bundle.addr < device_info.flash_addr or \
+            bundle.addr + bundle.new_length > device_info.flash_addr + device_info.flash_size:
+        puts("Image of " + str(bundle.new_length) + " bytes does not fit in target flash at: " + str(hex(bundle.addr)))
+        exit_prog(True)
+
+    with span(trace, "verify old release"):
+        changed = _delta_plan(protocol, conn, bundle, registry, device_id, retry)
+    if changed is None:
+        puts("Device does not hold the release the delta bundle upgrades from, flash it with the ELF file instead.")
+        exit_prog(True)
+    if registry is not None:
+        _mark_unknown(registry, device_id, bundle.addr, bundle.new_length, bundle.erase_size, bundle.new_sectors,
+                      changed)
+
+    puts("Applying delta bundle, " + str(len(changed)) + " of " + str(len(bundle.new_sectors)) + " sectors changed.")
+    data = bundle.image_data()
+    _flash_sectors(protocol, conn, bundle.addr, data, device_info, changed, retry, pipeline, progress, trace)
+    _seal(protocol, conn, bundle.addr, data, bundle.seal_crc, retry, trace, registry, device_id)
+
+    if registry is not None:
+        registry.save(DeviceRecord(device_id, bundle.addr, bundle.new_length, bundle.erase_size, bundle.new_image,
+                                   list(bundle.new_sectors)))
+
+    with span(trace, "go"):
+        protocol.go_to_application_cmd(conn, bundle.addr)
+
+    debug("Delta bundle applied.")
+
+
+# Flashes every image of a manifest (see flasher/manifest.py) in one bootloader session: all of them are checked
+# against the flash of the device and against each other before anything is erased, the sectors they need are erased
+# and written in one pass in address order, and only the application is sealed and started. The other arguments are
+# the ones of Program. The registry record of the device is replaced with one of the application.
+def ProgramManifest(conn, manifest: Manifest, progress_bar, retry: RetryPolicy = None, device_id: str = None,
+                    pipeline: PipelineSettings = None, capture: TrafficCapture = None, metrics: FlashMetrics = None,
+                    trace: TraceTrack = None, registry: DeviceRegistry = None):
+    if retry is None:
+        retry = RetryPolicy()
+    if pipeline is None:
+        pipeline = PipelineSettings()
+    if device_id is None:
+        device_id = str(getattr(conn, 'port', None) or "unknown")
+
+    progress = ProgressTracker(progress_bar, device_id) if progress_bar is not None else None
+    protocol, device_info = _start_session(conn, retry, device_id, capture, metrics, trace)
+
+    try:
+        plan = plan_manifest(manifest, device_info)
+    except ValueError as e:
+        puts("Manifest can't be flashed: " + str(e))
+        exit_prog(True)
+    application = manifest.application()
+    app_data = padded_data(application, device_info.write_size)
+    if registry is not None:
+        registry.forget(device_id)
+
+    erase_size = device_info.erase_size
+    erase_total = sum(run.sectors for run in plan) * erase_size
+    write_total = sum(len(run.data) for run in plan)
+    puts("Flashing " + str(len(manifest.images)) + " images: " + str(erase_total) + " bytes to erase in "
+         + str(len(plan)) + " runs, " + str(write_total) + " to write.")
+    erase_step = erase_size * max(1, pipeline.erase_batch)
+
+    if progress is not None:
+        progress.stage("erase", erase_total)
+    done = 0
+    with span(trace, "erase", bytes=erase_total):
+        for run in plan:
+            run_length = run.sectors * erase_size
+            for offset in range(0, run_length, erase_step):
+                length = min(erase_step, run_length - offset)
+                _erase_with_retry(protocol, conn, run.addr + offset, length, retry, length // erase_size)
+                done += length
+                if progress is not None:
+                    progress.update(done)
+
+    if progress is not None:
+        progress.stage("write", write_total)
+    done = 0
+    with span(trace, "write", bytes=write_total):
+        for run in plan:
+            _write_with_retry(protocol, conn, run.addr, run.data, device_info, retry, 0, None, max(1, pipeline.window),
+                              progress, None, done)
+            done += len(run.data)
+
+    _seal(protocol, conn, application.addr, app_data, binascii.crc32(app_data), retry, trace, registry,
+          device_id)
+    if registry is not None:
+        registry.store(device_id, application.addr, app_data, erase_size)
+
+    with span(trace, "go"):
+        protocol.go_to_application_cmd(conn, application.addr)
+
+    debug("Manifest flashed.")
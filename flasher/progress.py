@@ -0,0 +1,117 @@
+import sys
+import json
+import time
+import threading
+from dataclasses import dataclass, asdict
+from flasher.util import printProgressBar
+
+DEFAULT_INTERVAL: float = 0.1  # seconds between two reports of the same stage
+
+
+@dataclass
+class ProgressReport:
+    Stage: str
+    Progress: int  # bytes done
+    Max: int  # bytes in this stage
+    Device: str = ""
+    Rate: float = 0.0  # bytes/s since the previous report
+    AvgRate: float = 0.0  # bytes/s since the start of the stage
+    Eta: float = None  # seconds until the stage is done, None while unknown
+
+
+# Turns byte counts of the erase and write loops into ProgressReports for a callback. update() is called for every
+# chunk, so it only compares a timestamp; a report is built and passed on at most once per interval, plus at the
+# start and the end of every stage.
+class ProgressTracker:
+    def __init__(self, callback, device: str = "", interval: float = DEFAULT_INTERVAL):
+        self.callback = callback
+        self.device = device
+        self.interval = interval
+        self.stage_name = ""
+        self.total = 0
+        self._start_done = 0
+        self._start_t = 0.0
+        self._last_done = 0
+        self._last_t = 0.0
+
+    # Starts a stage of total bytes, of which done are already done (after a resume).
+    def stage(self, name: str, total: int, done: int = 0):
+        self.stage_name = name
+        self.total = total
+        self._start_done = self._last_done = done
+        self._start_t = self._last_t = time.perf_counter()
+        self.callback(ProgressReport(name, done, total, self.device))
+
+    def update(self, done: int):
+        now = time.perf_counter()
+        if now - self._last_t < self.interval and done < self.total:
+            return
+        rate = (done - self._last_done) / (now - self._last_t) if now > self._last_t else 0.0
+        elapsed = now - self._start_t
+        avg_rate = (done - self._start_done) / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - done) / avg_rate if avg_rate > 0 else None
+        self._last_done = done
+        self._last_t = now
+        self.callback(ProgressReport(self.stage_name, done, self.total, self.device, rate, avg_rate, eta))
+
+
+def _format_eta(eta) -> str:
+    if eta is None:
+        return "--:--"
+    return "%02d:%02d" % divmod(int(eta + 0.5), 60)
+
+
+def _suffix(report: ProgressReport) -> str:
+    return "%7.1f kB/s ETA %s" % (report.AvgRate / 1000, _format_eta(report.Eta))
+
+
+# Progress bar on the terminal for a single device.
+class BarRenderer:
+    def __init__(self, length: int = 40):
+        self.length = length
+
+    def __call__(self, report: ProgressReport):
+        if report.Max > 0:
+            printProgressBar(report.Progress, report.Max, prefix="%-6s" % report.Stage, suffix=_suffix(report),
+                             length=self.length)
+
+
+# One line per device for fleet runs. On a terminal the lines are redrawn in place, otherwise (a log file or CI)
+# every report is printed as a line of its own, which the tracker's throttling keeps short.
+class FleetRenderer:
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._lock = threading.Lock()
+        self._lines = dict()
+        self._drawn = 0
+
+    def _line(self, report: ProgressReport) -> str:
+        percent = 100.0 * report.Progress / report.Max if report.Max else 100.0
+        return "%-20s %-6s %5.1f%% %s" % (report.Device, report.Stage, percent, _suffix(report))
+
+    def __call__(self, report: ProgressReport):
+        with self._lock:
+            self._lines[report.Device] = self._line(report)
+            if not self.tty:
+                self.stream.write(self._lines[report.Device] + "\n")
+                return
+            if self._drawn:
+                self.stream.write("\x1b[%dF" % self._drawn)
+            for device in sorted(self._lines):
+                self.stream.write("\x1b[2K" + self._lines[device] + "\n")
+            self._drawn = len(self._lines)
+            self.stream.flush()
+
+
+# One JSON object per report and line, for dashboards.
+class JsonLinesRenderer:
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self._lock = threading.Lock()
+
+    def __call__(self, report: ProgressReport):
+        line = json.dumps(asdict(report))
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
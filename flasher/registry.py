@@ -0,0 +1,90 @@
+import os
+import json
+import random
+import hashlib
+import binascii
+from dataclasses import dataclass, asdict, field
+from flasher.util import debug, CACHE_DIR
+from flasher.journal import image_hash
+
+REGISTRY_DIR: str = os.path.join(CACHE_DIR, "devices")
+DEFAULT_SPOT_CHECKS: int = 2  # sectors verified with a CRC query before a record is trusted
+
+
+# CRC32 of every erase_size sector of the image data, the last one possibly shorter.
+def sector_crcs(data: bytes, erase_size: int) -> list:
+    return [binascii.crc32(data[start:start + erase_size]) for start in range(0, len(data), erase_size)]
+
+
+# What the flasher last wrote to one device: the image and the CRC of every sector of it. A sector whose CRC is None
+# is unknown, it was about to be rewritten when the record was saved.
+@dataclass
+class DeviceRecord:
+    device: str
+    addr: int
+    length: int
+    erase_size: int
+    image: str = ""
+    sectors: list = field(default_factory=list)
+
+    # Offset and length into the image data of sector i.
+    def sector_range(self, i: int):
+        start = i * self.erase_size
+        return start, min(self.erase_size, self.length - start)
+
+
+# Host side registry of the images on the devices this machine flashed, one small JSON file per device, so that
+# re-flashing a known device only has to erase and write the sectors that changed, instead of querying the CRC of
+# every sector first. A record is only trusted after a few of its sectors were checked against the device.
+class DeviceRegistry:
+    def __init__(self, registry_dir: str = REGISTRY_DIR, spot_checks: int = DEFAULT_SPOT_CHECKS):
+        self.registry_dir = registry_dir
+        self.spot_checks = spot_checks
+
+    def _path(self, device: str) -> str:
+        return os.path.join(self.registry_dir, hashlib.sha256(device.encode()).hexdigest()[:24] + ".json")
+
+    # The record of a device, or None if there is none that can be read.
+    def lookup(self, device: str):
+        path = self._path(device)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                record = DeviceRecord(**json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            debug("Ignoring unreadable device record %s: %s", path, e)
+            return None
+        if record.device != device:
+            return None
+        return record
+
+    def save(self, record: DeviceRecord):
+        os.makedirs(self.registry_dir, exist_ok=True)
+        path = self._path(record.device)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(asdict(record), f)
+        # Atomic, like the journal: a kill during the save never leaves a half written record behind.
+        os.replace(tmp_path, path)
+
+    def forget(self, device: str):
+        path = self._path(device)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Records that data (at addr) is now completely on the device.
+    def store(self, device: str, addr: int, data: bytes, erase_size: int, crcs: list = None):
+        self.save(DeviceRecord(device, addr, len(data), erase_size, image_hash(addr, data),
+                               crcs if crcs is not None else sector_crcs(data, erase_size)))
+
+    # Indices of the sectors of the new image data that differ from the record, or have to be assumed to.
+    @staticmethod
+    def changed_sectors(record: DeviceRecord, crcs: list) -> list:
+        return [i for i, crc in enumerate(crcs) if i >= len(record.sectors) or record.sectors[i] != crc]
+
+    # Sectors to verify on the device before trusting the record: a few of the ones that would be left as they are.
+    def spot_check_sectors(self, record: DeviceRecord, changed: list, count: int) -> list:
+        changed = set(changed)
+        unchanged = [i for i in range(min(count, len(record.sectors))) if i not in changed]
+        return sorted(random.sample(unchanged, min(self.spot_checks, len(unchanged))))
@@ -0,0 +1,66 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+TRACE_PID: int = 1
+
+
+# One row in the trace viewer: the host side work, or one device in a fleet run.
+class TraceTrack:
+    def __init__(self, recorder, tid: int, name: str):
+        self._recorder = recorder
+        self.tid = tid
+        self.name = name
+
+    # Records a span between two time.perf_counter() values.
+    def complete(self, name: str, start: float, end: float, **args):
+        t0 = self._recorder.t0
+        event = {"name": name, "ph": "X", "pid": TRACE_PID, "tid": self.tid,
+                 "ts": (start - t0) * 1e6, "dur": (end - start) * 1e6}
+        if args:
+            event["args"] = args
+        self._recorder.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.perf_counter(), **args)
+
+
+# Collects the spans of a flash session and writes them as a Chrome trace-event JSON file, which opens in
+# chrome://tracing or Perfetto. Events are only appended to a list while flashing, the file is written at the end.
+class TraceRecorder:
+    def __init__(self, path: str):
+        self.path = path
+        self.t0 = time.perf_counter()
+        self.events = list()
+        self._lock = threading.Lock()
+        self._tracks = dict()
+
+    # Returns the track with this name, creating it on first use.
+    def track(self, name: str) -> TraceTrack:
+        with self._lock:
+            track = self._tracks.get(name)
+            if track is None:
+                track = self._tracks[name] = TraceTrack(self, len(self._tracks), name)
+                self.events.append({"name": "thread_name", "ph": "M", "pid": TRACE_PID, "tid": track.tid,
+                                    "args": {"name": name}})
+            return track
+
+    def write(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        os.replace(tmp_path, self.path)
+
+
+# Span on the given track, or nothing when tracing is off.
+def span(track: TraceTrack, name: str, **args):
+    if track is None:
+        return contextlib.nullcontext()
+    return track.span(name, **args)
@@ -0,0 +1,101 @@
+import time
+import serial
+from dataclasses import dataclass, replace
+from flasher.util import debug, puts
+from flasher.bootloader_protocol import Protocol_RP2040
+from flasher.link import LinkProfile, open_link, save_profile
+
+CANDIDATE_BAUDRATES: list = [115200, 230400, 460800, 921600, 1000000, 1500000, 2000000, 3000000]
+RTT_ROUNDS: int = 10
+READ_ROUNDS: int = 8
+
+
+@dataclass
+class LinkMeasurement:
+    profile: LinkProfile
+    rtt: float  # seconds, median SYNC round trip
+    throughput: float  # bytes/s, sustained READ payload rate
+
+
+# Returns the median round trip time of a SYNC on an open blocking connection, or None when the bootloader doesn't
+# answer every SYNC.
+def measure_rtt(conn, rounds: int = RTT_ROUNDS):
+    opcodes = Protocol_RP2040.Opcodes
+    rtts = list()
+    for _ in range(rounds):
+        t_start = time.perf_counter()
+        conn.write(opcodes['Sync'])
+        response = conn.read(len(opcodes['ResponseSync']))
+        if response not in (opcodes['ResponseSync'], opcodes['ResponseSyncWota']):
+            return None
+        rtts.append(time.perf_counter() - t_start)
+    rtts.sort()
+    return rtts[len(rtts) // 2]
+
+
+# Measures one profile: the median round trip of a few SYNCs, then the payload rate of back to back READs of
+# max_data_len bytes from the start of flash. Returns None when the device doesn't answer reliably with this profile
+# (for example because the bootloader UART runs at another baud rate).
+def measure_link(port: str, profile: LinkProfile, rtt_rounds: int = RTT_ROUNDS, read_rounds: int = READ_ROUNDS):
+    try:
+        conn = open_link(port, profile)
+    except (ValueError, serial.SerialException) as e:
+        debug("Could not open %s with %s: %s", port, profile, e)
+        return None
+
+    protocol = Protocol_RP2040(exit_on_error=False)
+    protocol.wait_time_before_read = 0
+    try:
+        conn.reset_input_buffer()
+        rtt = measure_rtt(conn, rtt_rounds)
+        if rtt is None:
+            debug("No sync at %s baud.", profile.baudrate)
+            return None
+
+        info = protocol.info_cmd(conn)
+        t_start = time.perf_counter()
+        for i in range(read_rounds):
+            if protocol.read_cmd(conn, info.flash_addr, info.max_data_len) is None:
+                debug("READ failed at %s baud.", profile.baudrate)
+                return None
+        elapsed = time.perf_counter() - t_start
+        return LinkMeasurement(profile, rtt, (read_rounds * info.max_data_len) / elapsed)
+    except serial.SerialException as e:
+        debug("Measuring %s failed: %s", port, e)
+        return None
+    finally:
+        conn.close()
+
+
+# Tries every candidate baud rate, with and without low latency mode, keeps the profile with the highest READ
+# throughput (ties broken by round trip time) and saves it for the adapter behind the port.
+def tune_link(port: str, base: LinkProfile = None, baudrates: list = None, save: bool = True):
+    if base is None:
+        base = LinkProfile()
+    if baudrates is None:
+        baudrates = CANDIDATE_BAUDRATES
+    latency_modes = (False, True)
+    if port.startswith("tcp:"):
+        # Baud rate and latency timer mean nothing on a TCP bridge, only measure it once
+        baudrates = [base.baudrate]
+        latency_modes = (False,)
+
+    results = list()
+    for baudrate in baudrates:
+        for low_latency in latency_modes:
+            result = measure_link(port, replace(base, baudrate=baudrate, low_latency=low_latency))
+            if result is None:
+                continue
+            puts("%8d baud, low latency %-5s: round trip %6.2f ms, %8.0f bytes/s"
+                 % (baudrate, low_latency, result.rtt * 1000, result.throughput))
+            results.append(result)
+
+    if len(results) == 0:
+        puts("No working link profile found for " + port + ".")
+        return None
+
+    best = max(results, key=lambda r: (r.throughput, -r.rtt))
+    puts("Best profile: " + str(best.profile))
+    if save:
+        save_profile(port, best.profile)
+    return best.profile
@@ -1,29 +1,92 @@
-# Returns flasher usage message.
+import os
+import sys
 import struct
 import zlib
+import logging
+
+# Host side state that should survive a run (journals, caches) is kept under this directory.
+CACHE_DIR: str = os.path.join(os.path.expanduser("~"), ".cache", "pico-py-serial-flash")
+
 
+# Returns flasher usage message.
 def usage_flasher():
-    return str("Usage: main.py port filepath [BASE_ADDR] \nFor example: main.py /dev/ttyUSB0 ~/pico/test.elf")
+    return str("Usage: main.py port filepath [BASE_ADDR] \nFor example: main.py /dev/ttyUSB0 ~/pico/test.elf"
+               "\nA .delta bundle made with make_delta.py can be given instead of an ELF file, to upgrade devices "
+               "that hold the release it was made from. A .json manifest flashes several images in one session "
+               "(see flasher/manifest.py)."
+               "\nUse 'auto' as port to flash every serial port with a bootloader on it, or run main.py auto "
+               "to only list them. --ports=GLOB limits 'auto' to matching ports, device files included."
+               "\nOptions: --retries=N (retries per failed erase/write/seal, default 3), "
+               "--backoff=SECONDS (wait before the first retry, doubled after every retry, default 0.05), "
+               "--no-journal (don't keep or resume from a progress journal), "
+               "--no-registry (don't only write the sectors that changed since the last flash of the device), "
+               "--capture=FILE (record all traffic with timestamps, one file per port in fleet mode), "
+               "--metrics-json=FILE, --metrics-prom=FILE (per command latency report, as JSON or Prometheus textfile), "
+               "--trace=FILE (timeline of the session in Chrome trace-event format), "
+               "--progress or --progress=json (progress bar with throughput and ETA, or JSON lines), "
+               "--watch (stay connected and flash the sectors that changed whenever the ELF file is rebuilt)"
+               "\nLink options: --baud=N, --rtscts, --xonxoff, --rx-buffer=BYTES, --tx-buffer=BYTES, --low-latency, "
+               "--timeout=SECONDS (read timeout, 0 for non-blocking reads)"
+               "\nRun main.py port --tune to measure the link at several baud rates and save the best profile "
+               "for the adapter. Saved profiles are used automatically."
+               "\nPipeline options: --window=N (WRIT frames in flight), --erase-batch=N (sectors per ERAS). "
+               "Run main.py port --tune-pipeline to calibrate and save them for the link (erases the application)."
+               "\nOutput: --log-level=debug|info|warning|error|quiet (default info)")
+
+
+# All output goes through one logger. User messages (puts) are logged at INFO, debugging output at DEBUG,
+# which is off unless set_log_level("debug") is called.
+_logger = logging.getLogger("flasher")
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter("%(message)s"))
+_logger.addHandler(_handler)
+_logger.setLevel(logging.INFO)
+_logger.propagate = False
+
+LOG_LEVELS: dict = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "quiet": logging.CRITICAL + 1,
+}
+
+
+# Sets how much output is printed, one of the LOG_LEVELS names.
+def set_log_level(level: str):
+    _logger.setLevel(LOG_LEVELS[level.lower()])
+
+
+# For guarding debug output whose arguments are expensive to compute (conversions of whole buffers).
+def debug_enabled() -> bool:
+    return _logger.isEnabledFor(logging.DEBUG)
 
 
 # Wrapper function to be able to easily disable/alter all debugging string output.
-def debug(self, *args):
-    print(self, *args, sep=' ', end='\n', file=None)
-    pass
+# Formatting is lazy, use debug("Response: %s", response) instead of building the string at the call site, so a
+# disabled debug() costs no more than a function call.
+def debug(msg, *args):
+    _logger.debug(msg, *args)
 
 
 # Wrapper function to be able to easily disable/alter all user string output.
-def puts(self, *args):
-    print(self, *args, sep=' ', end='\n', file=None)
+def puts(msg, *args):
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info(" ".join(str(a) for a in (msg,) + args))
+
+
+# For problems the user should see even when the normal progress messages are turned off.
+def warn(msg, *args):
+    _logger.warning(msg, *args)
 
 
-# Wrapper function to easily change behaviour before exiting program.
-def exit_prog(before_flash: bool = True):
+# Wrapper function to easily change behaviour before exiting program. status is the exit status, None for 0.
+def exit_prog(before_flash: bool = True, status: int = None):
     if before_flash:
         puts("Program was exited before flashing the target device.")
     else:
         puts("Program has exited after/during flash. Be careful, flash might be damaged.")
-    exit()
+    exit(status)
 
 
 def hex_bytes_to_int(hex_bytes: bytes) -> []:
@@ -66,7 +129,9 @@ def printProgressBar(iteration, total, prefix='', suffix='', decimals=1, length=
     percent = ("{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
     filledLength = int(length * iteration // total)
     bar = fill * filledLength + '-' * (length - filledLength)
-    puts(f'\r{prefix} |{bar}| {percent}% {suffix}')
-    # Print New Line on Complete
-    if iteration == total:
-        puts("")
+    # Written directly instead of through the logger, which would end every redraw with a new line
+    if _logger.isEnabledFor(logging.INFO):
+        print(f'\r{prefix} |{bar}| {percent}% {suffix}', end=print_end, flush=True)
+        # Print New Line on Complete
+        if iteration == total:
+            print()
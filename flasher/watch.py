@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+from elftools.common.exceptions import ELFError
+from flasher.util import debug, puts
+from flasher.elf import load_elf
+from flasher.program import Program, RetryPolicy, PipelineSettings
+from flasher.bootloader_protocol import Protocol_RP2040
+from flasher.registry import DeviceRegistry
+
+# Watch mode: keeps the port open, and every time the ELF file is rebuilt flashes the sectors that changed and starts
+# the application. Which sectors changed is found with the registry (see flasher/registry.py), against the image this
+# session flashed last. The file is watched with inotify on Linux, and by polling its modification time elsewhere.
+# After GO the bootloader is gone, so before every flash the device has to be back in the bootloader: the application
+# can reboot into it, or the board is reset into it by hand. Until then the flasher keeps sending SYNC.
+
+SETTLE_TIME: float = 0.2  # seconds the file has to be left alone after a write before it is loaded
+POLL_INTERVAL: float = 0.2  # seconds, without inotify
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+_INOTIFY_EVENT = struct.Struct('iIII')  # wd, mask, cookie, length of the name that follows
+
+
+# inotify on a directory, through libc. Linkers usually replace the output file instead of writing into it, so the
+# directory is watched and not the file itself.
+class _Inotify:
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed on " + directory)
+
+    # Names of the files in the directory that changed, waiting at most timeout seconds (None for no limit) for the
+    # first one. Empty when nothing changed in time.
+    def changed(self, timeout: float = None) -> set:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        buf = os.read(self.fd, 1 << 16)
+        names = set()
+        pos = 0
+        while pos < len(buf):
+            _, _, _, length = _INOTIFY_EVENT.unpack_from(buf, pos)
+            pos += _INOTIFY_EVENT.size
+            names.add(buf[pos:pos + length].rstrip(b'\0'))
+            pos += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        self._name = os.fsencode(os.path.basename(self.path))
+        self._inotify = None
+        if sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify(os.path.dirname(self.path))
+            except (OSError, AttributeError) as e:
+                debug("No inotify, polling %s instead: %s", self.path, e)
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    # Blocks until the file was written and then left alone for SETTLE_TIME.
+    def wait(self):
+        if self._inotify is not None:
+            while self._name not in self._inotify.changed():
+                pass
+            while self._name in self._inotify.changed(SETTLE_TIME):
+                pass
+            return
+        stamp = self._stamp()
+        while self._stamp() == stamp:
+            time.sleep(POLL_INTERVAL)
+        stamp = None
+        while self._stamp() != stamp:
+            stamp = self._stamp()
+            time.sleep(SETTLE_TIME)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+# Sends SYNC until the bootloader on conn answers.
+def _wait_for_bootloader(conn):
+    protocol = Protocol_RP2040(exit_on_error=False)
+    protocol.MAX_SYNC_ATTEMPTS = 1
+    if getattr(conn, 'timeout', None):
+        protocol.wait_time_before_read = 0
+    if protocol.sync_cmd(conn, flush=True):
+        return
+    puts("Waiting for the device to return to the bootloader (reboot the application into it or reset the board).")
+    while not protocol.sync_cmd(conn, flush=True):
+        time.sleep(POLL_INTERVAL)
+
+
+# Flashes the ELF file at elf_path to the device on conn, and again after every rebuild, until interrupted with Ctrl+C.
+# registry holds what the device was flashed with, so that every rebuild only costs the sectors that changed.
+def watch_and_flash(conn, elf_path: str, registry: DeviceRegistry, retry: RetryPolicy = None, device_id: str = None,
+                    pipeline: PipelineSettings = None, progress_bar=None):
+    watcher = FileWatcher(elf_path)
+    flashed = None
+    try:
+        while True:
+            image = None
+            try:
+                image = load_elf(elf_path)
+            except (SystemExit, ELFError, ValueError, IndexError, struct.error) as e:
+                # A build that failed, or is still being written
+                puts("Could not load " + elf_path + ": " + str(e))
+            if image is not None and flashed is not None and image == flashed:
+                puts("Image unchanged, nothing to flash.")
+            elif image is not None:
+                _wait_for_bootloader(conn)
+                start = time.perf_counter()
+                try:
+                    Program(conn, image, progress_bar, retry, use_journal=False, device_id=device_id,
+                            pipeline=pipeline, registry=registry)
+                    flashed = image
+                    puts("Flashed in %.2fs." % (time.perf_counter() - start))
+                except SystemExit:
+                    puts("Flashing failed.")
+            puts("Watching " + elf_path + " for rebuilds, Ctrl+C to stop.")
+            watcher.wait()
+    except KeyboardInterrupt:
+        puts("Stopped watching.")
+    finally:
+        watcher.close()
@@ -0,0 +1,253 @@
+import struct
+import asyncio
+import binascii
+from flasher.util import debug
+from flasher_simulated.device_timing import DeviceTiming, FaultInjection
+from flasher_simulated.flash_model import SparseFlash
+
+# The simulated RP2040 bootloader (https://github.com/usedbytes/rp2040-serial-bootloader) behind an asyncio stream.
+# Everything the host sends collects in one receive buffer: SYNC is searched for in it with bytes.find(), opcodes and
+# arguments are unpacked from it in place and payloads are handed to the commands as memoryviews into it. Commands are
+# looked up by opcode in a dict. Only the link and flash timing (see device_timing.py) slow the device down, so without
+# it one device answers far faster than any real link could carry.
+
+HEADER_OFFSET: int = 28 * 1024  # the bootloader's own image and the header of the application before it
+SECTOR_SIZE: int = 1 << 12
+PAGE_SIZE: int = 1 << 8
+RECV_SIZE: int = 1 << 16  # bytes asked from the stream per read
+
+_U32 = struct.Struct('<I')
+_NO_ARGS = struct.Struct('<')
+_ARGS_1 = _U32
+_ARGS_2 = struct.Struct('<II')
+_ARGS_3 = struct.Struct('<III')
+
+
+def _opcode(name: bytes) -> int:
+    return _U32.unpack(name)[0]
+
+
+OP_SYNC = _opcode(b'SYNC')
+OP_READ = _opcode(b'READ')
+OP_CRCC = _opcode(b'CRCC')
+OP_ERAS = _opcode(b'ERAS')
+OP_WRIT = _opcode(b'WRIT')
+OP_SEAL = _opcode(b'SEAL')
+OP_INFO = _opcode(b'INFO')
+OP_GOGO = _opcode(b'GOGO')
+
+RSP_SYNC: bytes = b'PICO'
+RSP_OK: bytes = b'OKOK'
+RSP_ERR: bytes = b'ERR!'
+
+
+class SimulatedBootloader:
+    def __init__(self, timing: DeviceTiming = None, faults: FaultInjection = None, max_data_len: int = 1024,
+                 flash_memory: SparseFlash = None):
+        self.timing = timing if timing is not None else DeviceTiming()
+        self.faults = faults
+        self.max_data_len = max_data_len
+        self.flash = flash_memory if flash_memory is not None else SparseFlash()  # 16MB flash, erased
+        self.write_addr_min = self.flash.base + HEADER_OFFSET + SECTOR_SIZE
+        self._byte_time = self.timing.byte_time()
+        # Whether commands may fail or keep the flash busy, and whether responses go out without any delay
+        self._delayed = faults is not None or bool(self.timing.sector_erase_time or self.timing.page_program_time)
+        self._instant = faults is None and not (self._byte_time or self.timing.latency or self.timing.latency_timer)
+        # Time each direction of the link is busy until, see _throttle()
+        self._link_busy = {'rx': 0.0, 'tx': 0.0}
+        self._rx = bytearray()
+        self._pos = 0  # start of the bytes in _rx not yet consumed
+        self._reader = None
+        self._writer = None
+        # opcode -> (arguments, payload length from the arguments or None, command)
+        self._commands = {
+            OP_SYNC: (_NO_ARGS, None, self._sync),
+            OP_READ: (_ARGS_2, None, self._read),
+            OP_CRCC: (_ARGS_2, None, self._crc),
+            OP_ERAS: (_ARGS_2, None, self._erase),
+            OP_WRIT: (_ARGS_2, self._write_size, self._write),
+            OP_SEAL: (_ARGS_3, None, self._seal),
+            OP_INFO: (_NO_ARGS, None, self._info),
+            OP_GOGO: (_ARGS_1, None, self._ok),
+        }
+
+    # Serves one host connection until GOGO or until the host disconnects.
+    async def serve(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await self._wait_for_sync()
+                if await self._run_commands():
+                    # The application would start now, the bootloader is gone
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            debug("Host disconnected from the simulated device.")
+        writer.close()
+
+    # Reads from the stream until at least n unconsumed bytes are buffered.
+    async def _fill(self, n: int):
+        if self._pos:
+            del self._rx[:self._pos]
+            self._pos = 0
+        while len(self._rx) < n:
+            data = await self._reader.read(RECV_SIZE)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(self._rx), n)
+            self._rx += data
+
+    # Consumes n buffered bytes, as far as the link is concerned they arrive now.
+    async def _consume(self, n: int):
+        self._pos += n
+        if self._byte_time:
+            await self._throttle('rx', n)
+
+    # Transfers are accounted for and only slept off once the link is more than a millisecond ahead, a sleep per
+    # transfer would be far slower than the link itself.
+    async def _throttle(self, direction: str, length: int):
+        now = self._loop.time()
+        busy = self._link_busy[direction] = max(self._link_busy[direction], now) + length * self._byte_time
+        if busy - now > 0.001:
+            await asyncio.sleep(busy - now)
+
+    async def _send(self, data: bytes):
+        if self.faults is not None:
+            data = self.faults.drop(data)
+        delay = self.timing.latency + self.timing.adapter_delay(self._loop.time(), len(data))
+        if delay:
+            await asyncio.sleep(delay)
+        if self._byte_time:
+            await self._throttle('tx', len(data))
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _wait_for_sync(self):
+        while True:
+            found = self._rx.find(b'SYNC', self._pos)
+            if found >= 0:
+                await self._consume(found + 4 - self._pos)
+                break
+            # Keep the last bytes, they may be the start of a SYNC the next read completes
+            keep = max(self._pos, len(self._rx) - 3)
+            if self._byte_time:
+                await self._throttle('rx', keep - self._pos)
+            self._pos = keep
+            await self._fill(len(self._rx) - self._pos + 1)
+        await self._send(RSP_SYNC)
+
+    # Runs commands until an error, which sends the device back to waiting for SYNC (returns False), or GOGO (True).
+    # A frame that is buffered completely is parsed without awaiting anything, only a short buffer, the link and flash
+    # timing and injected faults cost a trip through the event loop.
+    async def _run_commands(self) -> bool:
+        rx = self._rx
+        commands = self._commands
+        while True:
+            if len(rx) - self._pos < 4:
+                await self._fill(4)
+            opcode = _U32.unpack_from(rx, self._pos)[0]
+            command = commands.get(opcode)
+            if command is None:
+                await self._consume(4)
+                await self._send(RSP_ERR)
+                return False
+            arg_struct, size, handle = command
+            head = 4 + arg_struct.size
+            if len(rx) - self._pos < head:
+                await self._fill(head)
+            args = arg_struct.unpack_from(rx, self._pos + 4)
+            data_len = size(args) if size is not None else 0
+            if data_len is None:
+                await self._consume(head)
+                await self._send(RSP_ERR)
+                return False
+            if len(rx) - self._pos < head + data_len:
+                await self._fill(head + data_len)
+            start = self._pos + head
+            await self._consume(head + data_len)
+            if self._delayed and not await self._busy(opcode, args, data_len):
+                await self._send(RSP_ERR)
+                return False
+            with memoryview(rx) as view, view[start:start + data_len] as data:
+                if self.faults is not None and opcode == OP_WRIT:
+                    response = handle(args, self.faults.corrupt(bytes(data)))
+                else:
+                    response = handle(args, data)
+            if response is None:
+                await self._send(RSP_ERR)
+                return False
+            if self._instant:
+                self._writer.write(response)
+                await self._writer.drain()
+            else:
+                await self._send(response)
+            if opcode == OP_GOGO:
+                return True
+
+    # Injected ERR! answers and the time the flash keeps the device busy. False if the command fails.
+    async def _busy(self, opcode: int, args, data_len: int) -> bool:
+        if self.faults is not None and opcode != OP_SYNC and self.faults.hit(self.faults.err_rate):
+            return False
+        if opcode == OP_ERAS:
+            busy = self.timing.busy_time(b'ERAS', args[1])
+        elif opcode == OP_WRIT:
+            busy = self.timing.busy_time(b'WRIT', data_len)
+        else:
+            busy = 0.0
+        if busy:
+            await asyncio.sleep(busy)
+        return True
+
+    # Like the real bootloader, the device only erases and writes past its own image
+    def _writable(self, addr: int, length: int) -> bool:
+        return addr >= self.write_addr_min and self.flash.contains(addr, length)
+
+    def _sync(self, args, data):
+        return RSP_SYNC
+
+    def _ok(self, args, data):
+        return RSP_OK
+
+    def _read(self, args, data):
+        if not self.flash.contains(args[0], args[1]):
+            return None
+        return RSP_OK + self.flash.read(args[0], args[1])
+
+    def _crc(self, args, data):
+        if not self.flash.contains(args[0], args[1]):
+            return None
+        return RSP_OK + _U32.pack(binascii.crc32(self.flash.read(args[0], args[1])))
+
+    def _erase(self, args, data):
+        addr, length = args
+        if not self._writable(addr, length) or addr % SECTOR_SIZE or length % SECTOR_SIZE:
+            return None
+        self.flash.erase(addr, length)
+        return RSP_OK
+
+    def _write_size(self, args):
+        return args[1] if self._writable(args[0], args[1]) and args[1] <= self.max_data_len else None
+
+    # Like the real bootloader, the CRC is of the flash as programmed, not of the data received: data written over
+    # cells that weren't erased comes back different.
+    def _write(self, args, data):
+        self.flash.program(args[0], data)
+        return RSP_OK + _U32.pack(binascii.crc32(self.flash.read(args[0], args[1])))
+
+    # The CRC given with SEAL has to match the application in flash, or the image isn't sealed. The CRC is taken a
+    # sector at a time, without a copy of the whole image.
+    def _seal(self, args, data):
+        addr, length, crc = args
+        if not self.flash.contains(addr, length):
+            return None
+        flash_crc = 0
+        for start in range(addr, addr + length, SECTOR_SIZE):
+            flash_crc = binascii.crc32(self.flash.read(start, min(SECTOR_SIZE, addr + length - start)), flash_crc)
+        if flash_crc != crc:
+            return None
+        return RSP_OK
+
+    def _info(self, args, data):
+        flash_end = self.flash.base + len(self.flash)
+        return RSP_OK + struct.pack('<5I', self.write_addr_min, flash_end - self.write_addr_min, SECTOR_SIZE,
+                                    PAGE_SIZE, self.max_data_len)
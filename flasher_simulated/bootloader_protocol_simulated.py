@@ -3,7 +3,8 @@ import asyncio
 import serial_asyncio
 import serial
 import binascii
-from dataclasses import dataclass, field
+from dataclasses import dataclass
+from flasher.capture import TrafficCapture
 from flasher_simulated.util import debug, puts, exit_prog, hex_bytes_to_int, bytes_to_little_end_uint32, little_end_uint32_to_bytes
 
 
@@ -22,51 +23,8 @@ class Protocol_RP2040:
     has_sync: bool = False
     wait_time_before_read: float = 0.05  # seconds
 
-    plc_output_bin: str = field(default="plc_output.bin")
-    plc_output_txt: str = field(default="plc_output.txt")
-    
-    device_output_bin: str = field(default="device_output.bin")
-    device_output_txt: str = field(default="device_output.txt")
-
-    plc_device_output_bin: str = field(default="plc_device_output.bin")
-    plc_device_output_txt: str = field(default="plc_device_output.txt")
-
-    def __post_init__(self):
-        self.plc_bin = open(self.plc_output_bin, 'wb')  # Open the file in binary mode
-        self.plc_txt = open(self.plc_output_txt, 'w')  # Open the file in binary mode
-        self.device_bin = open(self.device_output_bin, 'wb')  # Open the file in binary mode
-        self.device_txt = open(self.device_output_txt, 'w')  # Open the file in binary mode
-        self.plc_device_bin = open(self.plc_device_output_bin, 'wb')  # Open the file in binary mode
-        self.plc_device_txt = open(self.plc_device_output_txt, 'w')  # Open the file in binary mode
-
-
-    def __del__(self):
-        if self.plc_bin:
-            self.plc_bin.close()
-        if self.plc_txt:
-            self.plc_txt.close()
-        if self.device_bin:
-            self.device_bin.close()
-        if self.device_txt:
-            self.device_txt.close()
-        if self.plc_device_bin:
-            self.plc_device_bin.close()
-        if self.plc_device_txt:
-            self.plc_device_txt.close()
-
-    def log_device_plc_output(self, message: bytes):
-        self.plc_device_bin.write(message + b"\n")
-        self.plc_device_txt.write(str(message) + "\n")
-
-    def log_plc_output(self, message: bytes):
-        self.log_device_plc_output(message)
-        self.plc_bin.write(message + b"\n")
-        self.plc_txt.write(str(message) + "\n")
-
-    def log_device_output(self, message: bytes):
-        self.log_device_plc_output(message)
-        self.device_bin.write(message + b"\n")
-        self.device_txt.write(str(message) + "\n")
+    # Opt-in traffic capture (see flasher/capture.py). None means frames are not recorded at all.
+    capture: TrafficCapture = None
 
     Opcodes = {
         'Sync': b'SYNC',
@@ -86,7 +44,7 @@ class Protocol_RP2040:
 
     async def read_bootloader_resp(self, reader, response_len: int, exit_before_flash=True) -> (bytes, bytes):
         await asyncio.sleep(self.wait_time_before_read)
-        debug("Start blocking code reponse length is hit. Resp_len: " + str(response_len))
+        debug("Start blocking code reponse length is hit. Resp_len: %s", response_len)
         all_bytes = await reader.read(response_len)
         err_byte = all_bytes.removeprefix(self.Opcodes["ResponseErr"])
         data_bytes = bytes()
@@ -97,17 +55,18 @@ class Protocol_RP2040:
             puts("Error encoutered in RPi Pico! Please POR your Pico and try again.")
             exit_prog(exit_before_flash)
 
-        debug("Complete Buff: " + str(all_bytes))
-        debug("Data buff: " + str(data_bytes))
-        debug("Len Data buff: " + str(len(data_bytes)))
+        debug("Complete Buff: %s", all_bytes)
+        debug("Data buff: %s", data_bytes)
+        debug("Len Data buff: %s", len(data_bytes))
         return all_bytes, data_bytes
 
     async def sync_cmd(self, reader, writer) -> bool:
         for i in range(1, self.MAX_SYNC_ATTEMPTS + 1):
             response = bytes()
             try:
-                debug("Starting sync command by sending: " + str(self.Opcodes["Sync"]))
-                self.log_plc_output(self.Opcodes["Sync"])
+                debug("Starting sync command by sending: %s", self.Opcodes['Sync'])
+                if self.capture is not None:
+                    self.capture.host(self.Opcodes["Sync"])
                 writer.write(self.Opcodes["Sync"])
                 await writer.drain()
 
@@ -115,8 +74,9 @@ class Protocol_RP2040:
                 debug("Have send Sync command, start reading response")
                 response = await reader.read(4)
 
-                debug("Whole response has arrived: " + str(response))
-                self.log_device_output(response)
+                debug("Whole response has arrived: %s", response)
+                if self.capture is not None:
+                    self.capture.device(response)
                 if response == self.Opcodes["ResponseSync"]:
                     puts("Found a Pico device who responded to sync.")
                     self.has_sync = True
@@ -132,17 +92,19 @@ class Protocol_RP2040:
         expected_len = len(self.Opcodes['ResponseOK']) + (4 * 5)
         writer.write(self.Opcodes["Info"])
         await writer.drain()
-        self.log_plc_output(self.Opcodes["Info"])
-        debug("Written following bytes to Pico: " + str(self.Opcodes["Info"]))
+        if self.capture is not None:
+            self.capture.host(self.Opcodes["Info"])
+        debug("Written following bytes to Pico: %s", self.Opcodes['Info'])
         all_bytes, resp_ok_bytes = await self.read_bootloader_resp(reader, expected_len, True)
-        self.log_device_output(all_bytes)
+        if self.capture is not None:
+            self.capture.device(all_bytes)
         decoded_arr = []
         if len(resp_ok_bytes) <= 0:
             puts("Something went horribly wrong. Please POR and retry.")
             exit_prog(True)
         else:
             decoded_arr = hex_bytes_to_int(resp_ok_bytes)
-            debug("Decoded data array: " + str(decoded_arr))
+            debug("Decoded data array: %s", decoded_arr)
 
         flash_addr = bytes_to_little_end_uint32(resp_ok_bytes)
         flash_size = bytes_to_little_end_uint32(resp_ok_bytes[4:])
@@ -151,11 +113,11 @@ class Protocol_RP2040:
         max_data_len = bytes_to_little_end_uint32(resp_ok_bytes[16:])
         this_pico_info = PicoInfo(flash_addr, flash_size, erase_size, write_size, max_data_len)
 
-        debug("flash_addr: " + str(flash_addr))
-        debug("flash_size: " + str(flash_size))
-        debug("erase_size: " + str(erase_size))
-        debug("write_size: " + str(write_size))
-        debug("max_data_len: " + str(max_data_len))
+        debug("flash_addr: %s", flash_addr)
+        debug("flash_size: %s", flash_size)
+        debug("erase_size: %s", erase_size)
+        debug("write_size: %s", write_size)
+        debug("max_data_len: %s", max_data_len)
 
         return this_pico_info
 
@@ -171,12 +133,14 @@ class Protocol_RP2040:
             write_buff += b
         writer.write(write_buff)
         await writer.drain()
-        self.log_plc_output(write_buff)
-        debug("Number of bytes written: " + str(len(write_buff)))
+        if self.capture is not None:
+            self.capture.host(write_buff)
+        debug("Number of bytes written: %s", len(write_buff))
         await asyncio.sleep(self.wait_time_before_read)
         all_bytes, resp_ok_bytes = await self.read_bootloader_resp(reader, len(self.Opcodes['ResponseOK']), True)
-        self.log_device_output(all_bytes)
-        debug("Erased a length of bytes, response is: " + str(all_bytes))
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        debug("Erased a length of bytes, response is: %s", all_bytes)
         if all_bytes != self.Opcodes['ResponseOK']:
             return False
         return True
@@ -195,12 +159,14 @@ class Protocol_RP2040:
         write_buff += data
         writer.write(write_buff)
         await writer.drain()
-        self.log_plc_output(write_buff)
-        debug("Number of bytes written: " + str(len(write_buff)))
+        if self.capture is not None:
+            self.capture.host(write_buff)
+        debug("Number of bytes written: %s", len(write_buff))
         await asyncio.sleep(self.wait_time_before_read)
         all_bytes, data_bytes = await self.read_bootloader_resp(reader, len(self.Opcodes['ResponseOK']) + 4, True)
-        self.log_device_output(all_bytes)
-        debug("All bytes return from read: " + str(all_bytes))
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        debug("All bytes return from read: %s", all_bytes)
         resp_crc = bytes_to_little_end_uint32(data_bytes)
         calc_crc = binascii.crc32(data)
 
@@ -225,12 +191,14 @@ class Protocol_RP2040:
         wr_buff_read = hex_bytes_to_int(write_buff)
         writer.write(write_buff)
         await writer.drain()
-        self.log_plc_output(write_buff)
-        debug("Number of bytes written: " + str(len(write_buff)))
+        if self.capture is not None:
+            self.capture.host(write_buff)
+        debug("Number of bytes written: %s", len(write_buff))
         await asyncio.sleep(self.wait_time_before_read)
         all_bytes, data_bytes = await self.read_bootloader_resp(reader, len(self.Opcodes['ResponseOK']), False)
-        self.log_device_output(all_bytes)
-        debug("All bytes seal: " + str(all_bytes))
+        if self.capture is not None:
+            self.capture.device(all_bytes)
+        debug("All bytes seal: %s", all_bytes)
         if all_bytes[:4] != self.Opcodes['ResponseOK']:
             return False
         return True
@@ -245,7 +213,8 @@ class Protocol_RP2040:
             b = bytes(missing_bits)
             write_buff += b
         write_readable = hex_bytes_to_int(write_buff)
-        self.log_plc_output(write_buff)
+        if self.capture is not None:
+            self.capture.host(write_buff)
         writer.write(write_buff)
         await writer.drain()
         debug("Go.")
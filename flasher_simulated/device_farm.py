@@ -0,0 +1,175 @@
+import os
+import sys
+import tty
+import signal
+import asyncio
+import argparse
+from flasher.util import puts, debug
+from flasher_simulated.device_timing import DeviceTiming, TIMING_PROFILES
+from flasher_simulated.flash_model import SparseFlash
+
+# Many simulated bootloaders in one process, each behind a pseudo terminal, so the unmodified pyserial path of main.py
+# opens them like real serial ports. Every device keeps its own flash contents and timing, and after a session ends
+# (GOGO) it starts over in the bootloader, ready for the next flash. Linux and macOS only (pty).
+#   python -m flasher_simulated.device_farm --count=100 --timing=usb-cdc
+#   python main.py auto image.elf --ports='/tmp/pico-farm/ttyPICO*'
+
+DEFAULT_FARM_DIR: str = "/tmp/pico-farm"
+
+
+# StreamWriter stand-in for the pty master. Writes never block the event loop all devices share: what the pty
+# doesn't take right away is sent once it is writable again. It outlives the sessions, so close() only ends a session.
+class _PtyWriter:
+    def __init__(self, loop: asyncio.AbstractEventLoop, fd: int):
+        self._loop = loop
+        self._fd = fd
+        self._pending = bytearray()
+
+    def write(self, data):
+        if not self._pending:
+            try:
+                n = os.write(self._fd, data)
+            except BlockingIOError:
+                n = 0
+            data = data[n:]
+            if not data:
+                return
+            self._loop.add_writer(self._fd, self._flush)
+        self._pending += data
+
+    def _flush(self):
+        try:
+            n = os.write(self._fd, self._pending)
+        except BlockingIOError:
+            return
+        del self._pending[:n]
+        if not self._pending:
+            self._loop.remove_writer(self._fd)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    def is_closing(self) -> bool:
+        return False
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class VirtualDevice:
+    def __init__(self, index: int, timing: DeviceTiming, link_dir: str = None, state_dir: str = None):
+        self.index = index
+        self.timing = timing
+        self.master, self._slave = os.openpty()
+        # Raw mode before any host opens it, otherwise the line discipline echoes the host's bytes back
+        tty.setraw(self._slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self._slave)
+        self.link = os.path.join(link_dir, "ttyPICO%d" % index) if link_dir else None
+        # Only the programmed pages take memory; with a state_dir the flash is a file there and outlives the farm
+        self.flash = SparseFlash(path=os.path.join(state_dir, "ttyPICO%d.flash" % index) if state_dir else None)
+        self.sessions = 0
+
+    # Runs bootloader sessions on the pty, one after the other. The farm keeps the slave side open itself, so a host
+    # closing the port doesn't end the session, just like unplugging the USB cable of a powered Pico doesn't.
+    async def run(self, device):
+        loop = asyncio.get_running_loop()
+        writer = _PtyWriter(loop, self.master)
+        while True:
+            reader = asyncio.StreamReader()
+            loop.add_reader(self.master, self._read, reader)
+            try:
+                await device(reader, writer, timing=self.timing, flash_memory=self.flash)
+            finally:
+                loop.remove_reader(self.master)
+            self.sessions += 1
+            debug("Virtual device %s finished session %s.", self.index, self.sessions)
+
+    def _read(self, reader: asyncio.StreamReader):
+        try:
+            data = os.read(self.master, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            reader.feed_eof()
+            return
+        reader.feed_data(data)
+
+    def close(self):
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+        os.close(self.master)
+        os.close(self._slave)
+        self.flash.close()
+
+
+# count virtual devices, device i gets timings[i % len(timings)]. With a link_dir, every device also gets a stable
+# name there (ttyPICO0, ttyPICO1, ...), linking to its /dev/pts/N. With a state_dir, the flash contents of the devices
+# are kept in files there (ttyPICO<n>.flash), so the next farm starts with what the previous one was flashed with.
+class DeviceFarm:
+    def __init__(self, count: int, timings: list = None, link_dir: str = DEFAULT_FARM_DIR, device=None,
+                 state_dir: str = None):
+        if device is None:
+            from main_simulated import simulated_device
+            device = simulated_device
+        if not timings:
+            timings = [DeviceTiming()]
+        self.device = device
+        for d in (link_dir, state_dir):
+            if d:
+                os.makedirs(d, exist_ok=True)
+        self.devices = [VirtualDevice(i, timings[i % len(timings)], link_dir, state_dir) for i in range(count)]
+        for dev in self.devices:
+            if dev.link is not None:
+                if os.path.lexists(dev.link):
+                    os.unlink(dev.link)
+                os.symlink(dev.path, dev.link)
+
+    # The port names to hand to the flasher
+    def ports(self) -> list:
+        return [dev.link or dev.path for dev in self.devices]
+
+    async def serve(self):
+        await asyncio.gather(*(dev.run(self.device) for dev in self.devices))
+
+    def close(self):
+        for dev in self.devices:
+            dev.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve simulated Pico bootloaders on pseudo terminals.")
+    parser.add_argument("--count", type=int, default=8)
+    parser.add_argument("--dir", default=DEFAULT_FARM_DIR, help="directory for the ttyPICO<n> links")
+    parser.add_argument("--timing", default="ideal",
+                        help="timing profile, or a comma separated list assigned round robin: "
+                             + ", ".join(TIMING_PROFILES))
+    parser.add_argument("--state-dir", help="keep the flash contents of the devices in files in this directory")
+    args = parser.parse_args()
+
+    timings = [TIMING_PROFILES[name] for name in args.timing.split(",")]
+    # Stopped by a test harness or service manager: still remove the links on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with DeviceFarm(args.count, timings, args.dir, state_dir=args.state_dir) as farm:
+        puts("Serving " + str(args.count) + " simulated bootloaders as " + os.path.join(args.dir, "ttyPICO*")
+             + ", Ctrl+C to stop.")
+        try:
+            asyncio.run(farm.serve())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
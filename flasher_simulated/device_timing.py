@@ -0,0 +1,90 @@
+import math
+import random
+from dataclasses import dataclass
+
+
+# How long the simulated device and the link to it take. The defaults answer instantly, like the simulator always
+# did; see TIMING_PROFILES for realistic setups. Flash times are typical values of the W25Q16JV QSPI flash on the
+# Pico (datasheet: 4 kB sector erase tSE 45 ms, page program tPP 0.4 ms).
+@dataclass
+class DeviceTiming:
+    baudrate: int = 0  # UART baud rate, 0 for a link that isn't limited by one (USB CDC)
+    bits_per_byte: int = 10  # 8N1: start bit, 8 data bits, stop bit
+    bandwidth: int = 0  # bytes/s in each direction, 0 for unlimited
+    latency: float = 0.0  # seconds added to every response
+    # USB serial adapters (FTDI) hold device to host bytes until latency_packet bytes have collected or their latency
+    # timer ticks, which makes a short response wait for the next tick.
+    latency_timer: float = 0.0  # seconds, 0 for no adapter
+    latency_packet: int = 62  # bytes
+    sector_erase_time: float = 0.0  # seconds per erase_size sector
+    page_program_time: float = 0.0  # seconds per write_size page
+    erase_size: int = 1 << 12
+    write_size: int = 1 << 8
+
+    # Seconds one byte occupies the link, 0 when the link is not a bottleneck.
+    def byte_time(self) -> float:
+        t = 0.0
+        if self.baudrate:
+            t = self.bits_per_byte / self.baudrate
+        if self.bandwidth:
+            t = max(t, 1 / self.bandwidth)
+        return t
+
+    # Seconds the device is busy with the flash after receiving a command.
+    def busy_time(self, opcode: bytes, length: int) -> float:
+        if opcode == b'ERAS':
+            return math.ceil(length / self.erase_size) * self.sector_erase_time
+        if opcode == b'WRIT':
+            return math.ceil(length / self.write_size) * self.page_program_time
+        return 0.0
+
+    # Seconds a response of length bytes, sent at time now, is held back by the adapter's latency timer.
+    def adapter_delay(self, now: float, length: int) -> float:
+        if not self.latency_timer or length >= self.latency_packet:
+            return 0.0
+        return self.latency_timer - math.fmod(now, self.latency_timer)
+
+
+TIMING_PROFILES: dict = {
+    # Instant answers, only the host side costs anything
+    "ideal": DeviceTiming(),
+    # Flash times of the real chip over an unlimited link
+    "flash": DeviceTiming(sector_erase_time=0.045, page_program_time=0.0004),
+    # Pico on USB CDC: full speed USB bulk transfers, about 1 MB/s, with 1 ms frames
+    "usb-cdc": DeviceTiming(bandwidth=1000000, latency=0.001, sector_erase_time=0.045, page_program_time=0.0004),
+    # Pico UART behind an FTDI adapter at 115200 baud with the default 16 ms latency timer
+    "uart-115200": DeviceTiming(baudrate=115200, latency_timer=0.016, sector_erase_time=0.045,
+                                page_program_time=0.0004),
+    # The same adapter in low latency mode (1 ms latency timer) at 921600 baud
+    "uart-921600": DeviceTiming(baudrate=921600, latency_timer=0.001, sector_erase_time=0.045,
+                                page_program_time=0.0004),
+}
+
+
+# Faults the simulated device injects, each with a probability per command. Seeded, so a run can be repeated.
+@dataclass
+class FaultInjection:
+    err_rate: float = 0.0  # command answered with ERR! (the device goes back to waiting for SYNC)
+    drop_rate: float = 0.0  # one byte of the response lost on the way to the host
+    corrupt_rate: float = 0.0  # one byte of a WRIT payload flipped on the way in, so the returned CRC mismatches
+    seed: int = 0
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def hit(self, rate: float) -> bool:
+        return rate > 0 and self.rng.random() < rate
+
+    # The response with a random byte left out, or unchanged.
+    def drop(self, response: bytes) -> bytes:
+        if len(response) == 0 or not self.hit(self.drop_rate):
+            return response
+        i = self.rng.randrange(len(response))
+        return response[:i] + response[i + 1:]
+
+    # The WRIT payload with a random byte flipped, or unchanged.
+    def corrupt(self, data: bytes) -> bytes:
+        if len(data) == 0 or not self.hit(self.corrupt_rate):
+            return data
+        i = self.rng.randrange(len(data))
+        return data[:i] + bytes([data[i] ^ 0xff]) + data[i + 1:]
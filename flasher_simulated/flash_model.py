@@ -0,0 +1,136 @@
+import os
+import mmap
+
+# Flash of the simulated Pico, addressed like the real one through the XIP window (FLASH_BASE is flash offset 0).
+# Erased flash reads 0xff and programming can only clear bits (the new contents are old AND data), like NOR flash, so a
+# write that wasn't preceded by an erase shows up as corrupted data, not as a silently correct image.
+# In memory, only the pages that were ever programmed take up space, an untouched or erased page reads as 0xff. With a
+# path, the contents live in a memory mapped file instead and survive the process. The file holds the inverted bytes:
+# a new (sparse) file reads as zeros, which makes it fully erased flash without writing 16 MB of 0xff.
+
+FLASH_BASE: int = 0x10000000
+FLASH_SIZE: int = 16 * 1024 * 1024
+PAGE_SIZE: int = 1 << 12  # the erase sector of the Pico's flash
+
+_INVERT: bytes = bytes(b ^ 0xff for b in range(256))
+
+
+class SparseFlash:
+    def __init__(self, size: int = FLASH_SIZE, base: int = FLASH_BASE, page_size: int = PAGE_SIZE, path: str = None):
+        self.size = size
+        self.base = base
+        self.page_size = page_size
+        self.path = path
+        self._erased_page = b'\xff' * page_size
+        self._pages = dict()  # page index -> bytearray, in memory only
+        self._file = None
+        self._map = None
+        if path is not None:
+            self._file = open(path, 'a+b')
+            if os.fstat(self._file.fileno()).st_size != size:
+                self._file.truncate(size)
+            self._map = mmap.mmap(self._file.fileno(), size)
+
+    def __len__(self) -> int:
+        return self.size
+
+    # Whether [addr, addr + length) lies within the flash.
+    def contains(self, addr: int, length: int) -> bool:
+        return self.base <= addr and addr + length <= self.base + self.size and length >= 0
+
+    def _offset(self, addr: int, length: int) -> int:
+        if not self.contains(addr, length):
+            raise ValueError("flash access out of range: " + hex(addr) + " + " + hex(length))
+        return addr - self.base
+
+    # Splits [offset, offset + length) at page boundaries into (page index, offset in page, length) parts.
+    def _parts(self, offset: int, length: int):
+        end = offset + length
+        while offset < end:
+            index, start = divmod(offset, self.page_size)
+            n = min(self.page_size - start, end - offset)
+            yield index, start, n
+            offset += n
+
+    def read(self, addr: int, length: int) -> bytes:
+        offset = self._offset(addr, length)
+        if self._map is not None:
+            return self._map[offset:offset + length].translate(_INVERT)
+        parts = list()
+        for index, start, n in self._parts(offset, length):
+            page = self._pages.get(index)
+            parts.append(self._erased_page[:n] if page is None else page[start:start + n])
+        return b''.join(parts)
+
+    # Sets [addr, addr + length) to 0xff. Whole pages are dropped, so erasing gives the memory back.
+    def erase(self, addr: int, length: int):
+        offset = self._offset(addr, length)
+        if self._map is not None:
+            self._map[offset:offset + length] = bytes(length)
+            return
+        for index, start, n in self._parts(offset, length):
+            page = self._pages.get(index)
+            if page is None:
+                continue
+            if n == self.page_size:
+                del self._pages[index]
+            else:
+                page[start:start + n] = self._erased_page[:n]
+
+    # Programs data at addr: every byte becomes the old byte AND the new one.
+    def program(self, addr: int, data: bytes):
+        offset = self._offset(addr, len(data))
+        if self._map is not None:
+            # Stored inverted: ~(old & new) == stored | ~new
+            old = self._map[offset:offset + len(data)]
+            self._map[offset:offset + len(data)] = _or_bytes(old, bytes(data).translate(_INVERT))
+            return
+        index, start = divmod(offset, self.page_size)
+        if start + len(data) <= self.page_size:
+            # Within one page, as every WRIT of the flasher is
+            parts = ((index, start, len(data)),)
+        else:
+            parts = self._parts(offset, len(data))
+        pos = 0
+        for index, start, n in parts:
+            chunk = data[pos:pos + n]
+            pos += n
+            if chunk == self._erased_page[:n]:
+                # Programming 0xff changes nothing, and erased padding shouldn't take up memory
+                continue
+            page = self._pages.get(index)
+            if page is None:
+                page = self._pages[index] = bytearray(self._erased_page)
+            old = page[start:start + n]
+            page[start:start + n] = chunk if old == self._erased_page[:n] else _and_bytes(old, chunk)
+
+    # Bytes of memory the contents take in memory: the pages programmed since their last erase. 0 for a file, whose
+    # pages the OS caches as it sees fit.
+    def resident(self) -> int:
+        return len(self._pages) * self.page_size
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Bytewise a AND b and a OR b, through ints, which is far faster in Python than a loop over the bytes.
+def _and_bytes(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') & int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def _or_bytes(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
@@ -0,0 +1,147 @@
+import time
+import asyncio
+import threading
+
+# In-process transports to the simulated bootloader, instead of a TCP connection through the kernel:
+# - open_loopback() pairs two asyncio streams, for the asyncio host of flasher_simulated/ and the simulated device
+#   running in the same event loop.
+# - LoopbackSerial looks like a pyserial port to the blocking host of flasher/, and runs the simulated device in a
+#   background event loop shared by all loopback ports of the process.
+# Nothing binds a port, so any number of simulated flashes can run side by side.
+
+
+# StreamWriter stand-in that hands every write to a callback, directly, without any buffering or transport.
+class _CallbackWriter:
+    def __init__(self, on_data, on_close):
+        self._on_data = on_data
+        self._on_close = on_close
+        self._closed = False
+
+    def write(self, data):
+        if not self._closed:
+            self._on_data(bytes(data))
+
+    def writelines(self, lines):
+        for data in lines:
+            self.write(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._on_close()
+
+    def is_closing(self) -> bool:
+        return self._closed
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+# Returns ((host_reader, host_writer), (device_reader, device_writer)): what the host writes, the device reads and
+# the other way around. Must be called from the event loop both sides run in.
+def open_loopback():
+    host_reader = asyncio.StreamReader()
+    device_reader = asyncio.StreamReader()
+    host_writer = _CallbackWriter(device_reader.feed_data, device_reader.feed_eof)
+    device_writer = _CallbackWriter(host_reader.feed_data, host_reader.feed_eof)
+    return (host_reader, host_writer), (device_reader, device_writer)
+
+
+_device_loop = None
+_device_loop_lock = threading.Lock()
+
+
+# The event loop the devices behind LoopbackSerial ports run in, started on first use.
+def _loop() -> asyncio.AbstractEventLoop:
+    global _device_loop
+    with _device_loop_lock:
+        if _device_loop is None:
+            _device_loop = asyncio.new_event_loop()
+            threading.Thread(target=_device_loop.run_forever, name="simulated-devices", daemon=True).start()
+        return _device_loop
+
+
+# Blocking, pyserial compatible port connected to a simulated device. device is a coroutine function taking
+# (reader, writer), such as main_simulated.simulated_device (use functools.partial for its timing and faults).
+# read() honours timeout like pyserial: None blocks, 0 returns what is there, otherwise it waits at most that long.
+class LoopbackSerial:
+    def __init__(self, device, timeout: float = 1.0, port: str = "loopback"):
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        self._rx = bytearray()
+        self._rx_ready = threading.Condition()
+        self._device_eof = False
+        self._loop = _loop()
+        self._device_reader = None
+        asyncio.run_coroutine_threadsafe(self._start(device), self._loop).result()
+
+    async def _start(self, device):
+        self._device_reader = asyncio.StreamReader()
+        writer = _CallbackWriter(self._received, self._device_closed)
+        self._task = asyncio.ensure_future(device(self._device_reader, writer))
+
+    # Called in the device loop for everything the device sends
+    def _received(self, data: bytes):
+        with self._rx_ready:
+            self._rx += data
+            self._rx_ready.notify_all()
+
+    def _device_closed(self):
+        with self._rx_ready:
+            self._device_eof = True
+            self._rx_ready.notify_all()
+
+    def write(self, data) -> int:
+        self._loop.call_soon_threadsafe(self._device_reader.feed_data, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def read(self, size: int = 1) -> bytes:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self._rx_ready:
+            while len(self._rx) < size and not self._device_eof:
+                if deadline is None:
+                    self._rx_ready.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._rx_ready.wait(remaining)
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+            return data
+
+    @property
+    def in_waiting(self) -> int:
+        with self._rx_ready:
+            return len(self._rx)
+
+    def inWaiting(self) -> int:
+        return self.in_waiting
+
+    def reset_input_buffer(self):
+        with self._rx_ready:
+            self._rx.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self._loop.call_soon_threadsafe(self._device_reader.feed_eof)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
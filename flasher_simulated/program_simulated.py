@@ -20,9 +20,10 @@ def align(val, to):
     return (val + (to - 1)) & ~(to - 1)
 
 
-async def Program(reader, writer, image: Image, progress_bar):
+# wait_time_before_read can be 0 for transports that deliver every response in one piece (flasher_simulated/loopback.py).
+async def Program(reader, writer, image: Image, progress_bar, capture=None, wait_time_before_read: float = 0.05):
     # Normal RP2040 (not wireless) protocol
-    protocol = Protocol_RP2040()
+    protocol = Protocol_RP2040(capture=capture, wait_time_before_read=wait_time_before_read)
 
     # Check if there is a Pico device connected, ready to be flashed
     has_sync = await protocol.sync_cmd(reader, writer)
@@ -38,8 +39,8 @@ async def Program(reader, writer, image: Image, progress_bar):
     pad_zeros = bytes(pad_len)
     data = image.Data + pad_zeros
 
-    debug("pad_len: " + str(pad_len))
-    debug("pad_zeros: " + str(hex_bytes_to_int(pad_zeros)))
+    debug("pad_len: %s", pad_len)
+    debug("pad_zeros: %s", hex_bytes_to_int(pad_zeros))
 
     if image.Addr < device_info.flash_addr:
         puts("Image load address is too low: " + str(hex(image.Addr)) + " < " + str(hex(device_info.flash_addr)))
@@ -55,7 +56,7 @@ async def Program(reader, writer, image: Image, progress_bar):
     erase_len = int(align(len(data), device_info.erase_size))
     for start in range(0, erase_len, device_info.erase_size):
         erase_addr = image.Addr + start
-        debug("Erase: " + str(erase_addr) + "size: " + str(device_info.erase_size))
+        debug("Erase: %ssize: %s", erase_addr, device_info.erase_size)
         has_succeeded = await protocol.erase_cmd(reader, writer, erase_addr, device_info.erase_size)
         if not has_succeeded:
             puts("Error when erasing flash, at addr: " + str(erase_addr))
@@ -82,7 +83,7 @@ async def Program(reader, writer, image: Image, progress_bar):
 
     puts("Adding seal to finalize.")
     has_sealed = await protocol.seal_cmd(reader, writer, image.Addr, data)
-    debug("Has sealed: " + str(has_sealed))
+    debug("Has sealed: %s", has_sealed)
     if not has_sealed:
         puts("Sealing failed. Exiting.")
         exit_prog(False)
@@ -0,0 +1,139 @@
+import asyncio
+import collections
+from dataclasses import dataclass
+from flasher.util import debug
+from flasher.capture import read_any_capture, command_length, COMMAND_ARGS, HOST_TO_DEVICE
+
+# A device that plays back a recorded flash session: every frame the host sends is compared with the recorded one, and
+# answered with the response the real board gave. Sessions come from --capture files (with timestamps, so the
+# recorded response times can be replayed as well) or from the legacy logs in the repository root:
+#   plc_device_output_real.bin                            both directions, in order
+#   plc_output_real.bin + device_output_real.bin          host and device side, loaded together
+# ReplayDevice.serve() takes asyncio streams like simulated_device(), so LoopbackSerial(device.serve) gives a port
+# the flasher of flasher/ can use, and recorded_image() the image it has to be flashed with to match the recording.
+
+
+@dataclass
+class Exchange:
+    request: bytes
+    response: bytes = None  # None when the device didn't answer (GOGO, a SYNC sent before the device listened)
+    delay: float = 0.0  # seconds between the request and the response in the recording
+
+
+@dataclass
+class Divergence:
+    index: int  # of the exchange
+    offset: int  # first byte that differs
+    expected: bytes  # the recorded frame, empty where the host sent more than was recorded
+    actual: bytes
+
+    def __str__(self):
+        context = slice(max(0, self.offset - 8), self.offset + 8)
+        return ("frame " + str(self.index) + " (" + repr(self.expected[:4] or self.actual[:4]) + ") differs at byte "
+                + str(self.offset) + ": expected " + self.expected[context].hex(' ') + ", got "
+                + self.actual[context].hex(' '))
+
+
+# The exchanges of a recorded session. Each response is paired with the oldest request still waiting for one;
+# a SYNC that the device never answered with PICO (or WOTA) gets no response.
+def load_session(path: str, device_path: str = None) -> list:
+    frames = list(read_any_capture(path))
+    if device_path is not None:
+        frames += list(read_any_capture(device_path))
+    exchanges = list()
+    waiting = collections.deque()  # (exchange, time of the request)
+    for t, direction, data in frames:
+        if direction == HOST_TO_DEVICE:
+            exchange = Exchange(data)
+            exchanges.append(exchange)
+            waiting.append((exchange, t))
+            continue
+        while waiting and waiting[0][0].request[:4] == b'SYNC' and data[:4] not in (b'PICO', b'WOTA'):
+            waiting.popleft()
+        if not waiting:
+            debug("Recorded response without a request: %s", data[:16])
+            continue
+        exchange, request_t = waiting.popleft()
+        exchange.response = data
+        if t is not None and request_t is not None:
+            exchange.delay = max(0.0, t - request_t)
+    return exchanges
+
+
+# The image the recorded session wrote, from the address of its first WRIT on, so that a flasher given it sends the
+# same frames.
+def recorded_image(exchanges: list):
+    from flasher.program import Image
+    chunks = dict()
+    for exchange in exchanges:
+        frame = exchange.request
+        if frame[:4] == b'WRIT':
+            chunks[int.from_bytes(frame[4:8], 'little')] = frame[12:]
+    start = min(chunks)
+    data = bytearray()
+    for addr in sorted(chunks):
+        data[addr - start:addr - start + len(chunks[addr])] = chunks[addr]
+    return Image(start, bytes(data))
+
+
+class ReplayDevice:
+    # timing replays the recorded delay before every response. strict stops answering at the first divergence,
+    # otherwise the host gets the recorded responses regardless and every divergence is collected.
+    def __init__(self, exchanges: list, timing: bool = False, strict: bool = False):
+        self.exchanges = exchanges
+        self.timing = timing
+        self.strict = strict
+        self.position = 0  # exchanges replayed so far
+        self.divergences = list()
+
+    # Whether the host went through the whole recording without a divergence.
+    def matched(self) -> bool:
+        return not self.divergences and self.position == len(self.exchanges)
+
+    # Serves the host until the recording ends, the host disconnects or, when strict, the first divergence.
+    async def serve(self, reader, writer):
+        buf = bytearray()
+        try:
+            while self.position < len(self.exchanges):
+                expected = self.exchanges[self.position]
+                length = await self._frame_length(reader, buf, len(expected.request))
+                frame = bytes(buf[:length])
+                del buf[:length]
+                if frame != expected.request and not self._diverged(expected.request, frame):
+                    break
+                self.position += 1
+                if expected.response is None:
+                    continue
+                if self.timing and expected.delay:
+                    await asyncio.sleep(expected.delay)
+                writer.write(expected.response)
+                await writer.drain()
+            else:
+                extra = buf + await reader.read(1 << 16)
+                if extra:
+                    self._diverged(b'', bytes(extra))
+        except asyncio.IncompleteReadError as e:
+            if self.position < len(self.exchanges):
+                self._diverged(self.exchanges[self.position].request, bytes(e.partial))
+        writer.close()
+
+    # Reads until the next host frame is buffered and returns its length: as the protocol defines it, or the length of
+    # the recorded frame for anything that doesn't start with a known opcode.
+    async def _frame_length(self, reader, buf: bytearray, recorded: int) -> int:
+        while True:
+            if len(buf) >= 4:
+                length = command_length(buf) if bytes(buf[:4]) in COMMAND_ARGS else recorded
+                if length is not None and len(buf) >= length:
+                    return length
+            data = await reader.read(1 << 16)
+            if not data:
+                raise asyncio.IncompleteReadError(bytes(buf), None)
+            buf += data
+
+    # Records a divergence and returns whether to go on.
+    def _diverged(self, expected: bytes, actual: bytes) -> bool:
+        offset = next((i for i, (a, b) in enumerate(zip(expected, actual)) if a != b), min(len(expected), len(actual)))
+        divergence = Divergence(self.position, offset, expected, actual)
+        self.divergences.append(divergence)
+        debug("Replay diverged: %s", divergence)
+        return not self.strict
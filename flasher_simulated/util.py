@@ -6,15 +6,8 @@ def usage_flasher():
     return str("Usage: main.py port filepath [BASE_ADDR] \nFor example: main.py /dev/ttyUSB0 ~/pico/test.elf")
 
 
-# Wrapper function to be able to easily disable/alter all debugging string output.
-def debug(self, *args):
-    print(self, *args, sep=' ', end='\n', file=None)
-    pass
-
-
-# Wrapper function to be able to easily disable/alter all user string output.
-def puts(self, *args):
-    print(self, *args, sep=' ', end='\n', file=None)
+# debug() and puts() share the leveled logger of the real flasher, see flasher/util.py.
+from flasher.util import debug, puts
 
 
 # Wrapper function to easily change behaviour before exiting program.
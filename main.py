@@ -1,25 +1,95 @@
 import sys
-import traceback
 import os
-import serial.tools.list_ports
 import serial
-from flasher.elf import load_elf
-from flasher.util import debug, puts, usage_flasher, exit_prog
-from flasher.program import Image, Program
+from flasher.util import debug, puts, usage_flasher, exit_prog, set_log_level
+from flasher.program import Image, Program, ProgramDelta, ProgramManifest, RetryPolicy, PipelineSettings
+from flasher.delta import read_delta
+from flasher.manifest import load_manifest
+from flasher.image_cache import load_elf_cached
+from flasher.link import LinkProfile, open_link, load_profile, adapter_id
+from flasher.capture import TrafficCapture
+from flasher.metrics import FlashMetrics
+from flasher.trace import TraceRecorder, span
+from flasher.progress import BarRenderer, FleetRenderer, JsonLinesRenderer
+from flasher.registry import DeviceRegistry
+from flasher.journal import remove_journals
+
+# Modules only some runs need (pyelftools behind flasher.elf above all, the port enumeration of discovery, the thread
+# pool of fleet, the link and pipeline tuning) are imported where they are used, every flash job pays for what is
+# imported here. See benchmarks/startup_bench.py.
 
 
 # Called at start of main(), to catch program arguments and respond accordingly.
+# Options of the form --name=value (or just --name) are collected in the module level options dict.
 def handle_args():
-    _sys_args = sys.argv[1:]
-    debug("All args: " + str(_sys_args))
-    debug("Len args: " + str(len(_sys_args)))
+    _sys_args = list()
+    for arg in sys.argv[1:]:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            _sys_args.append(arg)
+    debug("All options: %s", options)
+    debug("All args: %s", _sys_args)
+    debug("Len args: %s", len(_sys_args))
+    if len(_sys_args) == 1 and (_sys_args[0] == "auto" or "tune" in options or "tune-pipeline" in options):
+        return _sys_args
     if len(_sys_args) <= 1 or len(_sys_args) > 3:
         return -1
     else:
         return _sys_args
 
 
-# Runs the flasher program
+# Returns the link profile for a port: the one saved by --tune for its adapter (or the defaults),
+# with the link options given on the command line applied on top.
+def link_profile(port: str) -> LinkProfile:
+    profile = load_profile(port) or LinkProfile()
+    if "baud" in options:
+        profile.baudrate = int(options["baud"])
+    if "rtscts" in options:
+        profile.rtscts = True
+    if "xonxoff" in options:
+        profile.xonxoff = True
+    if "rx-buffer" in options:
+        profile.rx_buffer = int(options["rx-buffer"])
+    if "tx-buffer" in options:
+        profile.tx_buffer = int(options["tx-buffer"])
+    if "low-latency" in options:
+        profile.low_latency = True
+    if "timeout" in options:
+        profile.read_timeout = float(options["timeout"])
+    debug("Link profile for %s: %s", port, profile)
+    return profile
+
+
+# Opens the port, which is also the check that it exists. Enumerating every serial port of the machine to look for it
+# costs more than opening it, and misses the device files the OS doesn't list as serial ports (pseudo terminals, udev
+# symlinks) anyway.
+def open_port(port: str):
+    try:
+        return open_link(port, link_profile(port))
+    except ValueError as e:
+        puts("Serial parameters out of range, with exception: " + str(e))
+        exit_prog(True)
+    except serial.SerialException as s_e:
+        puts("Given serial port was not available: " + str(s_e))
+        exit_prog(True)
+
+
+# Returns the pipeline settings for a port: the ones saved by --tune-pipeline for its transport (or the defaults),
+# with --window and --erase-batch applied on top.
+def pipeline_settings(port: str) -> PipelineSettings:
+    from flasher.pipeline_tuning import load_pipeline
+    pipeline = load_pipeline(port) or PipelineSettings()
+    if "window" in options:
+        pipeline.window = int(options["window"])
+    if "erase-batch" in options:
+        pipeline.erase_batch = int(options["erase-batch"])
+    debug("Pipeline settings for %s: %s", port, pipeline)
+    return pipeline
+
+
+# Runs the flasher program. Returns True when it flashed the image, the runs that only list, tune or watch don't.
 def run(_sys_args):
     global bin_found, img
     if _sys_args == -1:
@@ -27,36 +97,93 @@ def run(_sys_args):
         exit_prog(True)
 
     port = str(_sys_args[0])
-    flash_over_air = False
+    discovered = list()
+    delta = None
+    manifest = None
 
-    if port.startswith("tcp:"):
-        puts("Flashing over TCP is not yet implemented.")
-        flash_over_air = True
+    if port == "auto" and ("tune" in options or "tune-pipeline" in options):
+        puts("--tune and --tune-pipeline calibrate one port, they can't be combined with auto.")
         exit_prog(True)
-    else:
-        pc_port_paths = list()
-        [pc_port_paths.append(p[0]) for p in list(serial.tools.list_ports.comports())]
-        debug("All available serial communication ports on your machine: " + str(pc_port_paths))
-        if port not in pc_port_paths:
-            puts("Given serial port was not available.")
+    if port == "auto":
+        from flasher.discovery import discover_devices
+        discovered = discover_devices(options.get("ports") or None)
+        for dev in discovered:
+            puts("Found bootloader on " + dev.port + " (" + dev.response.decode() + "), flash at "
+                 + hex(dev.info.flash_addr) + " of " + str(dev.info.flash_size) + " bytes. " + dev.hwid)
+        if len(discovered) == 0:
+            puts("No Pico bootloader responded on any serial port.")
             exit_prog(True)
-    puts("Serial connection made.")
+        if len(_sys_args) == 1:
+            return
+    elif port.startswith("tcp:"):
+        puts("Connecting to a raw TCP serial bridge at " + port[len("tcp:"):] + ".")
+
+    if "tune" in options:
+        from flasher.tuning import tune_link
+        tune_link(port, link_profile(port))
+        return
+    conn = None
+    if port != "auto":
+        conn = open_port(port)
+        puts("Serial connection made.")
+    if "tune-pipeline" in options:
+        from flasher.pipeline_tuning import calibrate_pipeline, save_pipeline
+        puts("Calibrating the pipeline. This erases the start of the application area.")
+        # The registry's record of the device and its journals no longer match its flash
+        DeviceRegistry().forget(adapter_id(port))
+        remove_journals(adapter_id(port))
+        calibration = calibrate_pipeline(conn)
+        conn.close()
+        if calibration is not None:
+            save_pipeline(port, calibration.settings)
+        return
     file_path = str(_sys_args[1])
+    trace = TraceRecorder(options["trace"]) if options.get("trace") else None
     filename, file_extension = os.path.splitext(file_path)
 
     if file_extension == ".elf":
-        debug("Elf found!: " + str(file_extension))
+        debug("Elf found!: %s", file_extension)
         if len(_sys_args) >= 3:
             puts("Base address for ELF files can't be specified")
             puts(usage_flasher())
             exit_prog(True)
-        img = load_elf(file_path)
-        debug("Returned .elf address: " + str(img.Addr) + " and data: ")# + str(img.Data))
-        debug("ELF Image Data List Length: " + str(len(img.Data)))
+        with span(trace.track("host") if trace is not None else None, "load elf", path=file_path):
+            img = load_elf_cached(file_path)
+        debug("Returned .elf address: %s and data: ", img.Addr)# + str(img.Data))
+        debug("ELF Image Data List Length: %s", len(img.Data))
         debug("")
 
+    elif file_extension == ".delta":
+        debug("Delta bundle found!: %s", file_extension)
+        if len(_sys_args) >= 3:
+            puts("Base address for delta bundles can't be specified")
+            puts(usage_flasher())
+            exit_prog(True)
+        with span(trace.track("host") if trace is not None else None, "load delta", path=file_path):
+            delta = read_delta(file_path)
+        # The bundle is checked as it is, applying it only builds the sectors that changed
+        if delta.new_length == 0 or delta.new_length % delta.write_size or delta.addr % delta.erase_size:
+            puts("Delta bundle " + file_path + " has no valid image: " + str(delta.new_length) + " bytes at "
+                 + hex(delta.addr) + ".")
+            exit_prog(True)
+        debug("Delta bundle at %s: %s of %s sectors changed", hex(delta.addr), len(delta.changed),
+              len(delta.new_sectors))
+
+    elif file_extension == ".json":
+        debug("Manifest found!: %s", file_extension)
+        if len(_sys_args) >= 3:
+            puts("Base addresses of the images of a manifest are given in the manifest")
+            puts(usage_flasher())
+            exit_prog(True)
+        with span(trace.track("host") if trace is not None else None, "load manifest", path=file_path):
+            manifest = load_manifest(file_path)
+        application = manifest.application()
+        img = Image(application.addr, application.data)
+        for image in manifest.images:
+            debug("Manifest image %s at %s, %s bytes", image.file, hex(image.addr), len(image.data))
+
     elif file_extension == ".bin":
-        debug("Bin found!: " + str(file_extension))
+        debug("Bin found!: %s", file_extension)
         if len(_sys_args) != 3:
             puts("When flashing a binary file, make sure to pass a base address.")
             puts(usage_flasher())
@@ -64,7 +191,7 @@ def run(_sys_args):
         else:
             bin_found = True
     else:
-        puts("Incorrect file extension. Currently supported extensions are: '.elf' and '.bin'.")
+        puts("Incorrect file extension. Currently supported extensions are: '.elf', '.delta', '.json' (manifest) and '.bin'.")
         exit_prog(True)
     base_addr: int = -1
     if bin_found:
@@ -72,46 +199,130 @@ def run(_sys_args):
         puts("Binary file flashing not yet implemented.")
         exit_prog(True)
 
-    debug("Base addr: " + str(base_addr))
+    debug("Base addr: %s", base_addr)
     #debug("Img data: " + str(img.Data))
 
-    conn = None
-
-    if img.Data is None or img.Addr <= -1:
+    if delta is None and (img.Data is None or img.Addr <= -1):
         puts("Image file has not been read correctly.")
         exit_prog(True)
 
-    if flash_over_air:
-        puts("Flashing over TCP not yet implemented.")
-        exit_prog(True)
+    retry = RetryPolicy()
+    if "retries" in options:
+        retry.max_retries = int(options["retries"])
+    if "backoff" in options:
+        retry.backoff = float(options["backoff"])
+    # What was flashed to which device, so that re-flashing one only writes the sectors that changed
+    registry = DeviceRegistry() if "no-registry" not in options else None
 
-    try:
-        conn = serial.Serial(port=port, baudrate=115200, inter_byte_timeout=0.1, timeout=0)
-    except ValueError as e:
-        puts("Serial parameters out of range, with exception: " + str(e))
-        exit_prog(True)
-    except serial.SerialException as s_e:
-        puts("Serial Exception. Serial port probably not available: " + str(s_e))
+    if "watch" in options and (port == "auto" or file_extension != ".elf"):
+        puts("--watch needs a single port and an ELF file.")
         exit_prog(True)
 
+    if port == "auto":
+        puts("Image file has been read correctly.")
+        # Without explicit pipeline options, every port uses the settings calibrated for its own transport
+        pipeline = None
+        if "window" in options or "erase-batch" in options:
+            pipeline = pipeline_settings(port)
+        metrics = run_metrics()
+        from flasher.fleet import flash_fleet
+        try:
+            results = flash_fleet([dev.port for dev in discovered], delta or manifest or img, retry=retry,
+                                  use_journal="no-journal" not in options, pipeline=pipeline,
+                                  capture_path=options.get("capture") or None, metrics=metrics, trace=trace,
+                                  progress=progress_renderer(True), registry=registry)
+        finally:
+            export_metrics(metrics)
+            if trace is not None:
+                trace.write()
+        failed = [r for r in results if not r.ok]
+        if failed:
+            puts(str(len(failed)) + " of " + str(len(results)) + " devices failed to flash.")
+            exit_prog(True, 1)
+        return True
+
     puts("Image file has been read correctly.")
+    if "watch" in options:
+        import tempfile
+        from flasher.watch import watch_and_flash
+        # Without the registry, watch mode keeps one of its own for the session
+        with tempfile.TemporaryDirectory() as registry_dir:
+            watch_and_flash(conn, file_path, registry or DeviceRegistry(registry_dir), retry, adapter_id(port),
+                            pipeline_settings(port), progress_renderer(False))
+        conn.close()
+        return
     # puts(conn.baudrate)
     # puts(Opcodes['OpcodeSync'])
     # puts(hex_bytes_to_int(Opcodes['OpcodeSync']))
-    program_err = Program(conn, img, None)
+    capture = None
+    if options.get("capture"):
+        capture = TrafficCapture(options["capture"])
+    metrics = run_metrics()
+    try:
+        if manifest is not None:
+            ProgramManifest(conn, manifest, progress_renderer(False), retry, device_id=adapter_id(port),
+                            pipeline=pipeline_settings(port), capture=capture, metrics=metrics,
+                            trace=trace.track(port) if trace is not None else None, registry=registry)
+        elif delta is not None:
+            ProgramDelta(conn, delta, progress_renderer(False), retry, device_id=adapter_id(port),
+                         pipeline=pipeline_settings(port), capture=capture, metrics=metrics,
+                         trace=trace.track(port) if trace is not None else None, registry=registry)
+        else:
+            program_err = Program(conn, img, progress_renderer(False), retry, use_journal="no-journal" not in options,
+                                  device_id=adapter_id(port), pipeline=pipeline_settings(port), capture=capture,
+                                  metrics=metrics, trace=trace.track(port) if trace is not None else None,
+                                  registry=registry)
+    finally:
+        if capture is not None:
+            capture.close()
+        # Also written when the flash failed, the retries are most interesting then
+        export_metrics(metrics)
+        if trace is not None:
+            trace.write()
+    return True
+
+
+# Returns the metrics to record into when --metrics-json or --metrics-prom is given, else None.
+def run_metrics():
+    if options.get("metrics-json") or options.get("metrics-prom"):
+        return FlashMetrics()
+    return None
+
+
+# Writes the metrics to the files given with --metrics-json and --metrics-prom.
+def export_metrics(metrics: FlashMetrics):
+    if metrics is None:
+        return
+    if options.get("metrics-json"):
+        metrics.write_json(options["metrics-json"])
+    if options.get("metrics-prom"):
+        metrics.write_prometheus(options["metrics-prom"])
+
+
+# Returns the progress callback selected with --progress (a bar, one line per port in fleet mode) or
+# --progress=json (JSON lines on stdout), or None without the option.
+def progress_renderer(fleet: bool):
+    if "progress" not in options:
+        return None
+    if options["progress"] == "json":
+        return JsonLinesRenderer()
+    return FleetRenderer() if fleet else BarRenderer()
 
 
 # Module level global definitions
 bin_found: bool = False
 img: Image
+options: dict = dict()
 
 # Main of the program, handles args and captures the run function in try except clauses
 # to be able to easily catch errors
 if __name__ == '__main__':
     sys_args = handle_args()
+    if "log-level" in options:
+        set_log_level(options["log-level"])
     try:
-        run(sys_args)
-        puts("\nJobs done. Pico should have rebooted into the flashed application.")
+        if run(sys_args):
+            puts("\nJobs done. Pico should have rebooted into the flashed application.")
     except TypeError as err:
         print(err)
         puts(usage_flasher())
@@ -120,6 +331,7 @@ if __name__ == '__main__':
     except ValueError as err:
         puts("Value error, with error: " + str(err))
     except Exception:
+        import traceback
         puts("Unexpected error: ", sys.exc_info()[0])
         puts(traceback.print_exc())
         raise
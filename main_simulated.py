@@ -1,210 +1,49 @@
 import sys
 import os
 import asyncio
-import binascii
 from flasher.elf import load_elf
 from flasher.util import debug, puts, usage_flasher, exit_prog
 from flasher_simulated.program_simulated import Image, Program
-
-async def simulated_device(reader, writer):
-    async def usb_read_blocking(length):
-        return await reader.readexactly(length)
-
-    async def usb_write_blocking(data):
-        writer.write(data)
-        await writer.drain()
-
-    async def state_wait_for_sync(ctx):
-        idx = 0
-        recv = bytearray(4)
-        match = b'SYNC'
-
-        while idx < 4:
-            recv[idx:idx + 1] = await usb_read_blocking(1)
-            if recv[idx:idx + 1] != match[idx:idx + 1]:
-                idx = 0
-            else:
-                idx += 1
-
-        ctx['opcode'] = int.from_bytes(recv, 'little')
-        await usb_write_blocking(b'PICO')
-        return 'READ_OPCODE'
-
-    async def state_read_opcode(ctx):
-        ctx['opcode'] = int.from_bytes(await usb_read_blocking(4), 'little')
-        return 'READ_ARGS'
-
-    async def state_read_args(ctx):
-        desc = next((cmd for cmd in cmds if cmd['opcode'] == ctx['opcode']), None)
-        if not desc:
-            ctx['status'] = RSP_ERR
-            return 'ERROR'
-        
-        ctx['desc'] = desc
-        ctx['args'] = [int.from_bytes(await usb_read_blocking(4), 'little') for _ in range(desc['nargs'])]
-        ctx['data'] = bytearray()
-        return 'READ_DATA'
-
-    async def state_read_data(ctx):
-        desc = ctx['desc']
-        if desc['size']:
-            ctx['status'], ctx['data_len'], ctx['resp_data_len'] = desc['size'](ctx['args'])
-            if is_error(ctx['status']):
-                return 'ERROR'
-        else:
-            ctx['data_len'] = 0
-            ctx['resp_data_len'] = 0
-        
-        if ctx['data_len']:
-            ctx['data'] = await usb_read_blocking(ctx['data_len'])
-        return 'HANDLE_DATA'
-
-    async def state_handle_data(ctx):
-        desc = ctx['desc']
-        if desc['handle']:
-            ctx['status'], ctx['resp_args'], ctx['resp_data'] = desc['handle'](ctx['args'], ctx['data'])
-            if is_error(ctx['status']):
-                return 'ERROR'
-        else:
-            ctx['status'] = RSP_OK
-        
-        resp = ctx['status'].to_bytes(4, 'little')
-        for arg in ctx['resp_args']:
-            resp += arg.to_bytes(4, 'little')
-        resp += ctx['resp_data']
-        await usb_write_blocking(resp)
-        if ctx['opcode'] == int.from_bytes(b'GOGO', 'little'):
-            os._exit(0)
-        return 'READ_OPCODE'
-
-    async def state_error(ctx):
-        await usb_write_blocking(ctx['status'].to_bytes(4, 'little'))
-        return 'WAIT_FOR_SYNC'
-
-    states = {
-        'WAIT_FOR_SYNC': state_wait_for_sync,
-        'READ_OPCODE': state_read_opcode,
-        'READ_ARGS': state_read_args,
-        'READ_DATA': state_read_data,
-        'HANDLE_DATA': state_handle_data,
-        'ERROR': state_error,
-    }
-
-    cmds = [
-        {
-            'opcode': int.from_bytes(b'SYNC', 'little'),
-            'nargs': 0,
-            'resp_nargs': 0,
-            'size': None,
-            'handle': lambda args, data: (RSP_SYNC, [], b'')
-        },
-        {
-            'opcode': int.from_bytes(b'READ', 'little'),
-            'nargs': 2,
-            'resp_nargs': 0,
-            'size': lambda args: (RSP_OK, 0, args[1]),
-            'handle': lambda args, data: (RSP_OK, [], flash_memory[args[0]:args[0]+args[1]])
-        },
-        {
-            'opcode': int.from_bytes(b'ERAS', 'little'),
-            'nargs': 2,
-            'resp_nargs': 0,
-            'size': None,
-            'handle': lambda args, data: (
-                RSP_OK,
-                [],
-                (flash_memory.__setitem__(slice(args[0], args[0] + args[1]), b'\xff' * args[1]) or b'')
-            )
-        },
-        {
-            'opcode': int.from_bytes(b'WRIT', 'little'),
-            'nargs': 2,
-            'resp_nargs': 1,
-            'size': lambda args: (RSP_OK, args[1], 0),
-            'handle': lambda args, data: (
-                RSP_OK,
-                [binascii.crc32(data)],
-                (flash_memory[args[0]:args[0]+args[1]] == data and b'') or (flash_memory.__setitem__(slice(args[0], args[0]+args[1]), data) or b'')
-            )
-        },
-        {
-            'opcode': int.from_bytes(b'SEAL', 'little'),
-            'nargs': 3,
-            'resp_nargs': 0,
-            'size': None,
-            'handle': lambda args, data: (RSP_OK, [], b'')
-        },
-        {
-            'opcode': int.from_bytes(b'INFO', 'little'),
-            'nargs': 0,
-            'resp_nargs': 5,
-            'size': None,
-            'handle': lambda args, data: (
-                RSP_OK,
-                [write_addr_min, xip_base + len(flash_memory)- write_addr_min, 1 << 12, 1 << 8, 1024],
-                b''
-            )
-        },
-        {
-            'opcode': int.from_bytes(b'GOGO', 'little'),
-            'nargs': 0,
-            'resp_nargs': 0,
-            'size': None,
-            'handle': lambda args, data: (RSP_OK, [], b'')
-        },
-    ]
-
-    RSP_SYNC = int.from_bytes(b'PICO', 'little')
-    RSP_OK = int.from_bytes(b'OKOK', 'little')
-    RSP_ERR = int.from_bytes(b'ERR!', 'little')
-
-    def is_error(status):
-        return status == RSP_ERR
-
-    header_offset = 28 * 1024
-    flash_memory = bytearray(16 * 1024 * 1024)  # 16MB flash
-    xip_base = 0x10000000
-    flash_sector_size = 1 << 12
-    write_addr_min = (xip_base + header_offset + flash_sector_size)
-
-
-
-    ctx = {
-        'opcode': 0,
-        'status': 0,
-        'desc': None,
-        'args': [],
-        'data': bytearray(),
-        'resp_args': [],
-        'resp_data': bytearray(),
-        'data_len': 0,
-        'resp_data_len': 0,
-    }
-    state = 'WAIT_FOR_SYNC'
-
-    while True:
-        state = await states[state](ctx)
+from flasher_simulated.device_timing import DeviceTiming, FaultInjection, TIMING_PROFILES
+from flasher_simulated.loopback import open_loopback
+from flasher_simulated.flash_model import SparseFlash
+from flasher_simulated.bootloader_device import SimulatedBootloader
+
+# Simulated RP2040 bootloader, serving one host connection until it receives GOGO or the host disconnects.
+# timing sets the link and flash times (see flasher_simulated/device_timing.py, the default answers instantly),
+# faults the errors to inject, max_data_len is the largest WRIT payload announced in INFO. Pass flash_memory to keep
+# the flash contents across sessions (or runs, with a file backed SparseFlash), otherwise every session starts with
+# erased flash. The device itself is flasher_simulated/bootloader_device.py.
+async def simulated_device(reader, writer, timing: DeviceTiming = None, faults: FaultInjection = None,
+                           max_data_len: int = 1024, flash_memory: SparseFlash = None):
+    device = SimulatedBootloader(timing=timing, faults=faults, max_data_len=max_data_len, flash_memory=flash_memory)
+    await device.serve(reader, writer)
 
 async def run_flash_program(reader, writer, img):
-    await Program(reader, writer, img, None)
+    # The loopback hands over every response in one piece, no need to wait for the rest of it
+    await Program(reader, writer, img, None, wait_time_before_read=0)
 
 async def main():
-    if len(sys.argv) != 2:
-        print("Usage: main_simulated.py <path to ELF file>")
+    args = [a for a in sys.argv[1:] if not a.startswith("--timing=")]
+    timing_names = [a[len("--timing="):] for a in sys.argv[1:] if a.startswith("--timing=")]
+    if len(args) != 1 or any(name not in TIMING_PROFILES for name in timing_names):
+        print("Usage: main_simulated.py <path to ELF file> [--timing=" + "|".join(TIMING_PROFILES) + "]")
         sys.exit(1)
+    timing = TIMING_PROFILES[timing_names[-1]] if timing_names else None
 
-    elf_path = sys.argv[1]
+    elf_path = args[0]
     img = load_elf(elf_path)
     debug("Returned .elf address: " + str(img.Addr) + " and data: " )#+ str(img.Data))
-    debug("ELF Image Data List Length: " + str(len(img.Data)))
+    debug("ELF Image Data List Length: %s", len(img.Data))
     debug("")
-    server = await asyncio.start_server(simulated_device, '127.0.0.1', 8888)
-    await asyncio.sleep(1)  # Give the server a moment to start
-
-    device_reader, device_writer = await asyncio.open_connection('127.0.0.1', 8888)
-    flash_task = asyncio.create_task(run_flash_program(device_reader, device_writer, img))
+    # The simulated device runs in this event loop, connected to the host through in-memory streams
+    (host_reader, host_writer), (device_reader, device_writer) = open_loopback()
+    device_task = asyncio.create_task(simulated_device(device_reader, device_writer, timing=timing))
+    flash_task = asyncio.create_task(run_flash_program(host_reader, host_writer, img))
 
     await flash_task
+    host_writer.close()
+    await device_task
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,28 @@
+import sys
+import argparse
+from flasher.elf import load_elf
+from flasher.delta import build_delta, write_delta, DEFAULT_ERASE_SIZE, DEFAULT_WRITE_SIZE
+
+# Builds the delta bundle that upgrades devices from one release to the next, for main.py to apply in place of an ELF
+# file. Only the sectors that differ between the two releases end up in it.
+#   python make_delta.py release-1.4.elf release-1.5.elf 1.4-to-1.5.delta
+#   python main.py /dev/ttyACM0 1.4-to-1.5.delta
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a delta bundle between two releases.")
+    parser.add_argument("old_elf", help="the release the devices hold")
+    parser.add_argument("new_elf", help="the release to upgrade them to")
+    parser.add_argument("bundle", help="where to write the bundle, usually ending in .delta")
+    parser.add_argument("--erase-size", type=int, default=DEFAULT_ERASE_SIZE,
+                        help="erase size the devices report in INFO")
+    parser.add_argument("--write-size", type=int, default=DEFAULT_WRITE_SIZE,
+                        help="write size the devices report in INFO")
+    args = parser.parse_args()
+    try:
+        bundle = build_delta(load_elf(args.old_elf), load_elf(args.new_elf), args.erase_size, args.write_size)
+        write_delta(args.bundle, bundle)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(2)
+    print(str(len(bundle.changed)) + " of " + str(len(bundle.new_sectors)) + " sectors changed, "
+          + str(bundle.changed_bytes()) + " of " + str(bundle.new_length) + " bytes written to " + args.bundle + ".")
@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import argparse
+from dataclasses import asdict
+from flasher.bootloader_protocol import PicoInfo
+from flasher.planner import LinkModel, DEFAULT_PICO_INFO, plan_image, plan_delta, plan_manifest_session, fit_model
+
+# Dry run of a flash session: plans the frames that flashing an ELF file, a delta bundle (.delta) or a manifest (.json)
+# takes, without a device, and estimates how long it takes on a link. See flasher/planner.py for the model.
+#   python plan_flash.py build/app.elf                                  UART at 115200 baud, default flash times
+#   python plan_flash.py build/app.elf --baud=921600 --latency=0.001 --window=8
+#   python plan_flash.py --fit cell3-a.cap cell3-b.cap --save-model=cell3.json
+#   python plan_flash.py product.json --model=cell3.json --json=estimate.json
+
+
+def load_model(args) -> LinkModel:
+    model = LinkModel()
+    if args.model:
+        with open(args.model, 'r') as f:
+            model = LinkModel(**json.load(f))
+    if args.baud is not None:
+        model.baudrate = args.baud
+        model.byte_time = 0.0
+    if args.latency is not None:
+        model.latency = args.latency
+    if args.erase_time is not None:
+        model.sector_erase_time = args.erase_time
+    if args.page_time is not None:
+        model.page_program_time = args.page_time
+    return model
+
+
+def plan_file(path: str, info: PicoInfo, window: int, erase_batch: int):
+    extension = os.path.splitext(path)[1]
+    if extension == ".delta":
+        from flasher.delta import read_delta
+        return plan_delta(read_delta(path), info, window, erase_batch)
+    if extension == ".json":
+        from flasher.manifest import load_manifest
+        return plan_manifest_session(load_manifest(path), info, window, erase_batch)
+    from flasher.image_cache import load_elf_cached
+    return plan_image(load_elf_cached(path), info, window, erase_batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan a flash session without a device and estimate its time.")
+    parser.add_argument("file", nargs="?", help="ELF file, .delta bundle or .json manifest")
+    parser.add_argument("--pico-info", help="JSON file with the PicoInfo fields of the device, "
+                                            "defaults to what the RP2040 bootloader reports")
+    parser.add_argument("--window", type=int, default=1, help="WRIT frames in flight")
+    parser.add_argument("--erase-batch", type=int, default=1, help="sectors per ERAS")
+    parser.add_argument("--model", help="link model saved with --save-model")
+    parser.add_argument("--baud", type=int)
+    parser.add_argument("--latency", type=float, help="seconds per round trip")
+    parser.add_argument("--erase-time", type=float, help="seconds per sector erase")
+    parser.add_argument("--page-time", type=float, help="seconds per page program")
+    parser.add_argument("--fit", nargs="+", metavar="CAPTURE", help="fit the model to sessions recorded with --capture")
+    parser.add_argument("--save-model", help="where to save the (fitted) link model")
+    parser.add_argument("--json", help="also write the plan and estimate to this file")
+    args = parser.parse_args()
+    if args.file is None and not args.fit:
+        parser.error("give a file to plan, or captures to --fit")
+
+    try:
+        info = DEFAULT_PICO_INFO
+        if args.pico_info:
+            with open(args.pico_info, 'r') as f:
+                info = PicoInfo(**json.load(f))
+        model = load_model(args)
+        if args.fit:
+            model, rms = fit_model(args.fit, model)
+            print("Fitted to " + ", ".join(args.fit) + " (RMS error per command %.2f ms):" % (rms * 1000))
+            print("  latency %.3f ms, %.2f us per byte, sector erase %.2f ms, page program %.3f ms"
+                  % (model.latency * 1000, model.seconds_per_byte() * 1e6, model.sector_erase_time * 1000,
+                     model.page_program_time * 1000))
+        if args.save_model:
+            with open(args.save_model, 'w') as f:
+                json.dump(asdict(model), f, indent=2)
+        if args.file is None:
+            return
+        plan = plan_file(args.file, info, args.window, args.erase_batch)
+    except (OSError, ValueError, TypeError) as e:
+        print(f"Error: {e}")
+        sys.exit(2)
+
+    breakdown = plan.breakdown(model)
+    print(args.file + ": " + str(plan.total_frames()) + " frames ("
+          + ", ".join(op + " " + str(n) for op, n in plan.frames.items()) + ")")
+    print("  on the wire: " + str(plan.tx_bytes) + " bytes to the device, " + str(plan.rx_bytes) + " back")
+    print("  erase " + str(plan.erase_sectors) + " sectors, program " + str(plan.pages) + " pages, "
+          + str(plan.round_trips) + " round trips")
+    print("  estimated %.2f s (" % plan.estimate(model)
+          + ", ".join("%s %.2f s" % (part, seconds) for part, seconds in breakdown.items()) + ")")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"file": args.file, "frames": dict(plan.frames), "tx_bytes": plan.tx_bytes,
+                       "rx_bytes": plan.rx_bytes, "round_trips": plan.round_trips,
+                       "erase_sectors": plan.erase_sectors, "pages": plan.pages,
+                       "estimate": plan.estimate(model), "breakdown": breakdown, "model": asdict(model)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import random
+import functools
+import pytest
+import flasher.program
+from flasher.util import set_log_level
+from flasher.journal import open_journal, remove_journals
+from flasher.program import Image, Program, RetryPolicy
+from flasher_simulated.loopback import LoopbackSerial
+from flasher_simulated.flash_model import SparseFlash
+from main_simulated import simulated_device
+
+# Resuming interrupted flashes from the journal, against the simulated bootloader. Images are a few sectors long and
+# end in the middle of a sector, like real ELF files padded to the write size.
+
+IMAGE_ADDR = 0x10008000
+IMAGE_SIZE = 5 * 4096 + 700
+
+
+class _Interrupted(Exception):
+    pass
+
+
+# Passes frames to the simulated device until the first frame with the given opcode, which raises instead.
+class _CutConnection:
+    def __init__(self, conn, opcode: bytes):
+        self._conn = conn
+        self._opcode = opcode
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def write(self, data):
+        if bytes(data[:4]) == self._opcode:
+            raise _Interrupted()
+        return self._conn.write(data)
+
+
+def _image(seed: int) -> Image:
+    return Image(IMAGE_ADDR, random.Random(seed).randbytes(IMAGE_SIZE))
+
+
+def _flash(flash: SparseFlash, image: Image, cut: bytes = None):
+    conn = LoopbackSerial(functools.partial(simulated_device, flash_memory=flash), timeout=0.5)
+    try:
+        Program(conn if cut is None else _CutConnection(conn, cut), image, None, RetryPolicy(max_retries=1),
+                device_id="test")
+    finally:
+        conn.close()
+
+
+def _holds(flash: SparseFlash, image: Image) -> bool:
+    return flash.read(image.Addr, len(image.Data)) == image.Data
+
+
+@pytest.fixture(autouse=True)
+def journal_dir(tmp_path, monkeypatch):
+    set_log_level("quiet")
+    monkeypatch.setattr(flasher.program, "open_journal", functools.partial(open_journal, journal_dir=str(tmp_path)))
+    return tmp_path
+
+
+def test_resume_after_complete_write_and_interrupted_seal(journal_dir):
+    flash = SparseFlash()
+    image = _image(1)
+    with pytest.raises(_Interrupted):
+        _flash(flash, image, cut=b'SEAL')
+    assert len(list(journal_dir.iterdir())) == 1
+
+    _flash(flash, image)
+    assert _holds(flash, image)
+    assert list(journal_dir.iterdir()) == []
+
+
+def test_failed_seal_drops_the_journal(journal_dir):
+    flash = SparseFlash()
+    first, other = _image(1), _image(2)
+    with pytest.raises(_Interrupted):
+        _flash(flash, first, cut=b'SEAL')
+    # Another image flashed in between: resuming the first one leaves a mix of both, which the device won't seal
+    _flash(flash, other)
+    with pytest.raises(SystemExit):
+        _flash(flash, first)
+    assert list(journal_dir.iterdir()) == []
+
+    _flash(flash, first)
+    assert _holds(flash, first)
+
+
+def test_remove_journals_of_one_device(journal_dir):
+    image = _image(1)
+    for device in ("test", "other"):
+        open_journal(device, image.Addr, image.Data, 4096, str(journal_dir)).mark_erased(4096)
+    remove_journals("test", str(journal_dir))
+    assert [open_journal(device, image.Addr, image.Data, 4096, str(journal_dir)).erased
+            for device in ("test", "other")] == [0, 4096]